@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Accounting records for all job events, in the style of PBS accounting logs
+
+    Every record is a single line
+
+        MM/DD/YYYY HH:MM:SS;TYPE;job_id;key=value key=value ...
+
+    with TYPE 'Q' (job queued or held), 'S' (job started), 'E' (job ended), or
+    'D' (job deleted). Records are only ever appended, to one file per day in
+    $LPBS_HOME/accounting, named YYYYMMDD. The position of every record is
+    stored in an SQLite index in the same folder, by job ID, sequence number,
+    owner, and time, so that the history of a job, or all jobs of a user in a
+    date range, can be found without reading through the files. The index can
+    always be rebuilt from the files (see rebuild_index).
+"""
+
+import os
+import re
+import grp
+import time
+import shlex
+import socket
+import logging
+import sqlite3
+
+ACCOUNTING_DIR = 'accounting' # folder in $LPBS_HOME
+INDEX_FILE = 'index.db'
+RECORD_TYPES = ['Q', 'S', 'E', 'D']
+TIME_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    job_id   TEXT NOT NULL,
+    seq      INTEGER,
+    owner    TEXT,
+    type     TEXT,
+    time     REAL,
+    file     TEXT,
+    offset   INTEGER
+);
+CREATE INDEX IF NOT EXISTS records_job ON records (job_id);
+CREATE INDEX IF NOT EXISTS records_seq ON records (seq);
+CREATE INDEX IF NOT EXISTS records_owner ON records (owner, time);
+CREATE INDEX IF NOT EXISTS records_time ON records (time);
+"""
+
+_LOG_FILE_NAME = re.compile(r'^\d{8}$')
+_QUOTE_NEEDED = re.compile(r'[\s"\'\\;]')
+
+
+def accounting_folder():
+    """ Return the folder that holds the accounting logs """
+    return os.path.join(os.environ['LPBS_HOME'], ACCOUNTING_DIR)
+
+
+def format_duration(seconds):
+    """ Format the given number of seconds as HH:MM:SS """
+    seconds = int(seconds)
+    return "%02i:%02i:%02i" % (seconds // 3600, (seconds % 3600) // 60,
+                               seconds % 60)
+
+
+def quote_value(value):
+    """ Return the given attribute value as it is written into a record """
+    value = str(value).replace('\n', ' ')
+    if value == '' or _QUOTE_NEEDED.search(value):
+        value = '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return value
+
+
+def format_record(record_type, job_id, attributes, timestamp):
+    """ Return the line (including the newline) for an accounting record of
+        the given type for the given job ID, with attributes as a list of
+        tuples (key, value)
+    """
+    return "%s;%s;%s;%s\n" % (time.strftime(TIME_FORMAT,
+           time.localtime(timestamp)), record_type, job_id,
+           " ".join(["%s=%s" % (key, quote_value(value))
+                     for (key, value) in attributes if value is not None]))
+
+
+def parse_record(line):
+    """ Parse a line from an accounting log. Return a tuple (timestamp,
+        record_type, job_id, attributes), with attributes a list of tuples
+        (key, value). Raise a ValueError if the line cannot be parsed.
+    """
+    fields = line.rstrip('\n').split(';', 3)
+    if len(fields) != 4:
+        raise ValueError("Invalid accounting record: %s" % line)
+    (date, record_type, job_id, attribute_str) = fields
+    timestamp = time.mktime(time.strptime(date, TIME_FORMAT))
+    attributes = []
+    for item in shlex.split(attribute_str):
+        key, value = item.split('=', 1)
+        attributes.append((key, value))
+    return (timestamp, record_type, job_id, attributes)
+
+
+def job_attributes(job_info):
+    """ Return the attributes of the job described by job_info that are
+        written into every 'S' and 'E' record, as a list of tuples
+        (key, value)
+    """
+    try:
+        group = grp.getgrgid(os.getgid()).gr_name
+    except KeyError:
+        group = str(os.getgid())
+    attributes = [('user', job_info.owner), ('group', group),
+                  ('jobname', job_info.name), ('queue', job_info.queue),
+                  ('start', int(job_info.start_time) or None),
+                  ('exec_host', job_info.exec_host)]
+    resource_list = getattr(job_info, 'resource_list', {})
+    for field in sorted(resource_list.keys()):
+        attributes.append(("Resource_List.%s" % field, resource_list[field]))
+    attributes.append(('session', job_info.pid))
+    return attributes
+
+
+def _open_index(folder):
+    """ Return a connection to the index in the given accounting folder,
+        creating it if necessary
+    """
+    connection = sqlite3.connect(os.path.join(folder, INDEX_FILE), timeout=60)
+    connection.text_factory = str
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.DatabaseError, error:
+        logging.debug("Cannot switch accounting index to WAL mode: %s", error)
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def _attribute(attributes, key):
+    """ Return the value for the given key in the list of tuples (key, value),
+        or None
+    """
+    for (attr_key, value) in attributes:
+        if attr_key == key:
+            return value
+    return None
+
+
+def write_records(records):
+    """ Append the given records to today's accounting log, and add them to
+        the index. Every record is a tuple (record_type, job_id, attributes),
+        with attributes a list of tuples (key, value); the owner of the job is
+        taken from the 'user' attribute. Failures are logged, but never
+        raised: accounting must not get in the way of running jobs.
+    """
+    if len(records) == 0:
+        return
+    from LPBS.JobRegistry import sequence_number
+    now = time.time()
+    folder = accounting_folder()
+    log_file = time.strftime('%Y%m%d', time.localtime(now))
+    rows = []
+    try:
+        if not os.path.isdir(folder):
+            try:
+                os.mkdir(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        fd = os.open(os.path.join(folder, log_file),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            for (record_type, job_id, attributes) in records:
+                line = format_record(record_type, job_id, attributes, now)
+                # a single write with O_APPEND never interleaves with the
+                # records of other processes
+                os.write(fd, line)
+                offset = os.lseek(fd, 0, os.SEEK_CUR) - len(line)
+                rows.append((job_id, sequence_number(job_id),
+                             _attribute(attributes, 'user'), record_type,
+                             now, log_file, offset))
+        finally:
+            os.close(fd)
+    except (IOError, OSError), error:
+        logging.warn("Cannot write accounting record: %s", error)
+        return
+    try:
+        connection = _open_index(folder)
+        try:
+            with connection:
+                connection.executemany("INSERT INTO records (job_id, seq, "
+                                       "owner, type, time, file, offset) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        finally:
+            connection.close()
+    except sqlite3.Error, error:
+        logging.warn("Cannot index accounting record: %s", error)
+
+
+def write_record(record_type, job_id, attributes):
+    """ Write a single accounting record, see write_records """
+    write_records([(record_type, job_id, attributes), ])
+
+
+def account_queued(job_info):
+    """ Write the 'Q' record for the queued (or held) job described by
+        job_info
+    """
+    write_record('Q', job_info.job_id, [('user', job_info.owner),
+                 ('jobname', job_info.name), ('queue', job_info.queue),
+                 ('depend', getattr(job_info, 'depend', None))])
+
+
+def account_started(job_info):
+    """ Write the 'S' record for the job described by job_info, which has
+        just started
+    """
+    write_record('S', job_info.job_id, job_attributes(job_info))
+
+
+def account_ended(job_info, retcode, summary=None):
+    """ Write the 'E' record for the job described by job_info, which has
+        ended with the given exit status. The dict summary as returned by
+        ResourceLog.summary gives the resources used by the job, if available;
+        without any samples in it, the resources are unknown and left out
+    """
+    end_time = time.time()
+    attributes = job_attributes(job_info)
+    attributes.append(('end', int(end_time)))
+    attributes.append(('Exit_status', retcode))
+    if summary is not None and summary['samples'] > 0:
+        attributes.append(('resources_used.cput',
+                           format_duration(summary['cput'])))
+        attributes.append(('resources_used.mem',
+                           "%ikb" % (summary['maxmem'] // 1024)))
+        attributes.append(('resources_used.vmem',
+                           "%ikb" % (summary['maxvmem'] // 1024)))
+    if job_info.start_time > 0:
+        attributes.append(('resources_used.walltime',
+                           format_duration(end_time - job_info.start_time)))
+    write_record('E', job_info.job_id, attributes)
+
+
+def deleted_record(job_id, owner, requestor=None):
+    """ Return the 'D' record (for write_records) for the job with the given
+        job_id of the given owner. The requestor defaults to the current user
+    """
+    if requestor is None:
+        import getpass
+        requestor = "%s@%s" % (getpass.getuser(), socket.gethostname())
+    return ('D', job_id, [('user', owner), ('requestor', requestor)])
+
+
+def query(job_identifiers=None, owner=None, begin=None, end=None,
+    record_types=None):
+    """ Return a list of all accounting records (as returned by parse_record)
+        that match all of the given criteria, in the order in which they were
+        written: the list of job_identifiers (full job IDs or sequence
+        numbers), the owner, a begin and end time (in seconds since the
+        epoch), and a string of record types (e.g. 'SE').
+    """
+    folder = accounting_folder()
+    if not os.path.isfile(os.path.join(folder, INDEX_FILE)):
+        return []
+    conditions = []
+    params = []
+    if job_identifiers is not None:
+        job_conditions = []
+        for job_identifier in job_identifiers:
+            if job_identifier.isdigit():
+                job_conditions.append("seq = ?")
+                params.append(int(job_identifier))
+            else:
+                job_conditions.append("job_id = ?")
+                params.append(job_identifier)
+        if len(job_conditions) == 0:
+            return []
+        conditions.append("(%s)" % " OR ".join(job_conditions))
+    if owner is not None:
+        conditions.append("owner = ?")
+        params.append(owner)
+    if begin is not None:
+        conditions.append("time >= ?")
+        params.append(begin)
+    if end is not None:
+        conditions.append("time < ?")
+        params.append(end)
+    if record_types is not None:
+        conditions.append("type IN (%s)" % ", ".join(["?"] * len(record_types)))
+        params.extend(list(record_types))
+    sql = "SELECT file, offset FROM records"
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY time, rowid"
+    connection = _open_index(folder)
+    try:
+        positions = connection.execute(sql, params).fetchall()
+    finally:
+        connection.close()
+    records = []
+    open_files = {} # file name => open file
+    try:
+        for (log_file, offset) in positions:
+            if not open_files.has_key(log_file):
+                try:
+                    open_files[log_file] = open(os.path.join(folder, log_file))
+                except IOError, error:
+                    logging.warn("Cannot read accounting log: %s", error)
+                    open_files[log_file] = None
+            log_fh = open_files[log_file]
+            if log_fh is None:
+                continue
+            log_fh.seek(offset)
+            try:
+                records.append(parse_record(log_fh.readline()))
+            except ValueError, error:
+                logging.warn("%s (%s, offset %i)", error, log_file, offset)
+    finally:
+        for log_fh in open_files.values():
+            if log_fh is not None:
+                log_fh.close()
+    return records
+
+
+def rebuild_index():
+    """ Re-create the index from the accounting logs. Return the number of
+        indexed records
+    """
+    from LPBS.JobRegistry import sequence_number
+    folder = accounting_folder()
+    if not os.path.isdir(folder):
+        return 0
+    count = 0
+    connection = _open_index(folder)
+    try:
+        with connection:
+            connection.execute("DELETE FROM records")
+            for log_file in sorted(os.listdir(folder)):
+                if not _LOG_FILE_NAME.match(log_file):
+                    continue
+                log_fh = open(os.path.join(folder, log_file))
+                try:
+                    offset = 0
+                    rows = []
+                    for line in log_fh:
+                        try:
+                            (timestamp, record_type, job_id, attributes) \
+                            = parse_record(line)
+                            rows.append((job_id, sequence_number(job_id),
+                                         _attribute(attributes, 'user'),
+                                         record_type, timestamp, log_file,
+                                         offset))
+                        except ValueError, error:
+                            logging.warn("%s (%s, offset %i)", error,
+                                         log_file, offset)
+                        offset += len(line)
+                finally:
+                    log_fh.close()
+                connection.executemany("INSERT INTO records (job_id, seq, "
+                                       "owner, type, time, file, offset) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                count += len(rows)
+    finally:
+        connection.close()
+    return count
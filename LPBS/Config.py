@@ -59,12 +59,22 @@ domain: local
 # submitting the job.
 # The file given in 'sequence_file' is used for keeping track of the 'seqnr'
 # appearing in the job ID.
-# The file given in 'logfile' is used for logging all LPBS events. Both
-# 'sequence_file' and 'logfile' are relative to $LPBS_HOME.
+# All LPBS events are logged to the folder given in 'log_folder', as JSON
+# lines in one file per day; use lqlog to view them. Every process writes its
+# log entries from a background thread, in batches. If 'log_folder' is empty,
+# the plain text file given in 'logfile' is used instead. The 'sequence_file',
+# 'log_folder', and 'logfile' are relative to $LPBS_HOME.
+# The locks of jobs whose process has died (e.g. in a crash) are released, and
+# the jobs recorded as failed, by a check of all locks that lqsub and lqstat
+# run if the last check was more than 'stale_check_interval' seconds ago, and
+# that lpbsd runs at this interval. lqdel always checks first. Set to 0 to
+# disable these checks; lqstat still checks the jobs it shows.
 
 username_in_jobid: 0
 sequence_file: sequence
+log_folder: log
 logfile: lpbs.log
+stale_check_interval: 60
 
 
 [Scratch]
@@ -77,12 +87,59 @@ logfile: lpbs.log
 # the full job ID is created inside scratch_root. This folder is automatically
 # deleted when the job ends, unless 'keep_scratch' is set to 1. If the job
 # failed, the scratch will not be deleted, unless 'delete_failed_scratch' is set
-# to 1.
+# to 1. Deleted folders are first moved to the folder .lpbs_trash inside
+# scratch_root, and then removed by a background process at idle priority
+# (see 'lqstat -B').
+# Files given with 'lqsub -W stagein=...' are staged in to the job's scratch
+# folder (or scratch_root) before the job starts, and those given with
+# 'lqsub -W stageout=...' are staged out after it has ended, using
+# 'stage_threads' threads. Files are hard-linked or reflinked instead of copied
+# where the filesystem allows it. If 'stage_store' is set to 1, staged-in files
+# are kept read-only in the folder .lpbs_stage inside scratch_root, once for
+# every distinct content, and shared between all jobs that stage them in. Files
+# in the store that no job uses are removed after 'stage_store_ttl' seconds.
 
 scratch_root: $SCRATCH_ROOT
 create_jobid_folder: 0
 keep_scratch: 0
 delete_failed_scratch: 0
+stage_threads: 4
+stage_store: 1
+stage_store_ttl: 86400
+
+
+[Scheduler]
+
+# Settings for the local scheduler. If 'enabled' is set to 1, jobs are not
+# started immediately, but wait in the queue (state 'Q') until the cores and
+# memory they request with the '-l' option of lqsub (nodes/ppn, procs, ncpus,
+# and mem) are free in the pool given by 'cores' and 'memory'. If 'cores' or
+# 'memory' is 0, the number of CPUs or the physical memory of the machine is
+# used. Memory may be given with a unit, e.g. '32gb'. Jobs that do not request
+# any resources use one core. Queued jobs are started in FIFO order; if
+# 'backfill' is set to 1, later jobs that fit into the free resources may start
+# ahead of an earlier job that does not fit yet. The queue is processed
+# whenever a job is submitted or finishes; queued jobs are only started by
+# processes of the user who submitted them.
+
+enabled: 0
+cores: 0
+memory: 0
+backfill: 1
+
+
+[Monitoring]
+
+# The resource usage (CPU time, memory, and threads) of every running job is
+# sampled every 'interval' seconds, and written to the file
+# $LPBS_HOME/<job_id>.res. The last 'samples' samples are kept in the file. The
+# peak memory usage and the CPU efficiency (CPU time per walltime and requested
+# core) are tracked over the entire run of the job, and are shown by
+# 'lqstat -f'. The .res files are kept after the job has finished, and may be
+# deleted at any time. Setting 'interval' to 0 disables the sampling.
+
+interval: 60
+samples: 1440
 
 
 [Notification]
@@ -93,9 +150,20 @@ delete_failed_scratch: 0
 # 'send_growl' is set to 1, Growl (http://growl.info) is used for notification
 # on MacOS X. Notifications via Growl do not take into account the '-m' options
 # during job submission.
+#
+# Notifications are delivered in the background and never delay a job. Every
+# connection to a mail or Growl server is abandoned after 'timeout' seconds. A
+# failed notification is retried up to 'retries' times, waiting 'backoff'
+# seconds before the first retry, and twice as long before every further retry.
+# Before exiting, a process waits at most 'flush_timeout' seconds for its
+# pending notifications to be delivered.
 
 send_mail: 0
 send_growl: 0
+timeout: 10
+retries: 3
+backoff: 2
+flush_timeout: 30
 
 
 [Mail]
@@ -104,7 +172,11 @@ send_growl: 0
 # the address given by the 'from' option. The SMTP server given in 'smtp' is
 # used for sending the emails, if 'authenticate' is set to 1, authentication is
 # done with the given 'username' and 'password'. If 'tls' is 1, TLS encryption
-# will be used.
+# will be used. Mails are sent in the background, without delaying the job. If
+# 'digest' is set to a number of seconds greater than 0, notifications are not
+# sent right away, but collected and sent as a single mail every 'digest'
+# seconds. The digest is sent with the settings in $LPBS_HOME/lpbs.cfg and
+# $HOME/.lpbs.cfg, not with those of a config file given to lqsub.
 
 from: nobody@example.org
 smtp: smtp.example.com:587
@@ -112,6 +184,7 @@ username: user
 password: secret
 authenticate: 0
 tls: 1
+digest: 0
 
 
 [Growl]
@@ -124,10 +197,16 @@ tls: 1
 # It is possible to send notifications to more than one host. In this case, both
 # 'hostname' and 'password' should be a comma-separated list of values, with
 # each item corresponding to one host.
+#
+# A successful registration with a Growl host is remembered for
+# 'registration_ttl' seconds, and a host that could not be reached is not
+# contacted again for 'failure_ttl' seconds.
 
 hostname: localhost:23053
 password:
 sticky: 0
+registration_ttl: 86400
+failure_ttl: 300
 
 
 [Log]
@@ -146,7 +225,8 @@ def verify_config(config):
     try:
         for (section, key) in [('LPBS', 'username_in_jobid'),
         ('Scratch', 'create_jobid_folder'), ('Scratch', 'keep_scratch'),
-        ('Scratch', 'delete_failed_scratch'), ('Notification', 'send_mail'),
+        ('Scratch', 'delete_failed_scratch'), ('Scheduler', 'enabled'),
+        ('Scheduler', 'backfill'), ('Notification', 'send_mail'),
         ('Notification', 'send_growl'), ('Mail', 'authenticate'),
         ('Mail', 'tls'), ('Growl', 'sticky')]:
             try:
@@ -195,7 +275,8 @@ def get_config(config_file):
         c) the specified config_file
     """
     config = SafeConfigParser()
-    # Defaults
+    # Defaults (rewound, as a long-running process may read them repeatedly)
+    DEFAULTS.seek(0)
     config.readfp(DEFAULTS)
     config_files = []
     # $LPBS_HOME/lpbs.cfg
@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" The lpbsd daemon: run and supervise all jobs of one user from a single
+    event loop
+
+    Jobs are direct children of the daemon. They are reaped on SIGCHLD, which
+    (like SIGTERM and SIGHUP) wakes up the event loop through a self-pipe. The
+    lqsub, lqstat, and lqdel commands talk to the daemon over the socket given
+    by LPBS.DaemonClient.socket_path().
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+import getpass
+import logging
+from LPBS.Config import get_config
+from LPBS.JobUtils import JobInfo, array_job_id, parse_array_request, \
+                          find_jobs, remove_stale_jobs, \
+                          get_cpu_mem_info_for_pids, reap_stale_jobs, \
+                          stale_check_interval
+from LPBS.ResourceLog import sampling_interval
+from LPBS.JobRegistry import get_registry
+from LPBS.JobRunner import Job, new_job_id, set_resource_request, \
+                           array_slots, queue_pbs_script, \
+                           adopt_script_copy
+from LPBS.Scheduler import scheduler_enabled, remove_queued_jobs, claim_jobs
+from LPBS.Dependencies import record_exit, job_dependencies, EXIT_FAILED, \
+                              EXIT_DELETED
+from LPBS.Accounting import account_started, account_ended, write_record, \
+                            deleted_record
+from LPBS.DaemonClient import socket_path, send_message, receive_message
+from LPBS.Notifications import flush_notifications
+from LPBS.EventLog import flush_log
+
+# SO_PEERCRED is not exported by the socket module of Python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class ArrayRun:
+    """ All tasks of a job array, run by the daemon with at most the number of
+        simultaneously running tasks given by the slot limit
+    """
+    def __init__(self, daemon, pbs_script, array_id, options, environ, cwd):
+        """ Initialize, and set the lock for the array """
+        self.daemon = daemon
+        self.pbs_script = pbs_script
+        self.job_id = array_id
+        self.options = options
+        self.environ = environ
+        self.cwd = cwd
+        self.indices, self.slot_limit = \
+            parse_array_request(options.array_request)
+        self.running = {} # pid => Job
+        self.failed = 0
+        self.canceled = False
+        self.job_info = JobInfo(array_id)
+        self.job_info.name = os.path.basename(pbs_script)
+        if options.job_name is not None:
+            self.job_info.name = options.job_name
+        if options.queue is not None:
+            self.job_info.queue = options.queue
+        self.job_info.mail_points = options.mail_options
+        set_resource_request(self.job_info, options,
+                             slots=array_slots(options.array_request))
+        self.job_info.owner = getpass.getuser()
+        self.job_info.start_time = time.time()
+        # The array has no process of its own: its lock belongs to the daemon
+        self.job_info.set_lock(os.getpid())
+        account_started(self.job_info)
+        logging.info("Submitted job array %s with %i tasks", array_id,
+                     len(self.indices))
+
+    def start_tasks(self):
+        """ Start as many pending tasks as the slot limit allows """
+        while len(self.indices) > 0 and (self.slot_limit is None
+        or len(self.running) < self.slot_limit):
+            index = self.indices.pop(0)
+            task_id = array_job_id(self.job_id.replace('[]', '', 1), index)
+            job = Job(self.pbs_script, task_id, self.options, index,
+                      self.environ, self.cwd)
+            if self.daemon.start_job(job):
+                self.running[job.process.pid] = job
+            else:
+                self.failed += 1
+        if len(self.running) == 0:
+            if self.canceled:
+                write_record(*deleted_record(self.job_id,
+                                             self.job_info.owner))
+                retcode = EXIT_DELETED
+            else:
+                retcode = int(self.failed > 0)
+            account_ended(self.job_info, retcode)
+            record_exit(self.job_id, retcode)
+            self.job_info.release_lock()
+            if os.path.basename(self.pbs_script) == "%s.SC" % self.job_id:
+                # copy of the script of a queued array
+                try:
+                    os.unlink(self.pbs_script)
+                except OSError:
+                    pass
+            if self.canceled:
+                logging.info("Canceled job array %s", self.job_id)
+            else:
+                logging.info("Finished job array %s (%i failed tasks)",
+                             self.job_id, self.failed)
+            return False
+        return True
+
+    def task_finished(self, pid, retcode):
+        """ Handle the end of the task with the given pid. Return False if the
+            array is finished, True otherwise
+        """
+        job = self.running.pop(pid)
+        if retcode != 0:
+            self.failed += 1
+        self.daemon.end_job(job, retcode)
+        return self.start_tasks()
+
+    def pids(self):
+        """ Return a list of the PIDs of all running tasks """
+        return self.running.keys()
+
+    def cancel(self):
+        """ Cancel all pending tasks, and mark the running tasks as canceled
+        """
+        self.canceled = True
+        self.indices = []
+        for job in self.running.values():
+            job.canceled = True
+
+
+class Daemon:
+    """ Server for the requests of lqsub, lqstat, and lqdel """
+    def __init__(self, options):
+        """ Initialize for the options of lpbsd (with options.config being the
+            ConfigParser for the daemon itself)
+        """
+        self.options = options
+        self.socket_path = socket_path()
+        self.server = None
+        self.wakeup_r = None
+        self.wakeup_w = None
+        self.runs = {} # job ID => Job or ArrayRun
+        self.pids = {} # pid => job ID of the Job or ArrayRun it belongs to
+        self.timers = [] # list of tuples (time, function, args)
+        self.configs = {} # config file => ConfigParser
+        self.shutting_down = False
+        self.reload_config = False
+
+    def bind(self):
+        """ Create the listening socket. Return False if another daemon is
+            already listening on it
+        """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+            probe.close()
+            return False
+        except socket.error:
+            probe.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen(32)
+        self.server.setblocking(False)
+        _set_cloexec(self.server.fileno())
+        return True
+
+    def run(self):
+        """ Run the event loop until the daemon is shut down, and all of its
+            jobs have finished
+        """
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            _set_cloexec(fd)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGHUP, self._handle_signal)
+        for sig in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT,
+        signal.SIGHUP):
+            # restart interrupted system calls while talking to a client
+            signal.siginterrupt(sig, False)
+        logging.info("lpbsd started (PID %s)", os.getpid())
+        # pick up jobs queued while no daemon was running
+        self.dispatch()
+        if sampling_interval(self.options.config) > 0:
+            self.add_timer(sampling_interval(self.options.config),
+                           self.sample_jobs)
+        self.check_stale_locks()
+        while not (self.shutting_down and len(self.runs) == 0):
+            readers = [self.wakeup_r]
+            if self.server is not None:
+                readers.append(self.server)
+            try:
+                ready, _, _ = select.select(readers, [], [],
+                                            self._timeout())
+            except select.error, error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                ready = []
+            if self.wakeup_r in ready:
+                self._drain_wakeup()
+            self.reap_children()
+            self.run_timers()
+            if self.reload_config:
+                logging.info("Reloading configuration")
+                self.configs = {}
+                self.reload_config = False
+            if self.server in ready:
+                self.accept()
+        flush_notifications()
+        logging.info("lpbsd stopped")
+
+    def _handle_signal(self, sig, stack):
+        """ Record a signal; the event loop is woken up by set_wakeup_fd """
+        if sig in (signal.SIGTERM, signal.SIGINT):
+            self.shutdown()
+        elif sig == signal.SIGHUP:
+            self.reload_config = True
+
+    def _drain_wakeup(self):
+        """ Read all pending data from the self-pipe """
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError, error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def _timeout(self):
+        """ Return the time in seconds until the next timer is due, or None if
+            there are no timers
+        """
+        if len(self.timers) == 0:
+            return None
+        return max(0, min([timer[0] for timer in self.timers]) - time.time())
+
+    def add_timer(self, delay, function, *args):
+        """ Call function(*args) from the event loop after delay seconds """
+        self.timers.append((time.time() + delay, function, args))
+
+    def run_timers(self):
+        """ Call all timers that are due """
+        now = time.time()
+        due = [timer for timer in self.timers if timer[0] <= now]
+        self.timers = [timer for timer in self.timers if timer[0] > now]
+        for (_, function, args) in due:
+            function(*args)
+
+    def shutdown(self):
+        """ Stop accepting requests. The daemon exits as soon as all running
+            jobs have finished
+        """
+        if self.server is not None:
+            logging.info("Shutting down, waiting for %i jobs", len(self.runs))
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        self.shutting_down = True
+
+    def sample_jobs(self):
+        """ Sample the resource usage of all running jobs, in a single pass
+            over /proc, and schedule the next sampling
+        """
+        jobs = []
+        for run in self.runs.values():
+            if isinstance(run, ArrayRun):
+                jobs.extend(run.running.values())
+            else:
+                jobs.append(run)
+        cpu_mem_info = get_cpu_mem_info_for_pids(
+                       [job.process.pid for job in jobs])
+        for job in jobs:
+            job.sample(cpu_mem_info[job.process.pid])
+        self.add_timer(sampling_interval(self.options.config),
+                       self.sample_jobs)
+
+    def check_stale_locks(self):
+        """ Release the locks of all jobs whose process has died, and schedule
+            the next check
+        """
+        interval = stale_check_interval(self.options.config)
+        if interval <= 0:
+            return
+        if len(reap_stale_jobs()) > 0:
+            # jobs held for the stale jobs may have been released
+            self.dispatch()
+        self.add_timer(interval, self.check_stale_locks)
+
+    def get_config(self, config_file):
+        """ Return the ConfigParser for the given config file of a client.
+            Raise a ValueError if the config cannot be loaded
+        """
+        if config_file is not None:
+            config_file = os.path.abspath(config_file)
+        if not self.configs.has_key(config_file):
+            try:
+                self.configs[config_file] = get_config(config_file)
+            except SystemExit:
+                # get_config exits on unrecoverable errors
+                raise ValueError("Unrecoverable error in config data")
+        return self.configs[config_file]
+
+    def start_job(self, job):
+        """ Prepare and start the given Job. Return True if the job is running,
+            False otherwise
+        """
+        job.canceled = False
+        try:
+            if not job.prepare():
+                job.fail("Cannot prepare job")
+                return False
+            job.start(new_session=True)
+        except (OSError, IOError), error:
+            job.fail(error)
+            return False
+        return True
+
+    def end_job(self, job, retcode):
+        """ Clean up after the given job has ended with the given retcode """
+        # prevent subprocess from trying to reap the process again
+        job.process.returncode = retcode
+        if job.canceled or retcode < 0:
+            job.cancel()
+        else:
+            job.finish(retcode)
+
+    def run_job(self, pbs_script, job_id, options, environ, cwd):
+        """ Run the job (or job array) given by pbs_script under job_id """
+        if options.array_request is not None:
+            run = ArrayRun(self, pbs_script, job_id, options, environ, cwd)
+            if not run.start_tasks():
+                return
+            self.runs[job_id] = run
+            for pid in run.pids():
+                self.pids[pid] = job_id
+        else:
+            job = Job(pbs_script, job_id, options, None, environ, cwd)
+            if self.start_job(job):
+                self.runs[job_id] = job
+                self.pids[job.process.pid] = job_id
+
+    def dispatch(self):
+        """ Start all queued jobs that fit into the free resources """
+        if self.shutting_down:
+            return
+        for (job_id, spec) in claim_jobs(self.options.config):
+            logging.debug("Starting queued job %s", job_id)
+            self.run_job(spec['pbs_script'], job_id, spec['options'],
+                         spec['environ'], spec['cwd'])
+            if not self.runs.has_key(job_id):
+                record_exit(job_id, EXIT_FAILED)
+                JobInfo(job_id).release_lock()
+
+    def reap_children(self):
+        """ Collect the exit status of all children that have ended """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, error:
+                if error.errno == errno.EINTR:
+                    continue
+                break # ECHILD
+            if pid == 0:
+                break
+            if os.WIFSIGNALED(status):
+                retcode = -os.WTERMSIG(status)
+            else:
+                retcode = os.WEXITSTATUS(status)
+            job_id = self.pids.pop(pid, None)
+            if job_id is None:
+                continue
+            run = self.runs[job_id]
+            if isinstance(run, ArrayRun):
+                if run.task_finished(pid, retcode):
+                    for task_pid in run.pids():
+                        self.pids[task_pid] = job_id
+                else:
+                    del self.runs[job_id]
+            else:
+                self.end_job(run, retcode)
+                del self.runs[job_id]
+            self.dispatch()
+
+    def accept(self):
+        """ Handle all pending client connections """
+        while self.server is not None:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error, error:
+                if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                try:
+                    conn.setblocking(True)
+                    conn.settimeout(10)
+                    if not self.check_peer(conn):
+                        continue
+                    (command, data) = receive_message(conn)
+                    send_message(conn, self.handle(command, data))
+                except (socket.error, EOFError, struct.error), error:
+                    logging.warn("Error in communication with client: %s",
+                                 error)
+            finally:
+                conn.close()
+
+    def check_peer(self, conn):
+        """ Return True if the client connected to conn runs as the same user
+            as the daemon
+        """
+        try:
+            creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                    struct.calcsize('3i'))
+            (pid, uid, gid) = struct.unpack('3i', creds)
+        except socket.error, error:
+            logging.warn("Cannot check credentials of client: %s", error)
+            return False
+        if uid != os.getuid():
+            logging.warn("Rejected client with uid %s (PID %s)", uid, pid)
+            return False
+        return True
+
+    def handle(self, command, data):
+        """ Return the reply to the given request of a client """
+        handler = getattr(self, "handle_%s" % command, None)
+        if handler is None:
+            return {'status': 1, 'error': "Unknown command '%s'" % command}
+        try:
+            return handler(data)
+        except Exception, error:
+            logging.exception("Error handling %s request", command)
+            return {'status': 1, 'error': str(error)}
+
+    def handle_submit(self, data):
+        """ Submit a job. The data is a dict with the keys 'pbs_script' (the
+            absolute path of the script), 'script_copy' (a copy of the script
+            in $LPBS_HOME, which is renamed to the copy for the job), 'options'
+            (as parsed by lqsub, with options.config being the name of the
+            config file), 'environ' and 'cwd'
+        """
+        options = data['options']
+        environ = data['environ']
+        cwd = data['cwd']
+        pbs_script = data['pbs_script']
+        try:
+            options.config = self.get_config(options.config)
+            job_id = new_job_id(options)
+            if options.job_name is None:
+                options.job_name = os.path.basename(pbs_script)
+            if data.get('script_copy') is not None:
+                pbs_script = adopt_script_copy(data['script_copy'], job_id)
+            if ( scheduler_enabled(options.config)
+            or len(job_dependencies(options)) > 0 ):
+                try:
+                    queue_pbs_script(pbs_script, job_id, options, environ,
+                                     cwd)
+                except ValueError:
+                    if pbs_script != data['pbs_script']:
+                        os.unlink(pbs_script)
+                    raise
+                # after the reply, as starting a job may involve staging files
+                self.add_timer(0, self.dispatch)
+            else:
+                self.run_job(pbs_script, job_id, options, environ, cwd)
+        except ValueError, error:
+            return {'status': 1, 'error': str(error)}
+        return {'status': 0, 'job_id': job_id}
+
+    def handle_stat(self, data):
+        """ Return the list of JobInfo instances for all jobs matching the
+            dict data with keys 'job_ids', 'owner', 'array_tasks', and
+            (optionally) 'sample'
+        """
+        jobs = find_jobs(data['job_ids'], owner=data['owner'],
+                         array_tasks=data['array_tasks'],
+                         sample=data.get('sample', True))
+        alive = remove_stale_jobs(jobs)
+        if len(alive) < len(jobs):
+            # jobs held for the stale jobs may have been released
+            self.add_timer(0, self.dispatch)
+        return {'status': 0, 'jobs': alive}
+
+    def handle_delete(self, data):
+        """ Delete all jobs matching the job identifiers in the list
+            data['job_ids'] ('all' for all jobs). Queued jobs are removed from
+            the queue, and jobs run by the daemon are sent a SIGTERM, followed
+            by a SIGKILL after data['delay'] seconds. The reply contains the
+            list of the job IDs of all matching jobs not run by the daemon
+            under the key 'unhandled'.
+        """
+        # no job is touched unless the request is valid
+        try:
+            delay = float(data['delay'])
+        except (KeyError, TypeError, ValueError):
+            delay = -1
+        if delay < 0:
+            return {'status': 1,
+                    'error': "Invalid delay: %s" % data.get('delay')}
+        job_ids = data['job_ids']
+        if 'all' in job_ids:
+            job_ids = [None, ]
+        unhandled = []
+        for job_id in job_ids:
+            remove_queued_jobs(job_id)
+            for (matched_id, pid) in get_registry().lookup(job_id):
+                run = self.runs.get(matched_id)
+                if run is None:
+                    if not matched_id in unhandled:
+                        unhandled.append(matched_id)
+                    continue
+                if isinstance(run, ArrayRun):
+                    run.cancel()
+                    jobs = run.running.values()
+                else:
+                    run.canceled = True
+                    jobs = [run, ]
+                for job in jobs:
+                    self._kill(job, signal.SIGTERM)
+                    self.add_timer(delay, self._kill, job, signal.SIGKILL)
+        # tasks of arrays run by the daemon are handled through the array
+        unhandled = [job_id for job_id in unhandled
+                     if not self.runs.has_key(_array_of(job_id))]
+        # jobs held for the removed queued jobs may have been released
+        self.add_timer(0, self.dispatch)
+        return {'status': 0, 'unhandled': unhandled}
+
+    def _kill(self, job, sig):
+        """ Send sig to the process group of the given job, if it is still
+            running
+        """
+        if job.process.returncode is not None:
+            return
+        try:
+            os.killpg(job.process.pid, sig)
+            logging.info("Sent signal %s to job %s (PID %s)", sig,
+                         job.job_id, job.process.pid)
+        except OSError, error:
+            logging.debug("Failed to send signal to job %s: %s", job.job_id,
+                          error)
+
+    def handle_shutdown(self, data):
+        """ Shut down the daemon once all running jobs have finished """
+        self.shutdown()
+        return {'status': 0, 'running': len(self.runs)}
+
+
+def _array_of(job_id):
+    """ Return the ID of the job array of the given array task ID """
+    if '[' in job_id:
+        return array_job_id(job_id[:job_id.index('[')]
+                            + job_id[job_id.index(']')+1:])
+    return None
+
+
+def _set_cloexec(fd):
+    """ Don't let jobs inherit the given file descriptor """
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def daemonize():
+    """ Detach the current process from its terminal, in a new session """
+    flush_log()
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    os.chdir('/')
+    devnull = open(os.devnull, 'r+')
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+        os.dup2(devnull.fileno(), stream.fileno())
+    devnull.close()
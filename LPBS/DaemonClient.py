@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Talk to a running lpbsd over its Unix socket in $LPBS_HOME
+
+    Every request and reply is a single pickled object, preceded by its length
+    as a 4-byte unsigned integer in network byte order. A request is a tuple
+    (command, data), a reply is a dict with at least the key 'status' (0 on
+    success).
+"""
+
+import os
+import socket
+import struct
+import getpass
+import cPickle as pickle
+
+HEADER = struct.Struct('!I')
+
+# Timeout for a single request, in seconds. Stat requests for many jobs may
+# take a while, but a client must never hang forever on a wedged daemon
+REQUEST_TIMEOUT = 60
+
+
+def socket_path():
+    """ Return the path of the socket of the daemon of the current user """
+    return os.path.join(os.environ['LPBS_HOME'],
+                        "lpbsd.%s.sock" % getpass.getuser())
+
+
+def send_message(sock, obj):
+    """ Send obj over the given socket """
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    """ Receive exactly size bytes from the given socket. Raise an EOFError if
+        the connection is closed before that
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if chunk == '':
+            raise EOFError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def receive_message(sock):
+    """ Receive an object sent with send_message from the given socket. Raise
+        an EOFError if the connection is closed
+    """
+    (size, ) = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+def send_request(command, data=None):
+    """ Send the given command and data to the daemon, and return its reply.
+        Return None if no daemon is running, in which case the caller must
+        handle the request itself.
+    """
+    path = socket_path()
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            # don't talk to (or hand our environment to) somebody else's daemon
+            return None
+    except OSError:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(REQUEST_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            # stale socket file: the daemon is not running
+            return None
+        send_message(sock, (command, data))
+        return receive_message(sock)
+    finally:
+        sock.close()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Dependencies between jobs, as requested with 'lqsub -W depend=...'
+
+    A job with dependencies is held in the job registry with status 'H', and
+    the dependencies are stored in the 'depends' table. No process waits for a
+    held job: when a job ends, its exit status is recorded in the 'exits'
+    table, and in the same transaction, all jobs that depend on it are
+    checked. Jobs whose dependencies are satisfied are released into the queue
+    (status 'Q'), from where they are started like any other queued job. Jobs
+    whose dependencies can never be satisfied are deleted, which in turn may
+    release or delete the jobs depending on them.
+"""
+
+import os
+import time
+import logging
+import sqlite3
+from LPBS.JobRegistry import get_registry, sequence_number
+from LPBS.Accounting import write_records, deleted_record
+
+DEPEND_TYPES = ['afterok', 'afternotok', 'afterany', 'singleton']
+
+EXIT_FAILED = -1 # the job could not be run (JOB_EXEC_FAIL1 in TORQUE)
+EXIT_DELETED = 271 # the job was deleted (256 + SIGTERM, as in TORQUE)
+
+EXIT_RECORD_TTL = 7 * 86400 # seconds for which exit statuses are kept
+
+
+def parse_depend(depend):
+    """ Parse the value of the depend attribute, e.g.
+        'afterok:12.localhost.local:13,singleton'. Return a list of tuples
+        (type, job_identifier), with job_identifier None for 'singleton'.
+        Raise a ValueError if depend cannot be parsed
+    """
+    dependencies = []
+    if depend is None:
+        return dependencies
+    for item in depend.split(','):
+        parts = [part.strip() for part in item.strip().split(':')]
+        depend_type = parts[0]
+        if not depend_type in DEPEND_TYPES:
+            raise ValueError("Unsupported dependency '%s'" % item)
+        if depend_type == 'singleton':
+            if len(parts) > 1:
+                raise ValueError("Invalid dependency '%s'" % item)
+            dependencies.append((depend_type, None))
+            continue
+        if len(parts) < 2 or '' in parts:
+            raise ValueError("Invalid dependency '%s'" % item)
+        for job_id in parts[1:]:
+            if '[' in job_id and not '[]' in job_id:
+                raise ValueError("Dependencies on array tasks are not "
+                                 "supported: '%s'" % job_id)
+            dependencies.append((depend_type, job_id))
+    return dependencies
+
+
+def job_dependencies(options):
+    """ Return the list of dependencies (as returned by parse_depend) given
+        with the -W option in the lqsub options
+    """
+    from LPBS.JobUtils import parse_extra_attributes
+    attributes = parse_extra_attributes(options.extra_attributes)
+    return parse_depend(attributes.get('depend'))
+
+
+def dependency_satisfied(depend_type, retcode):
+    """ Return True if a dependency of the given type on a job that has ended
+        with the given exit status is satisfied
+    """
+    if depend_type == 'afterok':
+        return (retcode == 0)
+    if depend_type == 'afternotok':
+        return (retcode != 0)
+    return True
+
+
+def _resolve(connection, job_identifier):
+    """ Return the full job ID of the job (running, queued, or finished) that
+        matches the given job identifier, either a full job ID or a sequence
+        number. Raise a ValueError if there is no such job
+    """
+    if job_identifier.isdigit():
+        where = "seq = ?"
+        param = int(job_identifier)
+    else:
+        where = "job_id = ?"
+        param = job_identifier
+    # a job that has ended may still be in the jobs table for a moment
+    for table in ('exits', 'jobs'):
+        row = connection.execute("SELECT job_id FROM %s WHERE %s "
+                                 "ORDER BY length(job_id), job_id LIMIT 1"
+                                 % (table, where), (param, )).fetchone()
+        if row is not None:
+            return row[0]
+    raise ValueError("Unknown job '%s' in dependency" % job_identifier)
+
+
+def _singleton_parents(connection, job_info):
+    """ Return the job IDs of all earlier jobs of the same owner with the same
+        name as job_info that have not ended yet
+    """
+    from LPBS.JobUtils import decode_job_info
+    parents = []
+    for (job_id, info) in connection.execute(
+    "SELECT job_id, info FROM jobs WHERE owner = ? AND seq < ?",
+    (job_info.owner, sequence_number(job_info.job_id))):
+        if '[' in job_id and not '[]' in job_id:
+            continue # array task
+        try:
+            if decode_job_info(str(info)).name == job_info.name:
+                parents.append(job_id)
+        except ValueError:
+            continue
+    return parents
+
+
+def _evaluate(connection, job_id):
+    """ Return the state of the held job with the given job_id according to
+        its dependencies: 'H' if it must wait for more jobs to end, 'Q' if it
+        can be released, or None if its dependencies can never be satisfied
+    """
+    state = 'Q'
+    for (depend_type, retcode) in connection.execute(
+    "SELECT depends.type, exits.retcode FROM depends LEFT JOIN exits "
+    "ON exits.job_id = depends.parent_id WHERE depends.job_id = ?",
+    (job_id, )):
+        if retcode is None:
+            state = 'H'
+        elif not dependency_satisfied(depend_type, retcode):
+            return None
+    return state
+
+
+def _release(connection, job_id):
+    """ Change the status of the held job with the given job_id to queued.
+        Return False if there is no such job
+    """
+    row = connection.execute("SELECT info FROM jobs WHERE job_id = ? "
+                             "AND status = 'H'", (job_id, )).fetchone()
+    if row is None:
+        return False
+    from LPBS.JobUtils import decode_job_info
+    job_info = decode_job_info(str(row[0]))
+    job_info.status = 'Q'
+    info = sqlite3.Binary(job_info.encode())
+    connection.execute("UPDATE jobs SET status = 'Q', info = ? "
+                       "WHERE job_id = ?", (info, job_id))
+    return True
+
+
+def hold_job(job_info, spec, dependencies):
+    """ Put the job described by job_info into the registry, held until the
+        given dependencies (as returned by parse_depend) are satisfied, or
+        queued right away if they are satisfied already. The spec is stored
+        with the job as for queue_job. Raise a ValueError if a dependency
+        refers to an unknown job, or can never be satisfied
+    """
+    registry = get_registry()
+    connection = registry.connection
+    with connection:
+        # lock the registry, so that no parent can end unnoticed
+        connection.execute("BEGIN IMMEDIATE")
+        parents = []
+        for (depend_type, job_identifier) in dependencies:
+            if depend_type == 'singleton':
+                for parent_id in _singleton_parents(connection, job_info):
+                    parents.append((parent_id, 'afterany'))
+            else:
+                parents.append((_resolve(connection, job_identifier),
+                                depend_type))
+        connection.executemany("INSERT INTO depends (job_id, parent_id, type) "
+                               "VALUES (?, ?, ?)", [(job_info.job_id,
+                               parent_id, depend_type) for (parent_id,
+                               depend_type) in parents])
+        state = _evaluate(connection, job_info.job_id)
+        if state is None:
+            raise ValueError("The dependencies of job %s can never be "
+                             "satisfied" % job_info.job_id)
+        if state == 'Q':
+            connection.execute("DELETE FROM depends WHERE job_id = ?",
+                               (job_info.job_id, ))
+        job_info.status = state
+        job_info.pid = None
+        registry.insert(job_info, spec)
+    if state == 'H':
+        logging.info("Held job %s until %s", job_info.job_id,
+                     ", ".join(["%s:%s" % (depend_type, parent_id)
+                                for (parent_id, depend_type) in parents]))
+    else:
+        logging.info("Queued job %s, its dependencies are satisfied",
+                     job_info.job_id)
+
+
+def record_exit(job_id, retcode):
+    """ Record that the job (or job array) with the given job_id has ended
+        with the given exit status, and release or delete all jobs that were
+        held for it. Only the first exit status recorded for a job counts.
+        Return the list of job IDs of the released jobs
+    """
+    registry = get_registry()
+    connection = registry.connection
+    now = time.time()
+    released = []
+    deleted = []
+    deleted_records = [] # accounting records for the deleted jobs
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        cursor = connection.execute("INSERT OR IGNORE INTO exits "
+                                    "(job_id, seq, retcode, time) VALUES "
+                                    "(?, ?, ?, ?)", (job_id,
+                                    sequence_number(job_id), retcode, now))
+        if cursor.rowcount == 0:
+            return released
+        # a held job that was deleted no longer waits for anything
+        connection.execute("DELETE FROM depends WHERE job_id = ?", (job_id, ))
+        connection.execute("DELETE FROM exits WHERE time < ? AND job_id NOT "
+                           "IN (SELECT parent_id FROM depends)",
+                           (now - EXIT_RECORD_TTL, ))
+        ended = [job_id, ]
+        while len(ended) > 0:
+            parent_id = ended.pop()
+            for (child_id, ) in connection.execute(
+            "SELECT DISTINCT job_id FROM depends WHERE parent_id = ?",
+            (parent_id, )).fetchall():
+                state = _evaluate(connection, child_id)
+                if state == 'H':
+                    continue
+                connection.execute("DELETE FROM depends WHERE job_id = ?",
+                                   (child_id, ))
+                if state == 'Q':
+                    if _release(connection, child_id):
+                        released.append(child_id)
+                else:
+                    row = connection.execute("SELECT owner FROM jobs WHERE "
+                                             "job_id = ? AND status = 'H'",
+                                             (child_id, )).fetchone()
+                    if row is not None:
+                        deleted_records.append(deleted_record(child_id,
+                                               row[0], requestor='lpbs'))
+                    connection.execute("DELETE FROM jobs WHERE job_id = ? "
+                                       "AND status = 'H'", (child_id, ))
+                    connection.execute("INSERT OR IGNORE INTO exits "
+                                       "(job_id, seq, retcode, time) VALUES "
+                                       "(?, ?, ?, ?)", (child_id,
+                                       sequence_number(child_id),
+                                       EXIT_DELETED, now))
+                    deleted.append(child_id)
+                    ended.append(child_id)
+    for child_id in released:
+        logging.info("Released job %s", child_id)
+    for child_id in deleted:
+        logging.info("Deleted job %s, its dependencies can never be "
+                     "satisfied", child_id)
+        try:
+            os.unlink(os.path.join(registry.lpbs_home, "%s.SC" % child_id))
+        except OSError:
+            pass
+    write_records(deleted_records)
+    return released
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Log of all LPBS events, shared by all processes
+
+    Log entries are written as JSON lines into one segment file per day, named
+    YYYYMMDD.jsonl, in the 'log_folder' given in the [LPBS] section of the
+    config. A process never writes to the segment while it logs: the entries
+    are put into a queue, and written by a background thread, in batches of
+    whole lines that each take a single write. The entries of concurrent
+    processes therefore never interleave within a line, but the segment is not
+    strictly in order of time; read_entries sorts them.
+
+    If 'log_folder' is empty, the plain text 'logfile' is used instead.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+import traceback
+from collections import deque
+
+FLUSH_INTERVAL = 0.5 # seconds between writes of the background thread
+QUEUE_SIZE = 10000 # pending entries at which the logging process writes them
+WRITE_SIZE = 65536 # maximum bytes written at once
+
+_SEGMENT_NAME = re.compile(r'^(\d{8})\.jsonl$')
+
+_WRITER = None # SegmentWriter of the current process
+
+_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+class SegmentWriter:
+    """ Queue of log entries of the current process, written to the segment
+        files by a background thread
+    """
+    def __init__(self, folder):
+        """ Initialize; the thread is started with the first entry """
+        self.pid = os.getpid()
+        self.folder = folder
+        self.pending = deque() # appends and pops are thread-safe
+        self.wakeup = threading.Event()
+        self.stop = threading.Event()
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def put(self, entry):
+        """ Queue the given entry (a dict) for writing. Only if the queue is
+            full, or the writer has been closed, does the entry get written
+            right away
+        """
+        self.pending.append(entry)
+        if self.closed:
+            self.flush()
+            return
+        if not self.wakeup.is_set():
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name="LPBS log")
+                self.thread.daemon = True
+                self.thread.start()
+            self.wakeup.set()
+        if len(self.pending) >= QUEUE_SIZE:
+            self.flush()
+
+    def _run(self):
+        """ Write the queued entries, collecting the entries for
+            FLUSH_INTERVAL seconds after the first one arrives, until the
+            writer is closed
+        """
+        interval = FLUSH_INTERVAL
+        while not self.stop.is_set():
+            self.wakeup.wait()
+            self.stop.wait(interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """ Stop the background thread, and write all queued entries """
+        self.closed = True
+        self.stop.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def flush(self):
+        """ Write all queued entries """
+        with self.write_lock:
+            entries = []
+            try:
+                while True:
+                    entries.append(self.pending.popleft())
+            except IndexError:
+                pass
+            if len(entries) > 0:
+                self._write(entries)
+
+    def _write(self, entries):
+        """ Append the given entries to the segments of their days """
+        segments = {} # segment file => list of lines
+        for entry in entries:
+            segment = time.strftime('%Y%m%d.jsonl',
+                                    time.localtime(entry['time']))
+            try:
+                line = _ENCODER.encode(entry)
+            except (TypeError, ValueError), error:
+                line = _ENCODER.encode({'time': entry['time'], 'pid': self.pid,
+                                   'level': 'ERROR', 'msg': "Cannot encode "
+                                   "log entry: %s" % error})
+            segments.setdefault(segment, []).append(line + "\n")
+        try:
+            if not os.path.isdir(self.folder):
+                try:
+                    os.makedirs(self.folder)
+                except OSError:
+                    if not os.path.isdir(self.folder):
+                        raise
+            for segment in sorted(segments.keys()):
+                fd = os.open(os.path.join(self.folder, segment),
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    data = []
+                    size = 0
+                    for line in segments[segment]:
+                        if size + len(line) > WRITE_SIZE and size > 0:
+                            os.write(fd, "".join(data))
+                            data = []
+                            size = 0
+                        data.append(line)
+                        size += len(line)
+                    os.write(fd, "".join(data))
+                finally:
+                    os.close(fd)
+        except (IOError, OSError), error:
+            print >> sys.stderr, "Cannot write to LPBS log: %s" % error
+
+
+def get_writer(folder):
+    """ Return the SegmentWriter of the current process for the given folder.
+        The writer (and its thread) is never shared across a fork: the entries
+        that were pending at the fork are written by the parent
+    """
+    global _WRITER
+    if _WRITER is None or _WRITER.pid != os.getpid() \
+    or _WRITER.folder != folder:
+        if _WRITER is not None and _WRITER.pid == os.getpid():
+            _WRITER.flush()
+        _WRITER = SegmentWriter(folder)
+    return _WRITER
+
+
+def flush_log():
+    """ Write all pending log entries of the current process, and stop its
+        background thread; entries logged afterwards are written right away.
+        This must be called before leaving a process through os._exit; it is
+        called automatically at normal interpreter exit, before the module is
+        torn down.
+    """
+    if _WRITER is not None and _WRITER.pid == os.getpid():
+        _WRITER.close()
+
+atexit.register(flush_log)
+
+
+class SegmentHandler(logging.Handler):
+    """ Logging handler that queues records for the segment files in the given
+        folder
+    """
+    def __init__(self, folder, prog=None):
+        logging.Handler.__init__(self)
+        self.folder = folder
+        if prog is None:
+            prog = os.path.basename(sys.argv[0])
+        self.prog = prog
+
+    def emit(self, record):
+        """ Queue the record """
+        try:
+            entry = {'time': record.created, 'pid': record.process,
+                     'prog': self.prog, 'level': record.levelname,
+                     'func': record.funcName, 'msg': record.getMessage()}
+            if record.exc_info:
+                entry['exc'] = "".join(
+                               traceback.format_exception(*record.exc_info))
+            get_writer(self.folder).put(entry)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """ Write all pending entries """
+        flush_log()
+
+
+def log_folder(config):
+    """ Return the absolute path of the folder with the log segments, or None
+        if the plain text logfile is used
+    """
+    folder = config.get('LPBS', 'log_folder').strip()
+    if folder == '':
+        return None
+    return os.path.join(os.environ['LPBS_HOME'], folder)
+
+
+def setup_logging(config, debug=False):
+    """ Set up logging for the current process according to the config: at
+        the INFO level, or at the DEBUG level if debug is True
+    """
+    level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+    folder = log_folder(config)
+    if folder is None:
+        logfile = os.path.join(os.environ['LPBS_HOME'],
+                               config.get('LPBS', 'logfile'))
+        if debug:
+            logging.basicConfig(filename=logfile,
+            format='%(asctime)s %(funcName)s-%(levelname)s: %(message)s',
+            datefmt='%m/%d/%Y %H:%M:%S %z', level=level)
+        else:
+            logging.basicConfig(filename=logfile,
+            format='%(asctime)s: %(message)s',
+            datefmt='%m/%d/%Y %H:%M:%S %z', level=level)
+        return
+    root = logging.getLogger()
+    if len(root.handlers) == 0:
+        root.addHandler(SegmentHandler(folder))
+    root.setLevel(level)
+
+
+def segment_days(folder):
+    """ Return a sorted list of the days (as strings YYYYMMDD) for which there
+        are segments in the given folder
+    """
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    days = []
+    for name in names:
+        match = _SEGMENT_NAME.match(name)
+        if match:
+            days.append(match.group(1))
+    return sorted(days)
+
+
+def read_entries(folder, begin=None, end=None):
+    """ Return a list of all log entries (dicts) in the segments in the given
+        folder, sorted by time, optionally only those at or after the begin
+        and before the end time (in seconds since the epoch). Only the
+        segments of the days in that range are read.
+    """
+    first_day = last_day = None
+    if begin is not None:
+        first_day = time.strftime('%Y%m%d', time.localtime(begin))
+    if end is not None:
+        last_day = time.strftime('%Y%m%d', time.localtime(end))
+    entries = []
+    for day in segment_days(folder):
+        if first_day is not None and day < first_day:
+            continue
+        if last_day is not None and day > last_day:
+            continue
+        segment_entries = []
+        try:
+            segment_fh = open(os.path.join(folder, "%s.jsonl" % day))
+        except IOError, error:
+            print >> sys.stderr, "Cannot read log segment: %s" % error
+            continue
+        try:
+            for line in segment_fh:
+                try:
+                    entry = json.loads(line)
+                    entry_time = entry['time']
+                except (ValueError, KeyError, TypeError):
+                    continue # e.g. a line being written
+                if begin is not None and entry_time < begin:
+                    continue
+                if end is not None and entry_time >= end:
+                    continue
+                segment_entries.append(entry)
+        finally:
+            segment_fh.close()
+        # the segments of different days do not overlap
+        segment_entries.sort(key=lambda entry: entry['time'])
+        entries.extend(segment_entries)
+    return entries
+
+
+def format_entry(entry):
+    """ Return the given log entry as a line of text (without newline) """
+    line = "%s %s[%s] %s: %s" % (time.strftime('%m/%d/%Y %H:%M:%S',
+           time.localtime(entry['time'])), entry.get('prog', ''),
+           entry.get('pid', ''), entry.get('level', ''), entry.get('msg', ''))
+    if entry.has_key('exc'):
+        line += "\n" + entry['exc'].rstrip('\n')
+    return line
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Follow the output files of running jobs
+
+    New output is detected through inotify (Linux), and by polling the files
+    at a fixed interval where inotify is not available. Output files are never
+    read from the start: only their last lines, and whatever is appended to
+    them afterwards.
+"""
+
+import os
+import sys
+import errno
+import select
+import struct
+import logging
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie, length of name (followed by the name)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+BLOCK_SIZE = 65536 # bytes read at once from an output file
+POLL_INTERVAL = 1.0 # seconds between checks without inotify, and for job ends
+
+
+class Inotify:
+    """ Minimal inotify interface, through ctypes """
+    def __init__(self):
+        """ Create a new inotify instance. Raise an OSError if inotify is not
+            available
+        """
+        try:
+            import ctypes
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        except (ImportError, AttributeError), error:
+            raise OSError(errno.ENOSYS, "inotify not available: %s" % error)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._ctypes = ctypes
+
+    def fileno(self):
+        """ Return the file descriptor of the inotify instance """
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """ Watch the given path for the given events, return the watch
+            descriptor. Raise an OSError on failure
+        """
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        """ Return a list of tuples (wd, mask) for all pending events. Blocks
+            if there are no events
+        """
+        data = os.read(self.fd, BLOCK_SIZE)
+        events = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            (wd, mask, cookie, length) \
+            = INOTIFY_EVENT.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += INOTIFY_EVENT.size + length
+        return events
+
+    def close(self):
+        """ Close the inotify instance """
+        os.close(self.fd)
+
+
+def tail_offset(fh, lines):
+    """ Return the offset in the given file at which its last lines begin,
+        reading the file backwards from its end
+    """
+    fh.seek(0, os.SEEK_END)
+    end = fh.tell()
+    if lines <= 0:
+        return end
+    position = end
+    newlines = 0
+    # a newline at the very end does not start another line
+    skip_last = True
+    while position > 0:
+        size = min(BLOCK_SIZE, position)
+        position -= size
+        fh.seek(position)
+        block = fh.read(size)
+        index = len(block)
+        if skip_last:
+            if block.endswith('\n'):
+                index -= 1
+            skip_last = False
+        while True:
+            index = block.rfind('\n', 0, index)
+            if index < 0:
+                break
+            newlines += 1
+            if newlines == lines:
+                return position + index + 1
+    return 0
+
+
+class FollowedFile:
+    """ An output file, of which new data is written with a prefix on every
+        line
+    """
+    def __init__(self, path, prefix=''):
+        """ Open the file at the given path. Raise an IOError if the file
+            cannot be opened
+        """
+        self.path = path
+        self.prefix = prefix
+        self.fh = open(path, 'rb')
+        self.offset = 0
+        self.at_line_start = True
+
+    def skip_to_tail(self, lines):
+        """ Skip everything but the given number of lines at the end of the
+            file
+        """
+        self.offset = tail_offset(self.fh, lines)
+
+    def copy_new_data(self, out):
+        """ Write all data appended to the file since the last call to the
+            stream out. Return the number of bytes written
+        """
+        size = os.fstat(self.fh.fileno()).st_size
+        if size < self.offset:
+            out.write("%s[truncated]\n" % self.prefix)
+            self.offset = 0
+            self.at_line_start = True
+        copied = 0
+        self.fh.seek(self.offset)
+        while True:
+            data = self.fh.read(BLOCK_SIZE)
+            if not data:
+                break
+            self.offset += len(data)
+            copied += len(data)
+            if self.prefix:
+                lines = data.split('\n')
+                for (i, line) in enumerate(lines):
+                    if i > 0:
+                        out.write('\n')
+                        self.at_line_start = True
+                    if line:
+                        if self.at_line_start:
+                            out.write(self.prefix)
+                        out.write(line)
+                        self.at_line_start = False
+            else:
+                out.write(data)
+        return copied
+
+    def close(self, out):
+        """ Close the file, terminating an incomplete last line """
+        if not self.at_line_start:
+            out.write('\n')
+        self.fh.close()
+
+
+def follow_files(files, lines=10, follow=True, is_running=None,
+    out=sys.stdout):
+    """ Write the last lines of every file in the list of tuples
+        (path, prefix) to out, each line with the prefix of its file. If follow
+        is True, keep writing new data as it is appended to the files, until
+        is_running() returns False.
+    """
+    followed = []
+    for (path, prefix) in files:
+        try:
+            followed.append(FollowedFile(path, prefix))
+        except IOError, error:
+            logging.warn("Cannot read %s: %s", path, error)
+    try:
+        for followed_file in followed:
+            followed_file.skip_to_tail(lines)
+            followed_file.copy_new_data(out)
+        out.flush()
+        if not follow or len(followed) == 0:
+            return
+        try:
+            inotify = Inotify()
+        except OSError, error:
+            logging.debug("Polling for output: %s", error)
+            inotify = None
+        watches = {} # wd => FollowedFile
+        if inotify is not None:
+            for followed_file in followed:
+                try:
+                    wd = inotify.add_watch(followed_file.path, IN_MODIFY
+                         | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+                    watches[wd] = followed_file
+                except OSError, error:
+                    logging.debug("Cannot watch %s: %s", followed_file.path,
+                                  error)
+        last_check = time.time()
+        while True:
+            changed = followed
+            if inotify is not None and len(watches) == len(followed):
+                try:
+                    ready = select.select([inotify], [], [], POLL_INTERVAL)[0]
+                except select.error, error:
+                    if error.args[0] != errno.EINTR:
+                        raise
+                    ready = []
+                changed = []
+                if ready:
+                    for (wd, mask) in inotify.read_events():
+                        if watches.has_key(wd) \
+                        and not watches[wd] in changed:
+                            changed.append(watches[wd])
+            else:
+                time.sleep(POLL_INTERVAL)
+            for followed_file in changed:
+                followed_file.copy_new_data(out)
+            out.flush()
+            if time.time() - last_check >= POLL_INTERVAL:
+                last_check = time.time()
+                if is_running is not None and not is_running():
+                    # pick up whatever was written before the job ended
+                    for followed_file in followed:
+                        followed_file.copy_new_data(out)
+                    break
+        if inotify is not None:
+            inotify.close()
+    finally:
+        for followed_file in followed:
+            followed_file.close(out)
+        out.flush()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Indexed registry of all active jobs, stored in $LPBS_HOME/jobs.db
+
+    The registry mirrors the information in the lock files in a single SQLite
+    database, indexed by job ID and sequence number. This allows lqstat, lqdel
+    and friends to look up jobs without opening every lock file in $LPBS_HOME.
+    The database also holds the exit status of recently finished jobs, and
+    the dependencies between jobs (see LPBS.Dependencies).
+"""
+
+import os
+import logging
+import sqlite3
+import cPickle as pickle
+from glob import glob
+
+REGISTRY_FILE = 'jobs.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id   TEXT PRIMARY KEY,
+    seq      INTEGER NOT NULL,
+    owner    TEXT,
+    pid      INTEGER,
+    status   TEXT,
+    lockfile TEXT,
+    info     BLOB,
+    cores    INTEGER DEFAULT 1,
+    mem      INTEGER DEFAULT 0,
+    spec     BLOB,
+    pid_start INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_seq ON jobs (seq);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner);
+CREATE TABLE IF NOT EXISTS exits (
+    job_id   TEXT PRIMARY KEY,
+    seq      INTEGER NOT NULL,
+    retcode  INTEGER,
+    time     REAL
+);
+CREATE INDEX IF NOT EXISTS exits_seq ON exits (seq);
+CREATE TABLE IF NOT EXISTS depends (
+    job_id    TEXT NOT NULL,
+    parent_id TEXT NOT NULL,
+    type      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS depends_job ON depends (job_id);
+CREATE INDEX IF NOT EXISTS depends_parent ON depends (parent_id);
+"""
+
+# Columns that were added to the jobs table after its first version. They are
+# added to existing registries when they are opened.
+_ADDED_COLUMNS = [
+    ('cores', 'INTEGER DEFAULT 1'),
+    ('mem', 'INTEGER DEFAULT 0'),
+    ('spec', 'BLOB'),
+    ('pid_start', 'INTEGER'),
+]
+
+# Order by sequence number; job arrays come before their tasks, and tasks are
+# sorted numerically by their index
+_ORDER = "ORDER BY seq, length(job_id), job_id"
+
+_REGISTRY = None # JobRegistry instance of the current process
+
+# Registries inherited from the parent process after a fork. A connection must
+# never be closed in a child: SQLite would drop the parent's locks. Processes
+# that fork should call close_registry() first, as SQLite connections must not
+# be carried across a fork at all.
+_INHERITED_REGISTRIES = []
+
+
+def sequence_number(job_id):
+    """ Return the integer sequence number for the given job ID, e.g. 12 for
+        '12.localhost.local' or '12[3].localhost.local'. Return None if the
+        job ID does not start with a sequence number.
+    """
+    seq = job_id.split('.', 1)[0].split('[', 1)[0]
+    try:
+        return int(seq)
+    except ValueError:
+        return None
+
+
+def get_registry():
+    """ Return the JobRegistry for $LPBS_HOME. The connection to the database
+        is shared within a process, but never across a fork
+    """
+    global _REGISTRY
+    if _REGISTRY is None or _REGISTRY.pid != os.getpid():
+        if _REGISTRY is not None:
+            _INHERITED_REGISTRIES.append(_REGISTRY)
+        _REGISTRY = JobRegistry(os.environ['LPBS_HOME'])
+    return _REGISTRY
+
+
+def close_registry():
+    """ Close the connection to the registry of the current process, if any.
+        This must be called before forking.
+    """
+    global _REGISTRY
+    if _REGISTRY is not None and _REGISTRY.pid == os.getpid():
+        _REGISTRY.connection.close()
+        _REGISTRY = None
+
+
+class JobRegistry:
+    """ SQLite-backed index of all jobs that currently hold a lock """
+    def __init__(self, lpbs_home):
+        """ Open (and if necessary, create) the registry in lpbs_home. When the
+            registry is created, any existing lock files are imported.
+        """
+        self.pid = os.getpid()
+        self.lpbs_home = lpbs_home
+        self.dbfile = os.path.join(lpbs_home, REGISTRY_FILE)
+        is_new = not os.path.isfile(self.dbfile)
+        self.connection = sqlite3.connect(self.dbfile, timeout=60)
+        self.connection.text_factory = str
+        try:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError, error:
+            logging.debug("Cannot switch registry to WAL mode: %s", error)
+        self.connection.executescript(_SCHEMA)
+        self._upgrade_schema()
+        if is_new:
+            self.import_lock_files()
+
+    def _upgrade_schema(self):
+        """ Add any missing columns to a registry created by an earlier
+            version of LPBS
+        """
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(jobs)")]
+        for (column, definition) in _ADDED_COLUMNS:
+            if not column in columns:
+                logging.debug("Adding column %s to registry", column)
+                try:
+                    with self.connection:
+                        self.connection.execute(
+                        "ALTER TABLE jobs ADD COLUMN %s %s"
+                        % (column, definition))
+                except sqlite3.OperationalError, error:
+                    # a concurrent process may have added it already
+                    logging.debug("Cannot add column %s: %s", column, error)
+
+    def add(self, job_info, spec=None):
+        """ Insert job_info into the registry, replacing any earlier entry
+            for the same job ID. For queued jobs, spec holds all the data that
+            is necessary to start the job later on.
+        """
+        with self.connection:
+            self.insert(job_info, spec)
+
+    def insert(self, job_info, spec=None):
+        """ Like add, but as part of the transaction of the caller """
+        if spec is not None:
+            spec = sqlite3.Binary(pickle.dumps(spec, pickle.HIGHEST_PROTOCOL))
+        self.connection.execute(
+        "INSERT OR REPLACE INTO jobs "
+        "(job_id, seq, owner, pid, pid_start, status, lockfile, info, cores, "
+        "mem, spec) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_info.job_id, sequence_number(job_info.job_id),
+         job_info.owner, job_info.pid, job_info.pid_start, job_info.status,
+         job_info.lockfile,
+         sqlite3.Binary(job_info.encode()),
+         getattr(job_info, 'req_cores', 1),
+         getattr(job_info, 'req_mem', 0), spec))
+
+    def remove(self, job_id, status=None):
+        """ Remove the job with the given ID from the registry. If status is
+            given, the job is only removed if it has that status. Return True
+            if the job was removed, False otherwise.
+        """
+        with self.connection:
+            if status is None:
+                cursor = self.connection.execute(
+                         "DELETE FROM jobs WHERE job_id = ?", (job_id, ))
+            else:
+                cursor = self.connection.execute(
+                         "DELETE FROM jobs WHERE job_id = ? AND status = ?",
+                         (job_id, status))
+        return (cursor.rowcount > 0)
+
+    def remove_unfinished(self, job_id):
+        """ Remove the job with the given ID from the registry, unless an exit
+            status has been recorded for it (the process supervising the job
+            records it right before removing the job itself). Return True if
+            the job was removed, False otherwise.
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                     "DELETE FROM jobs WHERE job_id = ? AND NOT EXISTS "
+                     "(SELECT 1 FROM exits WHERE exits.job_id = jobs.job_id)",
+                     (job_id, ))
+        return (cursor.rowcount > 0)
+
+    def _where(self, job_id=None, owner=None, status=None):
+        """ Return tuple (sql, params) for a WHERE clause selecting all jobs
+            matching the given job identifier, owner, and status. A job
+            identifier that is a pure sequence number selects on the sequence
+            number, anything else is a prefix of the full job ID.
+        """
+        clauses = []
+        params = []
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        if job_id is not None:
+            if job_id.isdigit():
+                clauses.append("seq = ?")
+                params.append(int(job_id))
+            else:
+                # prefix match as a range on the primary key, using the index
+                clauses.append("job_id >= ? AND job_id < ?")
+                params.append(job_id)
+                params.append(job_id[:-1] + chr(ord(job_id[-1]) + 1))
+        if owner is not None:
+            clauses.append("owner = ?")
+            params.append(owner)
+        if len(clauses) == 0:
+            return ("", ())
+        return (" WHERE " + " AND ".join(clauses), tuple(params))
+
+    def lookup(self, job_id=None, owner=None, status=None):
+        """ Return a list of tuples (job_id, pid) for all jobs matching the
+            given job identifier, owner, and status, ordered by sequence
+            number. For job arrays, the array itself comes before its tasks.
+        """
+        where, params = self._where(job_id, owner, status)
+        return self.connection.execute(
+               "SELECT job_id, pid FROM jobs%s %s" % (where, _ORDER),
+               params).fetchall()
+
+    def lookup_owners(self, job_id=None, owner=None, status=None):
+        """ Return a list of tuples (job_id, owner) for all jobs matching the
+            given job identifier, owner, and status, in the same order as
+            lookup
+        """
+        where, params = self._where(job_id, owner, status)
+        return self.connection.execute(
+               "SELECT job_id, owner FROM jobs%s %s" % (where, _ORDER),
+               params).fetchall()
+
+    def running(self):
+        """ Return a list of tuples (job_id, pid, pid_start) for all jobs that
+            have a process, with pid_start the start time of the process as
+            stored by JobInfo.set_lock (None for jobs registered by earlier
+            versions of LPBS)
+        """
+        return self.connection.execute(
+               "SELECT job_id, pid, pid_start FROM jobs WHERE pid IS NOT NULL "
+               "%s" % _ORDER).fetchall()
+
+    def job(self, job_id):
+        """ Return the JobInfo instance stored for the job with the given job
+            ID, or None if there is no such job
+        """
+        from LPBS.JobUtils import decode_job_info
+        row = self.connection.execute("SELECT info FROM jobs WHERE job_id = ?",
+                                      (job_id, )).fetchone()
+        if row is None:
+            return None
+        try:
+            return decode_job_info(str(row[0]))
+        except ValueError, error:
+            logging.warn("Corrupt registry entry: %s", error)
+            return None
+
+    def jobs(self, job_id=None, owner=None):
+        """ Return a list of JobInfo instances, as they were stored in the
+            registry, for all jobs matching the given job identifier and owner
+        """
+        from LPBS.JobUtils import decode_job_info
+        where, params = self._where(job_id, owner)
+        result = []
+        for (info, ) in self.connection.execute(
+        "SELECT info FROM jobs%s %s" % (where, _ORDER), params):
+            try:
+                result.append(decode_job_info(str(info)))
+            except ValueError, error:
+                logging.warn("Corrupt registry entry: %s", error)
+        return result
+
+    def import_lock_files(self):
+        """ Add the information from all lock files in $LPBS_HOME to the
+            registry
+        """
+        from LPBS.JobUtils import decode_job_info
+        for lock_file in glob(os.path.join(self.lpbs_home, '*.lock')):
+            try:
+                lock = open(lock_file, 'r')
+                try:
+                    job_info = decode_job_info(lock.read())
+                finally:
+                    lock.close()
+            except (IOError, ValueError), error:
+                logging.warn("Cannot import lock file %s: %s", lock_file,
+                             error)
+                continue
+            job_info.job_id = os.path.splitext(os.path.basename(lock_file))[0]
+            job_info.lockfile = lock_file
+            logging.debug("Importing lock %s into registry", lock_file)
+            self.add(job_info)
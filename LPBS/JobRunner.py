@@ -0,0 +1,867 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Run jobs, either from a supervising process per job (lqsub) or from the
+    event loop of lpbsd
+"""
+
+import os
+import sys
+import subprocess
+import logging
+import signal
+import getpass
+import time
+from LPBS.JobUtils import get_new_job_id, JobInfo, array_job_id, \
+                          parse_array_request, get_cpu_mem_info_for_pids, \
+                          format_bytes, parse_extra_attributes
+from LPBS.ResourceLog import ResourceLog, resource_log_file, \
+                             sampling_interval, sample_capacity
+from LPBS.JobRegistry import sequence_number, close_registry
+from LPBS.Config import full_expand
+from LPBS.PBSFile import PBSScript
+from LPBS.Staging import StageStore, STORE_DIR, parse_stage_list, stage_in, \
+                         stage_out, link_or_copy
+from LPBS.Scratch import discard_scratch
+from LPBS.Dependencies import record_exit, hold_job, parse_depend, \
+                              EXIT_FAILED, EXIT_DELETED
+from LPBS.EventLog import flush_log
+from LPBS.Profiling import PhaseTimer, format_phases
+from LPBS.Accounting import account_queued, account_started, account_ended, \
+                            write_record, deleted_record
+from LPBS.Scheduler import scheduler_enabled, resource_request, get_pool, \
+                           queue_job, claim_jobs
+from LPBS.Notifications import Notifier, COND_STRT, COND_STOP, COND_ABRT, \
+                               COND_ABER, flush_notifications
+
+
+class SignalExc(Exception):
+    """ Exception to be raised when a signal is received """
+    def __init__(self, value):
+        """ Initialize for signal number given as 'value' """
+        self.value = value
+    def __str__(self):
+        """ Retrun signal number as string """
+        return repr(self.value)
+
+
+def psutil_killtree(pid):
+    """ Use psutil to kill a process tree from the bottom up. Return True on
+        success, False on error (i.e. psutil not available)
+    """
+    try:
+        import psutil
+        try:
+            process = psutil.Process(pid)
+            children = process.get_children()
+            if len(children) == 0:
+                process.kill()
+            else:
+                for child in children:
+                    psutil_killtree(child.pid)
+        except psutil.NoSuchProcess:
+            pass
+        return True
+    except ImportError:
+        return False
+
+
+def signal_handler(sig, stack):
+    """ Raise SignalExc """
+    logging.debug("signal handler for sig %s", sig)
+    raise SignalExc(sig)
+
+
+def array_slots(array_request):
+    """ Return the maximum number of tasks of the job array with the given
+        array_request that may run at the same time
+    """
+    indices, slot_limit = parse_array_request(array_request)
+    if slot_limit is None:
+        return len(indices)
+    return min(slot_limit, len(indices))
+
+
+def set_resource_request(job_info, options, slots=1):
+    """ Store the resources requested in options.resource_list in job_info.
+        The number of requested cores and memory is multiplied by slots.
+    """
+    try:
+        resources, cores, mem = resource_request(options.resource_list)
+    except ValueError, error:
+        logging.warn("Invalid resource request: %s", error)
+        resources, cores, mem = ({}, 1, 0)
+    job_info.resource_list = resources
+    job_info.req_cores = cores * slots
+    job_info.req_mem = mem * slots
+
+
+def new_job_id(options):
+    """ Return a new job ID for a job submitted with the given options. For
+        job arrays, this is the ID of the array. Raise a ValueError if no valid
+        job ID can be assigned.
+    """
+    if options.array_request is not None:
+        if options.interactive:
+            raise ValueError("Job arrays cannot be interactive")
+        try:
+            parse_array_request(options.array_request)
+        except ValueError, error:
+            raise ValueError("Invalid array request '%s': %s"
+                             % (options.array_request, error))
+    job_id = get_new_job_id(options)
+    logging.debug("assigning Job ID %s", job_id)
+    if job_id is None:
+        raise ValueError("Could not get new job ID")
+    if options.array_request is not None:
+        job_id = array_job_id(job_id)
+    return job_id
+
+
+class Job:
+    """ A single job, or a single task of a job array, from the preparation of
+        its environment until its end. The job is started without waiting for
+        it to finish. The environ and cwd of the submission default to those of
+        the current process.
+    """
+    def __init__(self, pbs_script, job_id, options, array_index=None,
+    environ=None, cwd=None):
+        """ Initialize """
+        logging.debug("Preparing for run of PBS script %s (Job ID %s)",
+                      pbs_script, job_id)
+        self.pbs_script = pbs_script
+        self.job_id = job_id
+        self.options = options
+        self.array_index = array_index
+        if environ is None:
+            environ = os.environ
+        self.environ = environ
+        if cwd is None:
+            cwd = os.getcwd()
+        self.cwd = cwd
+        self.notifier = Notifier(job_id, options)
+        self.job_info = JobInfo(job_id)
+        self.process = None
+        self.resource_log = None
+        self.job_scratch = ''
+        self.stage_store = None
+        self.stagein = [] # tuples (local_file, remote_file)
+        self.stageout = []
+        self.script_copy = script_copy_file(job_id)
+        self.pbs_env = {}
+        self.init_dir = None
+        self.cmd_list = []
+        self.stdin_fh = None
+        self.stdout_fh = None
+        self.stderr_fh = None
+
+    def prepare(self):
+        """ Create the scratch folder, set up the environment, and open the
+            files for the job's standard streams. Return True on success, False
+            if the job cannot run. May raise an OSError or IOError
+        """
+        options = self.options
+        job_id = self.job_id
+        array_index = self.array_index
+        job_info = self.job_info
+        job_name = os.path.basename(self.pbs_script)
+        output_suffix = str(sequence_number(job_id))
+        if array_index is not None:
+            output_suffix += "-%s" % array_index
+
+        # create the scratch folder
+        scratch_root = options.config.get('Scratch', 'scratch_root')
+        scratch_root = os.path.join(os.environ['LPBS_HOME'],
+                                    full_expand(scratch_root))
+        if os.path.isdir(scratch_root):
+            if not os.access(scratch_root, os.W_OK):
+                print >> sys.stderr, "WARNING: Scratch root %s not writable" \
+                            % scratch_root
+                logging.warn("Scratch root %s not writable", scratch_root)
+        else:
+            print >> sys.stderr, "WARNING: Scratch root %s does not exist" \
+                        % scratch_root
+            logging.warn("Scratch root %s does not exist", scratch_root)
+        if (options.config.getboolean('Scratch', 'create_jobid_folder')):
+            self.job_scratch = os.path.join(scratch_root, job_id)
+            try:
+                if not os.path.isdir(self.job_scratch):
+                    os.makedirs(self.job_scratch)
+            except OSError, error:
+                print >> sys.stderr, "Could not create scratch folder: %s" \
+                         % error
+                return False
+
+        # files to stage in and out
+        local_root = self.job_scratch
+        if local_root == '':
+            local_root = scratch_root
+        try:
+            attributes = parse_extra_attributes(options.extra_attributes)
+            self.stagein = parse_stage_list(attributes.get('stagein', ''),
+                                            local_root, self.environ['HOME'])
+            self.stageout = parse_stage_list(attributes.get('stageout', ''),
+                                             local_root, self.environ['HOME'])
+        except ValueError, error:
+            print >> sys.stderr, "Invalid option -W: %s" % error
+            return False
+        if len(self.stagein) > 0 and options.config.getboolean('Scratch',
+        'stage_store'):
+            try:
+                self.stage_store = StageStore(os.path.join(scratch_root,
+                                                           STORE_DIR))
+            except OSError, error:
+                logging.warn("Cannot use stage store: %s", error)
+
+        # set environment
+        if options.job_name is not None:
+            job_name = options.job_name
+        job_info.name = job_name
+        if array_index is not None:
+            job_info.name = "%s-%s" % (job_name, array_index)
+        if options.queue is not None:
+            job_info.queue = options.queue
+        pbs_env = {}
+        if options.copy_environment:
+            pbs_env = dict(self.environ)
+        if options.extra_env_vars is not None:
+            for var_value in options.extra_env_vars.split(","):
+                try:
+                    var, value = var_value.split("=", 1)
+                    var = var.strip()
+                    value = value.strip()
+                except ValueError:
+                    var = var_value.strip()
+                    value = ''
+                    if self.environ.has_key(var):
+                        value = self.environ[var]
+                pbs_env[var] = value
+        # Copy the standard "login" variables into the environment
+        for env_var in ['HOME', 'LOGNAME', 'USER', 'SHELL', 'TERM', 'MAIL']:
+            if self.environ.has_key(env_var):
+                pbs_env[env_var] = self.environ[env_var]
+        for env_var in ['HOME', 'LANG', 'LOGNAME', 'PATH', 'MAIL', 'SHELL',
+        'TZ']:
+            if self.environ.has_key(env_var):
+                pbs_env["PBS_O_%s" % env_var] = self.environ[env_var]
+        pbs_env['PBS_O_HOST'] = options.config.get('Node','hostname') + "." \
+                                + options.config.get('Node','domain')
+        pbs_env['PBS_SERVER'] = options.config.get('Server','hostname') + "." \
+                                + options.config.get('Server','domain')
+        pbs_env['PBS_O_QUEUE'] = ''
+        pbs_env['PBS_O_WORKDIR'] = self.cwd
+        pbs_env['PBS_ENVIRONMENT'] = 'PBS_BATCH'
+        pbs_env['PBS_JOBID'] = job_id
+        pbs_env['PBS_JOBNAME'] = job_name
+        pbs_env['PBS_NODEFILE'] = os.path.join(os.environ['LPBS_HOME'],
+                                               'nodefile')
+        pbs_env['PBS_QUEUE'] = ''
+        if array_index is not None:
+            pbs_env['PBS_ARRAYID'] = str(array_index)
+        job_info.variable_list = "%s" % pbs_env
+        nodefile_fh = open(pbs_env['PBS_NODEFILE'], 'w')
+        nodefile_fh.write(pbs_env['PBS_O_HOST']+"\n")
+        nodefile_fh.close()
+        job_info.server = pbs_env['PBS_SERVER']
+        job_info.exec_host = pbs_env['PBS_O_HOST']
+
+        job_info.mail_points = options.mail_options
+        if array_index is None:
+            set_resource_request(job_info, options)
+        else:
+            # the resources of array tasks are accounted for by the array
+            set_resource_request(job_info, options, slots=0)
+
+        # open files for I/O
+        job_info.join_path = False
+        job_info.output_path = 'STDOUT'
+        job_info.error_path = 'STDERR'
+        if not options.interactive:
+            stdout_file = "%s.o%s" % (job_name, output_suffix)
+            stderr_file = "%s.e%s" % (job_name, output_suffix)
+            self.stdin_fh = open(os.devnull)
+            if options.stdout_file is not None:
+                stdout_file = options.stdout_file
+                if array_index is not None:
+                    stdout_file += "-%s" % array_index
+                job_info.output_path = stdout_file
+            if options.stderr_file is not None:
+                stderr_file = options.stderr_file
+                if array_index is not None:
+                    stderr_file += "-%s" % array_index
+                job_info.error_path = stderr_file
+            stdout_file = os.path.join(self.cwd, stdout_file)
+            stderr_file = os.path.join(self.cwd, stderr_file)
+            if options.oe_join == 'oe':
+                job_info.join_path = True
+                self.stdout_fh = open(stdout_file, 'w')
+                self.stderr_fh = self.stdout_fh
+                job_info.stdout_file = stdout_file
+            elif options.oe_join == 'eo':
+                job_info.join_path = True
+                self.stderr_fh = open(stderr_file, 'w')
+                self.stdout_fh = self.stderr_fh
+                job_info.stderr_file = stderr_file
+            else:
+                self.stdout_fh = open(stdout_file, 'w')
+                self.stderr_fh = open(stderr_file, 'w')
+                job_info.stdout_file = stdout_file
+                job_info.stderr_file = stderr_file
+
+        if options.chroot is not None:
+            pbs_env['PBS_O_ROOTDIR'] = options.chroot
+        self.init_dir = self.environ['HOME']
+        if options.init_dir is not None:
+            self.init_dir = options.init_dir
+            pbs_env['PBS_O_INITDIR'] = self.init_dir
+        self.cmd_list = []
+        if options.shell is not None:
+            shell = options.shell
+            if "," in shell:
+                shell = shell.split(",")[0]
+            if "@" in shell:
+                shell = shell.split("@")[0]
+            shell = shell.strip()
+            self.cmd_list.append(shell)
+        else:
+            self.cmd_list.append(self.environ['SHELL'])
+        self.cmd_list.append('-l')
+        self.cmd_list.append('-c')
+        self.cmd_list.append(self.script_copy)
+        self.pbs_env = pbs_env
+
+        if len(self.stagein) > 0:
+            logging.info("Staging in %i files for job %s", len(self.stagein),
+                         job_id)
+            stage_in(self.stagein, self.stage_store,
+                     stage_threads(options.config))
+        return True
+
+    def redirect_io(self):
+        """ Connect the standard streams of the current process to those of the
+            job
+        """
+        os.dup2(self.stdin_fh.fileno(), sys.stdin.fileno())
+        os.dup2(self.stdout_fh.fileno(), sys.stdout.fileno())
+        os.dup2(self.stderr_fh.fileno(), sys.stderr.fileno())
+
+    def start(self, lock_pid=None, new_session=False):
+        """ Start the job, without waiting for it to finish. The lock for the
+            job is set for lock_pid, or for the PID of the job's process if
+            lock_pid is None. If new_session is True, the job is started in its
+            own session (and process group)
+        """
+        job_info = self.job_info
+        job_info.owner = getpass.getuser()
+        job_info.start_time = time.time()
+        if lock_pid is not None:
+            job_info.set_lock(lock_pid)
+        if self.pbs_script != self.script_copy:
+            if is_script_copy(self.pbs_script):
+                # the copy for a job array, which is never modified
+                link_or_copy(self.pbs_script, self.script_copy)
+            else:
+                PBSScript(self.pbs_script).write_copy(self.script_copy)
+        os.chmod(self.script_copy, 0o700)
+        chroot = self.options.chroot
+        init_dir = self.init_dir
+        def preexec():
+            """ Prepare the job's process after the fork """
+            if new_session:
+                os.setsid()
+            if chroot is not None:
+                os.chroot(chroot)
+                os.chdir(init_dir)
+        cwd = init_dir
+        if chroot is not None:
+            cwd = None # chdir after chroot
+        if self.options.interactive:
+            self.notifier.notify(COND_STRT)
+            logging.info("Started interactive job %s", self.job_id)
+            self.process = subprocess.Popen(self.cmd_list, env=self.pbs_env,
+                           cwd=cwd, preexec_fn=preexec, close_fds=True)
+        else:
+            self.process = subprocess.Popen(self.cmd_list, env=self.pbs_env,
+                           cwd=cwd, preexec_fn=preexec, close_fds=True,
+                           stdin=self.stdin_fh,
+                           stdout=self.stdout_fh, stderr=self.stderr_fh)
+            # the job has its own copies of the file descriptors
+            for fh in set([self.stdin_fh, self.stdout_fh, self.stderr_fh]):
+                fh.close()
+            self.notifier.notify(COND_STRT)
+            logging.info("Submitted job %s", self.job_id)
+        if lock_pid is None:
+            job_info.set_lock(self.process.pid)
+        account_started(job_info)
+        self.open_resource_log()
+
+    def open_resource_log(self):
+        """ Create the ring file for the resource usage of the job, unless
+            sampling is disabled in the config
+        """
+        config = self.options.config
+        if sampling_interval(config) <= 0:
+            return
+        try:
+            cores = resource_request(self.options.resource_list)[1]
+        except ValueError:
+            cores = 1
+        try:
+            self.resource_log = ResourceLog(resource_log_file(self.job_id),
+                                capacity=sample_capacity(config), cores=cores,
+                                start_time=self.job_info.start_time)
+        except IOError, error:
+            logging.warn("Cannot create resource log for job %s: %s",
+                         self.job_id, error)
+
+    def sample(self, cpu_mem_info=None):
+        """ Add a sample of the resource usage of the running job to its ring
+            file. The cpu_mem_info tuple as returned by get_cpu_mem_info may be
+            given if it has already been collected for the job's process.
+        """
+        if self.resource_log is None or self.process is None:
+            return
+        if self.process.returncode is not None:
+            return
+        if cpu_mem_info is None:
+            cpu_mem_info = get_cpu_mem_info_for_pids(
+                           [self.process.pid])[self.process.pid]
+        (cput, mem, vmem, threads) = cpu_mem_info
+        if mem == 0:
+            return # process is gone
+        try:
+            self.resource_log.add(time.time(), cput, mem, vmem, threads)
+        except IOError, error:
+            logging.warn("Cannot write resource log for job %s: %s",
+                         self.job_id, error)
+            self.resource_log = None
+
+    def close_resource_log(self):
+        """ Record the end of the job in its ring file, and log its total
+            resource usage. Return the summary of the ring file, or None if
+            there is none
+        """
+        if self.resource_log is None:
+            return None
+        summary = None
+        try:
+            self.resource_log.close(end_time=time.time())
+            summary = self.resource_log.summary()
+            if summary['samples'] == 0:
+                logging.info("Resources used by job %s: unknown, the job "
+                             "ended before the first sample", self.job_id)
+            else:
+                logging.info("Resources used by job %s: cput=%is, maxmem=%s, "
+                             "cpu_efficiency=%.0f%%", self.job_id,
+                             summary['cput'], format_bytes(summary['maxmem']),
+                             100 * summary['cpu_efficiency'])
+        except IOError, error:
+            logging.warn("Cannot close resource log for job %s: %s",
+                         self.job_id, error)
+        self.resource_log = None
+        return summary
+
+    def remove_script_copy(self):
+        """ Remove the copy of the script run by the job """
+        try:
+            os.unlink(self.script_copy)
+        except OSError:
+            pass
+
+    def record_exit(self, retcode, summary=None):
+        """ Record the exit status of the job in the accounting log, and for
+            the jobs depending on it (the tasks of job arrays have no exit
+            status of their own for that purpose). The summary of the job's
+            ring file may be given for the resources used
+        """
+        account_ended(self.job_info, retcode, summary)
+        if self.array_index is None:
+            record_exit(self.job_id, retcode)
+
+    def finish(self, retcode):
+        """ Clean up after the job has finished with the given exit code """
+        self.record_exit(retcode, self.close_resource_log())
+        self.job_info.release_lock()
+        self.remove_script_copy()
+
+        # notify about end of process
+        self.notifier.job_retcode = retcode
+        self.notifier.notify(COND_STOP)
+        logging.info("Finished job %s with status %s", self.job_id, retcode)
+
+        # stage out files, and remove scratch folder
+        config = self.options.config
+        staged_out = True
+        if len(self.stageout) > 0:
+            logging.info("Staging out %i files for job %s",
+                         len(self.stageout), self.job_id)
+            try:
+                stage_out(self.stageout, stage_threads(config))
+            except (IOError, OSError), error:
+                logging.error("Stage-out failed for job %s: %s", self.job_id,
+                              error)
+                staged_out = False
+        if self.stage_store is not None:
+            self.stage_store.prune(stage_store_ttl(config))
+        if os.path.isdir(self.job_scratch) and staged_out:
+            if not config.getboolean('Scratch', 'keep_scratch'):
+                if ( (retcode == 0) or (config.getboolean('Scratch',
+                'delete_failed_scratch')) ):
+                    discard_scratch(self.job_scratch)
+
+    def fail(self, error):
+        """ Clean up after the job could not be started due to the given
+            error
+        """
+        self.record_exit(EXIT_FAILED)
+        self.job_info.release_lock()
+        self.remove_script_copy()
+        self.notifier.notify(COND_ABER, message="%s"%error)
+        logging.error("Failed to submit job %s: %s", self.job_id, error)
+
+    def kill(self):
+        """ Kill the job's process tree """
+        try:
+            if not psutil_killtree(self.process.pid):
+                # If psutil didn't work, just terminate the subprocess.
+                # This may leave its children running
+                self.process.terminate()
+        except AttributeError:
+            # process wasn't even running
+            pass
+        except OSError, error:
+            logging.debug("Cannot kill job %s: %s", self.job_id, error)
+
+    def cancel(self):
+        """ Clean up after the job was canceled """
+        summary = self.close_resource_log()
+        write_record(*deleted_record(self.job_id, self.job_info.owner))
+        self.record_exit(EXIT_DELETED, summary)
+        self.job_info.release_lock()
+        self.remove_script_copy()
+        if os.path.isdir(self.job_scratch):
+            discard_scratch(self.job_scratch)
+        self.notifier.notify(COND_ABRT)
+        logging.info("Canceled job %s", self.job_id)
+
+
+def script_copy_file(job_id):
+    """ Return the name of the copy of the script that the job with the given
+        job_id runs
+    """
+    return os.path.join(os.environ['LPBS_HOME'], "%s.SC" % job_id)
+
+
+def is_script_copy(pbs_script):
+    """ Return True if pbs_script is a copy of a script made by LPBS """
+    return ( (os.path.dirname(os.path.abspath(pbs_script))
+              == os.path.abspath(os.environ['LPBS_HOME']))
+             and pbs_script.endswith('.SC') )
+
+
+def adopt_script_copy(script_copy, job_id):
+    """ Rename script_copy, the copy of a script written on submission, to
+        the name of the copy for the job with the given job_id. Return the new
+        name
+    """
+    new_name = script_copy_file(job_id)
+    os.rename(script_copy, new_name)
+    return new_name
+
+
+def stage_threads(config):
+    """ Return the number of threads used for staging files """
+    try:
+        return max(1, config.getint('Scratch', 'stage_threads'))
+    except ValueError:
+        logging.warn("Invalid value for stage_threads in section Scratch")
+        return 1
+
+
+def stage_store_ttl(config):
+    """ Return the number of seconds for which unused files are kept in the
+        stage store
+    """
+    try:
+        return config.getfloat('Scratch', 'stage_store_ttl')
+    except ValueError:
+        logging.warn("Invalid value for stage_store_ttl in section Scratch")
+        return 86400
+
+
+def run_pbs_script(pbs_script, job_id, options, array_index=None):
+    """ Run the given pbs_script, and wait for it to finish. If array_index is
+        given, the script is run as the task with that index in a job array.
+        The durations of the phases of the job's startup are recorded in the
+        job info, continuing options.phase_timer if it is set (by lqsub)
+    """
+    retcode = 1
+    if not os.environ.has_key('LPBS_HOME'):
+        return retcode
+    timer = getattr(options, 'phase_timer', None)
+    if timer is None or array_index is not None:
+        timer = PhaseTimer()
+    job = Job(pbs_script, job_id, options, array_index)
+    timer.mark('setup')
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        if not job.prepare():
+            job.remove_script_copy()
+            return 1
+        timer.mark('prepare')
+        if not options.interactive:
+            os.setsid()
+            job.redirect_io()
+        timer.mark('redirect')
+        # stored with the lock, which is set before the job's process starts
+        job.job_info.startup_phases = list(timer.phases)
+        # pass control to shell, wait for completion
+        job.start(lock_pid=os.getpid())
+        timer.mark('start')
+        logging.info("Startup of job %s took %s", job_id,
+                     format_phases(timer.phases))
+        interval = sampling_interval(options.config)
+        if job.resource_log is not None:
+            signal.signal(signal.SIGALRM, lambda sig, stack: job.sample())
+            signal.setitimer(signal.ITIMER_REAL, interval, interval)
+        try:
+            retcode = job.process.wait()
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        job.finish(retcode)
+    except (OSError, IOError), error:
+        job.fail(error)
+    except SignalExc:
+        # Cancel Job
+        logging.debug("SignalExc")
+        job.kill()
+        job.cancel()
+        retcode = 0
+    return retcode
+
+
+def run_job_array(pbs_script, array_id, options):
+    """ Run all tasks of the job array with the given array_id, each in a
+        forked child process, with at most the number of simultaneously running
+        tasks given by the slot limit in options.array_request
+    """
+    logging.debug("Preparing for run of job array %s", array_id)
+    indices, slot_limit = parse_array_request(options.array_request)
+    job_info = JobInfo(array_id)
+    job_info.name = os.path.basename(pbs_script)
+    if options.job_name is not None:
+        job_info.name = options.job_name
+    if options.queue is not None:
+        job_info.queue = options.queue
+    job_info.mail_points = options.mail_options
+    set_resource_request(job_info, options,
+                         slots=array_slots(options.array_request))
+    job_info.owner = getpass.getuser()
+    job_info.start_time = time.time()
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    os.setsid()
+    devnull = open(os.devnull, 'r+')
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+        os.dup2(devnull.fileno(), stream.fileno())
+    running = {} # pid => task job ID
+    failed = 0
+    retcode = 0
+    try:
+        job_info.set_lock(os.getpid())
+        account_started(job_info)
+        logging.info("Submitted job array %s with %i tasks", array_id,
+                     len(indices))
+        for index in indices:
+            while slot_limit is not None and len(running) >= slot_limit:
+                pid, status = os.wait()
+                if status != 0:
+                    failed += 1
+                del running[pid]
+            task_id = array_job_id(job_info.job_id.replace('[]', '', 1),
+                                   index)
+            close_registry()
+            pid = os.fork()
+            if pid == 0:
+                # Child process
+                retcode = 1
+                try:
+                    retcode = run_pbs_script(pbs_script, task_id, options,
+                                             array_index=index)
+                finally:
+                    flush_notifications()
+                    flush_log()
+                    os._exit(retcode)
+            running[pid] = task_id
+        while len(running) > 0:
+            pid, status = os.wait()
+            if status != 0:
+                failed += 1
+            del running[pid]
+        logging.info("Finished job array %s (%i failed tasks)", array_id,
+                     failed)
+    except SignalExc:
+        # Cancel all running tasks
+        logging.debug("SignalExc")
+        for pid in running.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in running.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        logging.info("Canceled job array %s", array_id)
+        write_record(*deleted_record(array_id, job_info.owner))
+        retcode = EXIT_DELETED
+    if failed > 0 and retcode == 0:
+        retcode = 1
+    account_ended(job_info, retcode)
+    record_exit(array_id, retcode)
+    job_info.release_lock()
+    if pbs_script == script_copy_file(array_id):
+        try:
+            os.unlink(pbs_script)
+        except OSError:
+            pass
+    devnull.close()
+    if failed > 0:
+        return 1
+    return 0
+
+
+def start_queued_job(job_id, spec):
+    """ Start the queued job with the given job_id in a detached process. The
+        spec is the dict that was stored with the job by queue_pbs_script
+    """
+    options = spec['options']
+    close_registry()
+    newpid = os.fork()
+    if newpid == 0:
+        # Child process: fork again so that the job is not our child
+        try:
+            if os.fork() == 0:
+                retcode = 1
+                try:
+                    try:
+                        os.chdir(spec['cwd'])
+                        os.environ.clear()
+                        os.environ.update(spec['environ'])
+                        logging.debug("Starting queued job %s", job_id)
+                        if options.array_request is not None:
+                            retcode = run_job_array(spec['pbs_script'], job_id,
+                                                    options)
+                        else:
+                            retcode = run_pbs_script(spec['pbs_script'],
+                                                     job_id, options)
+                    except OSError, error:
+                        logging.error("Failed to start queued job %s: %s",
+                                      job_id, error)
+                    # make sure the job does not keep holding resources, nor
+                    # its dependent jobs waiting (ignored if the job ran)
+                    if retcode != 0:
+                        record_exit(job_id, EXIT_FAILED)
+                    JobInfo(job_id).release_lock()
+                    try:
+                        os.unlink(spec['pbs_script'])
+                    except OSError:
+                        pass
+                    dispatch_queued_jobs(options)
+                finally:
+                    flush_notifications()
+                    flush_log()
+                    os._exit(retcode)
+        finally:
+            os._exit(0)
+    else:
+        os.waitpid(newpid, 0)
+
+
+def dispatch_queued_jobs(options):
+    """ Start all queued jobs of the current user that fit into the free
+        resources (all queued jobs, if the scheduler is disabled)
+    """
+    for (job_id, spec) in claim_jobs(options.config):
+        start_queued_job(job_id, spec)
+
+
+def queue_pbs_script(pbs_script, job_id, options, environ=None, cwd=None):
+    """ Put the given PBS script into the queue of the scheduler, under the
+        given job_id, or hold it until the jobs it depends on have ended. The
+        job will run with the given environ and in the given cwd (default:
+        those of the current process). The script is copied, unless it is the
+        copy for the job already (see script_copy_file). Raise a ValueError if
+        the job cannot be queued.
+    """
+    if environ is None:
+        environ = os.environ
+    if cwd is None:
+        cwd = os.getcwd()
+    try:
+        resources, cores, mem = resource_request(options.resource_list)
+    except ValueError, error:
+        raise ValueError("Invalid resource request: %s" % error)
+    slots = 1
+    if options.array_request is not None:
+        slots = array_slots(options.array_request)
+    if scheduler_enabled(options.config):
+        pool_cores, pool_mem = get_pool(options.config)
+        if ( (cores * slots > pool_cores)
+        or (pool_mem is not None and mem * slots > pool_mem) ):
+            logging.error("Job %s exceeds the resources of the scheduler",
+                          job_id)
+            raise ValueError("Job requests more resources than are available "
+                             "to the scheduler")
+    try:
+        depend = parse_extra_attributes(options.extra_attributes).get('depend')
+        dependencies = parse_depend(depend)
+    except ValueError, error:
+        raise ValueError("Invalid option -W: %s" % error)
+    if options.job_name is None:
+        options.job_name = os.path.basename(pbs_script)
+    script_copy = script_copy_file(job_id)
+    if pbs_script != script_copy:
+        PBSScript(pbs_script).write_copy(script_copy)
+    job_info = JobInfo(job_id)
+    job_info.name = options.job_name
+    if options.queue is not None:
+        job_info.queue = options.queue
+    job_info.owner = getpass.getuser()
+    job_info.mail_points = options.mail_options
+    job_info.resource_list = resources
+    job_info.req_cores = cores * slots
+    job_info.req_mem = mem * slots
+    spec = {'pbs_script': script_copy, 'options': options,
+            'environ': dict(environ), 'cwd': cwd}
+    if len(dependencies) > 0:
+        job_info.depend = depend
+        try:
+            hold_job(job_info, spec, dependencies)
+        except ValueError:
+            if pbs_script != script_copy:
+                os.unlink(script_copy)
+            raise
+    else:
+        queue_job(job_info, spec)
+    account_queued(job_info)
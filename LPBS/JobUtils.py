@@ -24,12 +24,46 @@
 import os
 import sys
 import signal
+import fcntl
+import errno
+import select
 import logging
-import pprint
+import re
 import time
+import json
 import datetime
 import cPickle as pickle
-from glob import glob
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+from LPBS.JobRegistry import get_registry
+from LPBS.ResourceLog import read_summary
+from LPBS.Dependencies import record_exit, EXIT_FAILED
+from LPBS.Accounting import account_ended
+from LPBS.Profiling import format_phases
+
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'] # parse_date
+
+LOCK_MAGIC = 'LPBS-JOB 2' # format and version of encoded JobInfo instances
+# number of header fields for every version of the format that can be read
+_HEADER_LENGTHS = {'LPBS-JOB 1': 5, LOCK_MAGIC: 6}
+LOCK_HEADER_SIZE = 4096 # upper bound for the length of the header line
+_HEADER_UNSAFE = re.compile(r'[\t\n]')
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+_JSON_DECODER = json.JSONDecoder()
+
+# attributes of a job as shown by lqstat -f, in order (see JobInfo.attributes)
+JOB_ATTRIBUTES = ['Job_Id', 'Job_Name', 'Job_Owner', 'job_state', 'queue',
+                  'server', 'exec_host', 'PID', 'Error_Path', 'Join_Path',
+                  'Mail_Points', 'Output_Path', 'depend', 'startup_time',
+                  'Resource_List', 'resources_used']
+# entries of resources_used that require sampling the processes of a job
+SAMPLED_RESOURCES = ['cput', 'mem', 'vmem', 'threads', 'maxmem',
+                     'cpu_efficiency']
+
+STALE_CHECK_FILE = 'stale_check' # touched by every check for stale locks
+
+SYS_PIDFD_OPEN = 434 # number of the pidfd_open system call (Linux >= 5.3)
+POLL_INTERVAL = 0.1 # seconds between checks for processes without a pidfd
 
 
 def get_cpu_mem_info(pid):
@@ -83,6 +117,98 @@ def get_cpu_mem_info(pid):
     return (cput, mem, vmem, threads)
 
 
+def read_process_table(proc='/proc'):
+    """ Read the stat file of every process in the proc filesystem, in a single
+        pass. Return a tuple (table, children) where table is a dict of PID =>
+        (cput, mem, vmem, threads) for each process individually (CPU time in
+        seconds as a float, memory in bytes), and children is a dict of PID =>
+        list of child PIDs. Raise an OSError if proc cannot be read.
+    """
+    clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    table = {}
+    children = {}
+    for entry in os.listdir(proc):
+        if not entry.isdigit():
+            continue
+        try:
+            stat_fh = open(os.path.join(proc, entry, 'stat'))
+            try:
+                stat = stat_fh.read()
+            finally:
+                stat_fh.close()
+        except IOError:
+            continue # process has ended in the meantime
+        # the command name in parentheses may contain spaces
+        fields = stat[stat.rfind(')')+2:].split()
+        try:
+            ppid = int(fields[1])
+            cput = (int(fields[11]) + int(fields[12])) / clock_ticks
+            threads = int(fields[17])
+            vmem = int(fields[20])
+            mem = int(fields[21]) * page_size
+        except (IndexError, ValueError):
+            continue
+        pid = int(entry)
+        table[pid] = (cput, mem, vmem, threads)
+        children.setdefault(ppid, []).append(pid)
+    for pid_children in children.values():
+        pid_children.sort()
+    return (table, children)
+
+
+def get_cpu_mem_info_for_pids(pids):
+    """ Return a dict of PID => (cput, mem, vmem, threads) for all of the given
+        PIDs, with the same meaning as the result of get_cpu_mem_info, but
+        collected from a single pass over /proc for all PIDs together. On
+        systems without /proc, fall back to get_cpu_mem_info for every PID.
+    """
+    pids = set([pid for pid in pids if pid is not None])
+    if len(pids) == 0:
+        return {}
+    try:
+        (table, children) = read_process_table()
+    except (OSError, ValueError, AttributeError):
+        logging.debug("/proc not available, using get_cpu_mem_info")
+        return dict([(pid, get_cpu_mem_info(pid)) for pid in pids])
+
+    def accumulate(pid):
+        """ Accumulate the resources of pid and its subprocesses """
+        (cput, mem, vmem, threads) = table[pid]
+        cput = int(cput)
+        pid_children = [child for child in children.get(pid, [])
+                        if table.has_key(child)]
+        if len(pid_children) > 0:
+            threads = 0
+        for child in pid_children:
+            (cput_child, mem_child, vmem_child, threads_child) \
+            = accumulate(child)
+            cput = cput + cput_child
+            mem = mem + mem_child
+            vmem = vmem + vmem_child
+            if threads_child > 0:
+                threads = threads_child
+        return (cput, mem, vmem, threads)
+
+    result = {}
+    for pid in pids:
+        if table.has_key(pid):
+            result[pid] = accumulate(pid)
+        else:
+            logging.warn("Process %s is not running anymore" % pid)
+            result[pid] = (0, 0, 0, 0)
+    return result
+
+
+def pid_is_alive(pid):
+    """ Return True if a process with the given PID exists """
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        return (error.errno != errno.ESRCH)
+    return True
+
+
 def format_bytes(bytes):
     """ Return string representation for number of bytes """
     remaining = bytes
@@ -97,9 +223,46 @@ def format_bytes(bytes):
     return str(bytes)
 
 
+def parse_date(date_str, is_end=False):
+    """ Return the time in seconds since the epoch for the given date string.
+        A date without a time refers to the start of the day, or to the end of
+        the day if is_end is True. Raise a ValueError for an invalid date
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            timestamp = time.mktime(time.strptime(date_str.strip(),
+                                                  date_format))
+        except ValueError:
+            continue
+        if is_end:
+            if date_format == '%Y-%m-%d':
+                timestamp += 86400
+            elif date_format == '%Y-%m-%d %H:%M':
+                timestamp += 60
+            else:
+                timestamp += 1
+        return timestamp
+    raise ValueError("Invalid date '%s'" % date_str)
+
+
+class JobInfo(object):
+    """ Class for holding Job Info
 
-class JobInfo:
-    """ Class for holding Job Info """
+        A JobInfo is stored (in its lock file, and in the job registry) as a
+        header line with the fields in HEADER_FIELDS, which are needed most
+        often, followed by a JSON body with the remaining fields (see encode)
+    """
+    __slots__ = ['job_id', 'pid', 'name', 'owner', 'queue', 'status',
+                 'start_time', 'server', 'exec_host', 'error_path',
+                 'output_path', 'stdout_file', 'stderr_file',
+                 'resources_used', 'join_path', 'mail_points',
+                 'variable_list', 'lockfile', 'resource_list', 'req_cores',
+                 'req_mem', 'depend', 'pid_start', 'startup_phases']
+    HEADER_FIELDS = ['pid', 'status', 'start_time', 'owner', 'queue',
+                     'pid_start']
+    # the lock file is implied by the job ID
+    BODY_FIELDS = [field for field in __slots__
+                   if not field in HEADER_FIELDS and field != 'lockfile']
     def __init__(self, job_id=None):
         """ Initialize """
         self.job_id = job_id
@@ -113,32 +276,106 @@ class JobInfo:
         self.exec_host = None
         self.error_path = None
         self.output_path = None
+        self.stdout_file = None # full path of the file written by the job
+        self.stderr_file = None
         self.resources_used = {}
         self.join_path = None
         self.mail_points = None
         self.variable_list = None
         self.lockfile = None
+        self.resource_list = {}
+        self.req_cores = 1
+        self.req_mem = 0
+        self.depend = None # value of the depend attribute, for held jobs
+        self.pid_start = None # start time of the process pid, see set_lock
+        self.startup_phases = None # list of [name, seconds], see PhaseTimer
+    def __getstate__(self):
+        """ Return the fields as a dict, for pickling """
+        return dict([(field, getattr(self, field))
+                     for field in self.__slots__ if hasattr(self, field)])
+    def __setstate__(self, state):
+        """ Set the fields from the given dict, as returned by __getstate__
+            (or the __dict__ of a JobInfo pickled by an older version)
+        """
+        self.__init__()
+        for (field, value) in state.items():
+            if field in self.__slots__:
+                setattr(self, field, value)
     def __str__(self):
         """ Retrun string representation """
-        return pprint.pformat(self.__dict__)
-    def full_info(self):
-        """ Return multi-line string with full information about the job """
-        full_info_str  = "Job Id: %s\n" % self.job_id
-        full_info_str += "    Job_Name = %s\n" % self.name
-        full_info_str += "    Job_Owner = %s\n" % self.owner
-        full_info_str += "    job_state = %s\n" % self.status
-        full_info_str += "    queue = %s\n" % self.queue
-        full_info_str += "    server = %s\n" % self.server
-        full_info_str += "    exec_host = %s\n" % self.exec_host
-        full_info_str += "    PID = %s\n" % self.pid
-        full_info_str += "    Error_Path = %s\n" % self.error_path
-        full_info_str += "    Join_Path = %s\n" % self.join_path
-        full_info_str += "    Mail_Points = %s\n" % self.mail_points
-        full_info_str += "    Output_Path = %s\n" % self.output_path
-        for field in self.resources_used.keys():
-            full_info_str += "    resources_used.%s = %s\n" % (field,
-                                                     self.resources_used[field])
+        import pprint
+        return pprint.pformat(self.__getstate__())
+    def attributes(self, fields=None):
+        """ Return a list of tuples (name, value) for the JOB_ATTRIBUTES of the
+            job, in order. The values of 'Resource_List' and 'resources_used'
+            are dicts. If fields is given, only the attributes selected by it
+            are included (see select_attributes)
+        """
+        startup_time = None
+        if self.startup_phases is not None:
+            startup_time = format_phases(self.startup_phases)
+        attributes = [('Job_Id', self.job_id), ('Job_Name', self.name),
+                      ('Job_Owner', self.owner), ('job_state', self.status),
+                      ('queue', self.queue), ('server', self.server),
+                      ('exec_host', self.exec_host), ('PID', self.pid),
+                      ('Error_Path', self.error_path),
+                      ('Join_Path', self.join_path),
+                      ('Mail_Points', self.mail_points),
+                      ('Output_Path', self.output_path),
+                      ('depend', self.depend),
+                      ('startup_time', startup_time),
+                      ('Resource_List', dict(self.resource_list)),
+                      ('resources_used', dict(self.resources_used))]
+        if fields is None:
+            return attributes
+        return select_attributes(attributes, fields)
+    def full_info(self, fields=None):
+        """ Return multi-line string with full information about the job,
+            optionally only with the attributes selected by fields
+        """
+        full_info_str = ""
+        for (name, value) in self.attributes(fields):
+            if name == 'Job_Id':
+                full_info_str += "Job Id: %s\n" % value
+            elif isinstance(value, dict):
+                for key in sorted(value.keys()):
+                    full_info_str += "    %s.%s = %s\n" % (name, key,
+                                                           value[key])
+            elif value is not None \
+            or not name in ['depend', 'startup_time']:
+                full_info_str += "    %s = %s\n" % (name, value)
         return full_info_str
+    def xml_info(self, fields=None):
+        """ Return the job as a <Job> element, as in the output of TORQUE's
+            'qstat -x', optionally only with the attributes selected by fields.
+            Attributes that are not set (or empty) are left out
+        """
+        xml_info_str = "<Job>"
+        for (name, value) in self.attributes(fields):
+            if value is None or value == {}:
+                continue
+            if isinstance(value, dict):
+                xml_info_str += "<%s>" % name
+                for key in sorted(value.keys()):
+                    xml_info_str += "<%s>%s</%s>" % (key,
+                                    escape(str(value[key])), key)
+                xml_info_str += "</%s>" % name
+            else:
+                xml_info_str += "<%s>%s</%s>" % (name, escape(str(value)),
+                                                 name)
+        return xml_info_str + "</Job>"
+    def json_info(self, fields=None):
+        """ Return the job as a single line with a JSON object, with the same
+            structure as the element returned by xml_info (but including
+            unset attributes, as null)
+        """
+        attributes = OrderedDict(self.attributes(fields))
+        try:
+            return _JSON_ENCODER.encode(attributes)
+        except UnicodeDecodeError:
+            return _JSON_ENCODER.encode(OrderedDict([(name,
+                   _to_unicode(value)) for (name, value)
+                   in attributes.items()]))
     def short_info(self, print_header=False):
         """ Return one-line string with summary of job information """
         short_info_str = ""
@@ -157,29 +394,58 @@ class JobInfo:
                           walltime[:15], self.status[:1], self.queue[:15])
         return short_info_str
     def set_lock(self, pid):
-        """ Create a lock file and store job information inside """
+        """ Create a lock file and store job information inside. The job is
+            also added to the job registry. Together with the PID, the start
+            time of its process is stored, so that the lock is recognized as
+            stale even if the PID is reused after the process has died
+        """
         if self.job_id is None:
             raise ValueError("Can't set lock unless job_id is set")
         self.lockfile = os.path.join(os.environ['LPBS_HOME'],
                                      "%s.lock" % self.job_id)
         self.pid = pid
-        lock = open(self.lockfile, 'w')
-        pickle.dump(self, lock)
-        lock.close()
-    def read_lock(self, lockfile):
-        """ Read job info from existing lock file. Raise an IOError if the
-            lockfile cannot be read
+        self.pid_start = process_start_time(pid)
+        # readers must never see a partially written lock file
+        temp_file = "%s.%i.tmp" % (self.lockfile, os.getpid())
+        fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, self.encode())
+        finally:
+            os.close(fd)
+        os.rename(temp_file, self.lockfile)
+        get_registry().add(self)
+    def encode(self):
+        """ Return the job info as a string: a header line with LOCK_MAGIC
+            and the HEADER_FIELDS, separated by tabs, followed by a line with
+            a JSON object holding the BODY_FIELDS
         """
-        lock = open(lockfile, 'r')
-        temp = pickle.load(lock)
-        lock.close()
-        logging.debug("Read JobInfo from lock:\n%s", temp)
-        self.__dict__ = temp.__dict__
-        if self.start_time > 0:
-            walltime = int(time.time() - self.start_time)
-            self.resources_used['walltime'] \
-            = str(datetime.timedelta(seconds=walltime))
-        (cput, mem, vmem, threads) = get_cpu_mem_info(self.pid)
+        header = [LOCK_MAGIC]
+        for field in self.HEADER_FIELDS:
+            value = getattr(self, field)
+            if value is None:
+                value = ''
+            elif field == 'start_time':
+                value = repr(float(value))
+            header.append(_HEADER_UNSAFE.sub(' ', str(value)))
+        body = dict([(field, getattr(self, field))
+                     for field in self.BODY_FIELDS])
+        try:
+            body = _JSON_ENCODER.encode(body)
+        except UnicodeDecodeError:
+            # e.g. a path that is not valid UTF-8
+            body = _JSON_ENCODER.encode(_to_unicode(body))
+        return "\t".join(header) + "\n" + body + "\n"
+    def update_resources_used(self, cpu_mem_info=None):
+        """ Recalculate the walltime, cput, mem, vmem, and threads entries in
+            the resources_used dict. If cpu_mem_info is given, it is used
+            instead of calling get_cpu_mem_info for the job's process.
+        """
+        if self.pid is None:
+            return # queued job
+        self.update_walltime()
+        if cpu_mem_info is None:
+            cpu_mem_info = get_cpu_mem_info(self.pid)
+        (cput, mem, vmem, threads) = cpu_mem_info
         if cput > 0:
             self.resources_used['cput'] \
             = str(datetime.timedelta(seconds=cput))
@@ -189,42 +455,395 @@ class JobInfo:
             self.resources_used['vmem'] = format_bytes(vmem)
         if threads > 0:
             self.resources_used['threads'] = threads
-        self.job_id = os.path.splitext(os.path.basename(lockfile))[0]
-        self.lockfile = lockfile
+        # peak memory and CPU efficiency, from the job's resource log
+        summary = read_summary(self.job_id)
+        maxmem = mem
+        if summary is not None:
+            maxmem = max(mem, summary['maxmem'])
+        if maxmem > 0:
+            self.resources_used['maxmem'] = format_bytes(maxmem)
+        if summary is not None and summary['cpu_efficiency'] > 0:
+            self.resources_used['cpu_efficiency'] \
+            = "%.0f%%" % (100 * summary['cpu_efficiency'])
+    def update_walltime(self):
+        """ Recalculate the walltime entry in the resources_used dict """
+        if self.pid is None:
+            return # queued job
+        if self.start_time > 0:
+            walltime = int(time.time() - self.start_time)
+            self.resources_used['walltime'] \
+            = str(datetime.timedelta(seconds=walltime))
     def release_lock(self):
-        """ Delete lock """
+        """ Delete lock, and remove the job from the job registry """
         if self.job_id is None:
             raise ValueError("Can't release lock unless job_id is set")
         lockfile = os.path.join(os.environ['LPBS_HOME'], "%s.lock"
                                 % self.job_id)
         logging.debug("Releasing lock: %s", lockfile)
+        get_registry().remove(self.job_id)
         try:
             os.unlink(lockfile)
         except OSError:
             pass
 
 
-def get_new_job_id(options):
-    """ Return a fresh, unused job ID """
+def decode_job_info(data, header_only=False):
+    """ Return the JobInfo encoded in data, as returned by JobInfo.encode. If
+        header_only is True, only the HEADER_FIELDS are set, and data may end
+        after the header line. The pickled JobInfo written by older versions
+        of LPBS is also accepted. Raise a ValueError if data cannot be decoded
+    """
+    if not data.startswith(LOCK_MAGIC.split(' ', 1)[0]):
+        try:
+            job_info = pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+        IndexError, KeyError, TypeError), error:
+            raise ValueError("Cannot decode job info: %s" % error)
+        if not isinstance(job_info, JobInfo):
+            raise ValueError("Cannot decode job info: not a JobInfo")
+        return job_info
+    header_end = data.find("\n")
+    if header_end < 0:
+        raise ValueError("Incomplete job info")
+    header = data[:header_end].split("\t")
+    if not _HEADER_LENGTHS.has_key(header[0]):
+        raise ValueError("Unsupported job info format '%s'" % header[0])
+    if len(header) != _HEADER_LENGTHS[header[0]] + 1:
+        raise ValueError("Invalid job info header")
+    job_info = JobInfo()
+    (pid, status, start_time, owner, queue) = header[1:6]
+    if pid != '':
+        job_info.pid = int(pid)
+    job_info.status = status
+    job_info.start_time = float(start_time)
+    if owner != '':
+        job_info.owner = owner
+    job_info.queue = queue
+    if len(header) > 6 and header[6] != '':
+        job_info.pid_start = int(header[6])
+    if not header_only:
+        body = _JSON_DECODER.decode(data[header_end+1:])
+        for field in JobInfo.BODY_FIELDS:
+            if body.has_key(field):
+                setattr(job_info, field, _to_str(body[field]))
+    return job_info
+
+
+def _to_unicode(value):
+    """ Return value with all strings (also in dicts and lists) decoded as
+        UTF-8, replacing invalid characters
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict([(_to_unicode(key), _to_unicode(item))
+                     for (key, item) in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [_to_unicode(item) for item in value]
+    return value
+
+
+def _to_str(value):
+    """ Return value with all unicode strings (also in dicts and lists), as
+        returned by the JSON decoder, encoded as UTF-8
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict([(_to_str(key), _to_str(item))
+                     for (key, item) in value.items()])
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    return value
+
+
+def select_attributes(attributes, fields):
+    """ Return the list of tuples (name, value) in attributes (as returned by
+        JobInfo.attributes) that are selected by the list of fields. A field
+        is either the name of an attribute, or, for the dict attributes
+        'Resource_List' and 'resources_used', the name and a key, e.g.
+        'resources_used.walltime'. The 'Job_Id' is always included.
+    """
+    selected = []
+    for (name, value) in attributes:
+        if name == 'Job_Id' or name in fields:
+            selected.append((name, value))
+        elif isinstance(value, dict):
+            prefix = name + '.'
+            keys = [field[len(prefix):] for field in fields
+                    if field.startswith(prefix)]
+            if len(keys) > 0:
+                selected.append((name, dict([(key, value[key])
+                                 for key in keys if value.has_key(key)])))
+    return selected
+
+
+def parse_fields(fields_str):
+    """ Return the list of fields in the given comma-separated string, for
+        select_attributes. Raise a ValueError for unknown attributes
+    """
+    fields = []
+    for field in fields_str.split(','):
+        field = field.strip()
+        if field == '':
+            continue
+        name = field.split('.', 1)[0]
+        if not name in JOB_ATTRIBUTES:
+            raise ValueError("Unknown field '%s'" % field)
+        if '.' in field and not name in ['Resource_List', 'resources_used']:
+            raise ValueError("Unknown field '%s'" % field)
+        fields.append(field)
+    return fields
+
+
+def fields_need_sampling(fields):
+    """ Return True if any of the given fields (as returned by parse_fields,
+        or None for all fields) is one of the SAMPLED_RESOURCES
+    """
+    if fields is None or 'resources_used' in fields:
+        return True
+    for field in fields:
+        if field.startswith('resources_used.') \
+        and field.split('.', 1)[1] in SAMPLED_RESOURCES:
+            return True
+    return False
+
+
+def read_lock_header(lockfile):
+    """ Return a JobInfo with only the HEADER_FIELDS (and the job ID) set,
+        from the given lock file, reading no more than its header. Raise an
+        IOError if the lock file cannot be read
+    """
+    lock = open(lockfile, 'r')
+    try:
+        data = lock.read(LOCK_HEADER_SIZE)
+        if not data.startswith(LOCK_MAGIC.split(' ', 1)[0]):
+            data += lock.read() # older versions: must unpickle everything
+    finally:
+        lock.close()
+    try:
+        job_info = decode_job_info(data, header_only=True)
+    except ValueError, error:
+        raise IOError("Invalid lock file %s: %s" % (lockfile, error))
+    job_info.job_id = os.path.splitext(os.path.basename(lockfile))[0]
+    job_info.lockfile = lockfile
+    return job_info
+
+
+def find_jobs(job_ids=None, owner=None, array_tasks=True, sample=True):
+    """ Return a list of JobInfo instances, with up-to-date resource
+        information, for all registered jobs that match any of the job
+        identifiers in the list job_ids (all jobs if job_ids is empty or None),
+        and that belong to the given owner (if not None). If array_tasks is
+        False, the individual tasks of job arrays are skipped. If sample is
+        False, only the walltime is updated, and the processes of the jobs are
+        not examined for the SAMPLED_RESOURCES.
+    """
+    registry = get_registry()
+    if not job_ids:
+        job_ids = [None, ]
+    result = []
+    seen = set()
+    for job_id in job_ids:
+        for job_info in registry.jobs(job_id, owner):
+            if job_info.job_id in seen:
+                continue
+            if not array_tasks and is_array_task(job_info.job_id):
+                continue
+            seen.add(job_info.job_id)
+            result.append(job_info)
+    if not sample:
+        for job_info in result:
+            job_info.update_walltime()
+        return result
+    # The resources of a job array are those of its tasks (the process of the
+    # array may supervise other jobs as well)
+    task_pids = {}
+    for job_info in result:
+        if job_info.job_id.split('.', 1)[0].endswith('[]'):
+            prefix = job_info.job_id.split('[', 1)[0] + '['
+            task_pids[job_info.job_id] = [pid for (task_id, pid)
+                                          in registry.lookup(prefix)
+                                          if task_id != job_info.job_id]
+    pids = [job_info.pid for job_info in result]
+    for pid_list in task_pids.values():
+        pids.extend(pid_list)
+    cpu_mem_info = get_cpu_mem_info_for_pids(pids)
+    for job_info in result:
+        if task_pids.has_key(job_info.job_id):
+            totals = [0, 0, 0, 0]
+            for pid in task_pids[job_info.job_id]:
+                for (i, value) in enumerate(cpu_mem_info.get(pid, (0, ) * 4)):
+                    totals[i] += value
+            job_info.update_resources_used(tuple(totals))
+        else:
+            job_info.update_resources_used(cpu_mem_info.get(job_info.pid))
+    return result
+
+
+def remove_stale_jobs(jobs):
+    """ Return the list of all JobInfo instances in jobs whose process is still
+        running. The locks of all other jobs are stale, and are released.
+        Queued jobs, which have no process yet, are never stale.
+    """
+    result = []
+    for job_info in jobs:
+        if job_info.pid is None \
+        or job_process_alive(job_info.pid, job_info.pid_start):
+            result.append(job_info)
+        else:
+            release_stale_job(job_info)
+    return result
+
+
+def process_start_time(pid):
+    """ Return the start time of the process with the given PID, in clock
+        ticks after the system boot, or None if it cannot be determined (e.g.
+        on systems without /proc). Unlike the PID, the start time identifies a
+        process uniquely
+    """
+    try:
+        stat_fh = open('/proc/%i/stat' % pid)
+        try:
+            stat = stat_fh.read()
+        finally:
+            stat_fh.close()
+        # the command name in parentheses may contain spaces
+        return int(stat[stat.rfind(')')+2:].split()[19])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def job_process_alive(pid, pid_start):
+    """ Return True if the process with the given PID exists, and, if its
+        start time pid_start (as returned by process_start_time) is known,
+        has not been replaced by another process with the same PID
+    """
+    if not pid_is_alive(pid):
+        return False
+    if pid_start is None:
+        return True
+    start_time = process_start_time(pid)
+    return (start_time is None or start_time == pid_start)
+
+
+def release_stale_job(job_info):
+    """ Release the lock of the given job, whose process has died without
+        releasing it, and record the job's final state in the accounting log
+        as failed. Return False if another process has released the lock
+        first, or is about to
+    """
+    if not get_registry().remove_unfinished(job_info.job_id):
+        return False
+    lockfile = os.path.join(os.environ['LPBS_HOME'], "%s.lock"
+                            % job_info.job_id)
+    logging.warn("lock %s is stale", lockfile)
+    account_ended(job_info, EXIT_FAILED)
+    if not is_array_task(job_info.job_id):
+        record_exit(job_info.job_id, EXIT_FAILED)
+    try:
+        os.unlink(lockfile)
+    except OSError:
+        pass
+    return True
+
+
+def reap_stale_jobs():
+    """ Check the locks of all running jobs in a single pass over the job
+        registry, and release those whose process has died (see
+        release_stale_job). Return the list of IDs of the released jobs
+    """
+    registry = get_registry()
+    stale_check_file = os.path.join(registry.lpbs_home, STALE_CHECK_FILE)
+    try:
+        open(stale_check_file, 'a').close()
+        os.utime(stale_check_file, None)
+    except (IOError, OSError), error:
+        logging.debug("Cannot touch %s: %s", stale_check_file, error)
+    released = []
+    for (job_id, pid, pid_start) in registry.running():
+        if job_process_alive(pid, pid_start):
+            continue
+        job_info = registry.job(job_id)
+        if job_info is None:
+            continue # released in the meantime
+        job_info.job_id = job_id
+        if release_stale_job(job_info):
+            released.append(job_id)
+    return released
+
+
+def stale_check_interval(config):
+    """ Return the interval in seconds between checks for stale locks,
+        according to the [LPBS] section of the config (0 if the checks are
+        disabled)
+    """
+    try:
+        return max(0.0, config.getfloat('LPBS', 'stale_check_interval'))
+    except ValueError:
+        logging.warn("Invalid value for stale_check_interval in section LPBS")
+        return 0.0
+
+
+def reap_stale_jobs_if_due(config):
+    """ Call reap_stale_jobs, unless the last check for stale locks (by any
+        process) was less than the stale_check_interval ago. This takes a
+        single stat call if no check is due
+    """
+    interval = stale_check_interval(config)
+    if interval <= 0:
+        return []
+    try:
+        last_check = os.stat(os.path.join(os.environ['LPBS_HOME'],
+                                          STALE_CHECK_FILE)).st_mtime
+    except OSError:
+        last_check = 0
+    if abs(time.time() - last_check) < interval:
+        return []
+    return reap_stale_jobs()
+
+
+def reserve_sequence_numbers(options, count=1):
+    """ Atomically reserve count consecutive sequence numbers and return the
+        first one, or None if the sequence file cannot be accessed.
+
+        The sequence file is locked exclusively for the duration of the
+        read-increment-write cycle, so concurrent submissions can never receive
+        the same number. The file is deliberately not fsync'ed: it only needs
+        to be consistent between processes, which the lock guarantees.
+    """
     sequencefile = os.path.join(os.environ['LPBS_HOME'],
                                 options.config.get('LPBS', 'sequence_file'))
-    # read previous sequence number and up-one
     try:
-        sequencefile_fh = open(sequencefile, 'r')
-        sequence = int(sequencefile_fh.read())
-        sequencefile_fh.close()
-    except IOError, error:
-        sequence = 0
-    sequence = sequence + 1
-    # write new sequence number back to sequence file
-    try:
-        sequencefile_fh = open(sequencefile, 'w')
-        sequencefile_fh.write(str(sequence))
-        sequencefile_fh.close()
-    except IOError, error:
-        print >> sys.stderr, "Could not write to %s:\n%s" \
-                             % (sequencefile, error)
+        sequencefile_fd = os.open(sequencefile, os.O_RDWR | os.O_CREAT, 0o666)
+    except OSError, error:
+        print >> sys.stderr, "Could not open %s:\n%s" % (sequencefile, error)
         return None
+    try:
+        try:
+            fcntl.flock(sequencefile_fd, fcntl.LOCK_EX)
+            # read previous sequence number and up-one
+            try:
+                sequence = int(os.read(sequencefile_fd, 64))
+            except ValueError:
+                sequence = 0
+            # write new sequence number back to sequence file. Since the
+            # number can only grow, overwriting in place is safe
+            os.lseek(sequencefile_fd, 0, os.SEEK_SET)
+            last = str(sequence + count)
+            os.write(sequencefile_fd, last)
+            os.ftruncate(sequencefile_fd, len(last))
+        except (OSError, IOError), error:
+            print >> sys.stderr, "Could not write to %s:\n%s" \
+                                 % (sequencefile, error)
+            return None
+    finally:
+        os.close(sequencefile_fd) # releases the lock
+    return sequence + 1
+
+
+def format_job_id(options, sequence):
+    """ Return the full job ID for the given sequence number """
     id_host = options.config.get("Server", 'hostname')
     id_domain = options.config.get("Server", 'domain')
     if options.config.getboolean('LPBS', 'username_in_jobid'):
@@ -234,22 +853,91 @@ def get_new_job_id(options):
         return "%s.%s.%s" % (sequence, id_host, id_domain)
 
 
+def array_job_id(job_id, index=''):
+    """ Return the ID of the job array with the given job_id (index='') or of
+        the task with the given index in that array, e.g. '12[]' or '12[3]' for
+        job_id '12'
+    """
+    if '.' in job_id:
+        sequence, rest = job_id.split('.', 1)
+        return "%s[%s].%s" % (sequence, index, rest)
+    return "%s[%s]" % (job_id, index)
+
+
+def is_array_task(job_id):
+    """ Return True if job_id is the ID of a single task in a job array """
+    sequence = job_id.split('.', 1)[0]
+    return ('[' in sequence) and not sequence.endswith('[]')
+
+
+def parse_extra_attributes(extra_attributes):
+    """ Parse the list of values given to the '-W' option of lqsub, each of
+        the form 'attr_name=attr_value[,attr_name=attr_value...]'. Return a
+        dict attr_name => attr_value. Values that are lists of files (as for
+        the stagein and stageout attributes) may contain commas. Raise a
+        ValueError if the attributes cannot be parsed
+    """
+    attributes = {}
+    if extra_attributes is None:
+        return attributes
+    for item in extra_attributes:
+        name = None
+        for part in item.split(','):
+            if '=' in part and not '@' in part.split('=', 1)[0]:
+                name, value = part.split('=', 1)
+                name = name.strip()
+                if attributes.has_key(name):
+                    attributes[name] += ',' + value
+                else:
+                    attributes[name] = value
+            elif name is not None:
+                attributes[name] += ',' + part
+            else:
+                raise ValueError("Invalid attribute '%s'" % part)
+    return attributes
+
+
+def parse_array_request(array_request):
+    """ Parse the array request given to the '-t' option of lqsub, e.g.
+        '1-100%16' or '1,3,5-10'. Return tuple (indices, slot_limit), where
+        indices is a sorted list of the array indices and slot_limit is the
+        maximum number of tasks that may run at the same time (None for no
+        limit). Raise a ValueError if array_request cannot be parsed.
+    """
+    slot_limit = None
+    if '%' in array_request:
+        array_request, slot_limit = array_request.split('%', 1)
+        slot_limit = int(slot_limit)
+        if slot_limit < 1:
+            raise ValueError("Slot limit must be positive")
+    indices = set()
+    for item in array_request.split(','):
+        if '-' in item:
+            first, last = item.split('-', 1)
+            indices.update(range(int(first), int(last) + 1))
+        else:
+            indices.add(int(item))
+    if len(indices) == 0 or min(indices) < 0:
+        raise ValueError("Invalid array request '%s'" % array_request)
+    return (sorted(indices), slot_limit)
+
+
+def get_new_job_id(options):
+    """ Return a fresh, unused job ID """
+    sequence = reserve_sequence_numbers(options)
+    if sequence is None:
+        return None
+    return format_job_id(options, sequence)
+
 
 def pid_for_job_id(job_id):
     """ For a given Job_ID, return the process ID, or None if the given job id
         does not exist or is not accessible
     """
-    lock_files = glob(os.path.join(os.environ['LPBS_HOME'], '*.lock'))
-    for lock_file in lock_files:
-        if os.path.basename(lock_file).startswith(job_id):
-            job_info = JobInfo()
-            try:
-                job_info.read_lock(lock_file)
-                return(job_info.pid)
-            except IOError, error:
-                logging.debug("Failed to open lock: %s", error)
-                return None
-    logging.debug("No lock file found for job_id %s", job_id)
+    matches = get_registry().lookup(job_id)
+    if len(matches) > 0:
+        return matches[0][1]
+    logging.debug("No registered job found for job_id %s", job_id)
     return None
 
 
@@ -266,3 +954,124 @@ def send_sig_to_job_id(job_id, sig=signal.SIGTERM):
     else:
         logging.debug("Skipped sending signal %s to job %s (pid not found)",
                       sig, job_id)
+
+
+def pidfd_open(pid):
+    """ Return a file descriptor that becomes readable when the process with
+        the given PID exits, or None if pidfds are not supported
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.syscall(SYS_PIDFD_OPEN, pid, 0)
+    except (ImportError, OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return fd
+
+
+def leads_process_group(pid):
+    """ Return True if the process with the given PID leads its own process
+        group, as the process running a job does unless the job is interactive
+    """
+    try:
+        return os.getpgid(pid) == pid
+    except OSError:
+        return False
+
+
+def job_group_is_alive(pid, group):
+    """ Return True if the process with the given PID, or any process in its
+        process group (if group is True) still exists
+    """
+    if not group:
+        return pid_is_alive(pid)
+    try:
+        os.killpg(pid, 0)
+    except OSError, error:
+        return (error.errno != errno.ESRCH)
+    return True
+
+
+def signal_job_group(job_id, pid, sig, group):
+    """ Send sig to the process group led by the process with the given PID
+        (if group is True), or to the process only. Return True if the signal
+        was sent
+    """
+    try:
+        if group:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except OSError, error:
+        logging.debug("Failed to send signal %s to job %s (PID %s): %s",
+                      sig, job_id, pid, error)
+        return False
+    logging.info("Sent signal %s to job %s (PID %s)", sig, job_id, pid)
+    return True
+
+
+def terminate_jobs(jobs, delay):
+    """ Terminate all the given jobs (list of tuples (job_id, pid)) at once:
+        send SIGTERM to all of them, wait until they have exited, but at most
+        for delay seconds in total, and send SIGKILL to the ones that are
+        still running. A job has exited once its process group is gone. The
+        tasks of job arrays in the list get their SIGTERM from the array.
+        Return the list of IDs of the jobs that were killed.
+    """
+    job_ids = set([job_id for (job_id, pid) in jobs])
+    alive = {} # pid => (job_id, group)
+    pidfds = {} # fd => pid
+    poller = select.poll()
+    try:
+        for (job_id, pid) in jobs:
+            if pid is None or alive.has_key(pid):
+                continue
+            # open the pidfd first, so that it can't refer to a reused PID
+            fd = pidfd_open(pid)
+            group = leads_process_group(pid)
+            if is_array_task(job_id) and (job_id[:job_id.index('[')+1]
+            + job_id[job_id.index(']'):]) in job_ids:
+                sent = pid_is_alive(pid)
+            else:
+                sent = signal_job_group(job_id, pid, signal.SIGTERM, group)
+            if sent:
+                alive[pid] = (job_id, group)
+                if fd is not None:
+                    pidfds[fd] = pid
+                    poller.register(fd, select.POLLIN)
+            elif fd is not None:
+                os.close(fd)
+        deadline = time.time() + delay
+        while len(alive) > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if len(pidfds) < len(alive):
+                remaining = min(remaining, POLL_INTERVAL)
+            try:
+                events = poller.poll(remaining * 1000)
+            except select.error, error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for (fd, event) in events:
+                poller.unregister(fd)
+                os.close(fd)
+                pid = pidfds.pop(fd)
+                if not alive[pid][1]:
+                    del alive[pid]
+                # else, the rest of the group is checked below
+            watched = set(pidfds.values())
+            for (pid, (job_id, group)) in alive.items():
+                if not pid in watched and not job_group_is_alive(pid, group):
+                    del alive[pid]
+        killed = []
+        for (pid, (job_id, group)) in sorted(alive.items()):
+            if signal_job_group(job_id, pid, signal.SIGKILL, group):
+                killed.append(job_id)
+        return killed
+    finally:
+        for fd in pidfds.keys():
+            os.close(fd)
@@ -19,17 +19,22 @@
 #    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
 ############################################################################
 
-""" Notifications and Logging """
+""" Notifications and Logging
 
-import email
-import smtplib
+    The email, smtplib, and gntp modules are only imported once a notification
+    is actually sent, so that importing this module stays cheap
+"""
+
+import os
+import sys
+import time
+import fcntl
+import Queue
+import atexit
 import socket
+import getpass
 import logging
-try:
-    import gntp
-    import gntp.notifier as gntp_notifier
-except ImportError:
-    gntp_notifier = None
+import threading
 
 
 COND_STRT = 1 # Begun execution
@@ -37,6 +42,10 @@ COND_STOP = 2 # Execution terminated
 COND_ABRT = 3 # Execution aborted
 COND_ABER = 4 # Execution failed
 
+QUEUE_SIZE = 100 # maximum number of pending notifications per process
+
+_QUEUE = None # NotificationQueue of the current process
+
 
 class Notifier:
     """ Notifier for a single job  """
@@ -55,6 +64,8 @@ class Notifier:
         self.growl['sticky'] = False
         self.growl['hostnames'] = []
         self.growl['passwords'] = []
+        self.growl['registration_ttl'] = 86400
+        self.growl['failure_ttl'] = 300
         self.mail = {}
         self.mail['recipients'] = []
         self.mail['use_tls'] = True
@@ -64,20 +75,40 @@ class Notifier:
         self.mail['username'] = ''
         self.mail['password'] = 'secret'
         self.mail['smtp_server'] = 'localhost'
+        self.mail['digest'] = 0
+        self.timeout = 10
+        self.retries = 3
+        self.backoff = 2
+        self.flush_timeout = 30
         self._message_id = ''
-        self._growl_notifiers = []
+        self._growl_hosts = [] # tuples (hostname, port, password)
+        self._growl_notifiers = {} # index in _growl_hosts => GrowlNotifier
 
         if options is not None:
 
+            # Delivery settings
+            for (attr, option) in [('timeout', 'timeout'),
+            ('retries', 'retries'), ('backoff', 'backoff'),
+            ('flush_timeout', 'flush_timeout')]:
+                try:
+                    setattr(self, attr,
+                            options.config.getfloat("Notification", option))
+                except ValueError:
+                    logging.warn("Invalid value for %s in section "
+                                 "Notification", option)
+            self.retries = int(self.retries)
+            for attr in ['timeout', 'retries', 'backoff']:
+                self.mail[attr] = getattr(self, attr)
+
             # Transfer email options to Notifier
             if options.config.getboolean("Notification", 'send_mail'):
                 self.notifications['mail'] = True
-                self.mail['authenticate'] = \
-                options.config.getboolean("Mail", 'authenticate')
-                self.mail['sender'] =  options.config.get("Mail", 'from')
-                self.mail['username'] =  options.config.get("Mail", 'username')
-                self.mail['password'] =  options.config.get("Mail", 'password')
-                self.mail['smtp_server'] =  options.config.get("Mail", 'smtp')
+                self.mail.update(smtp_settings(options.config))
+                try:
+                    self.mail['digest'] \
+                    = options.config.getfloat("Mail", 'digest')
+                except ValueError:
+                    logging.warn("Invalid value for digest in section Mail")
                 if options.email_addresses is not None:
                     for item in options.email_addresses:
                         for address in item.split(","):
@@ -99,8 +130,17 @@ class Notifier:
                 while ( len(self.growl['passwords'])
                 < len(self.growl['hostnames']) ):
                     self.growl['passwords'].append(self.growl['passwords'][-1])
-                # Construct growl_notifiers
-                if gntp_notifier is None:
+                for option in ['registration_ttl', 'failure_ttl']:
+                    try:
+                        self.growl[option] \
+                        = options.config.getfloat("Growl", option)
+                    except ValueError:
+                        logging.warn("Invalid value for %s in section Growl",
+                                     option)
+                # Growl hosts are registered with on the first notification
+                try:
+                    import gntp.notifier
+                except ImportError:
                     logging.error("gntp module not availalble. Will not send "
                     "growl notifications")
                 else:
@@ -114,28 +154,44 @@ class Notifier:
                         except ValueError:
                             logging.debug("Can't parse port '%s'", port)
                             port = 23053
-                        password = self.growl['passwords'][i]
-                        growl_notifier = self._register_growl(hostname, port,
-                        password, force=True)
-                        if growl_notifier is not None:
-                            self._growl_notifiers.append(growl_notifier)
+                        self._growl_hosts.append((hostname, port,
+                                                  self.growl['passwords'][i]))
 
 
     def notify(self, condition, message=None):
         """ Send notification for the given condition COND_STRT, COND_STOP,
             COND_ABRT, or COND_ABER. If message is given, it is appended to the
-            auto-generated notification text
+            auto-generated notification text. The notification is delivered in
+            the background, and this method returns immediately.
         """
         logging.debug("Sending notification for condition %i", condition)
+        queue = get_queue()
+        queue.flush_timeout = self.flush_timeout
         if self.notifications['mail']:
-            self.notify_email(condition, message)
+            queue.put(self, self.notify_email, (condition, message))
         if self.notifications['growl']:
-            self.notify_growl(condition, message)
+            for i in xrange(len(self._growl_hosts)):
+                queue.put(self, self._notify_growl_host,
+                          (i, condition, message))
 
 
     def notify_growl(self, condition, message=None):
-        """ Send notification via growl """
+        """ Send notification via growl to all growl hosts, right away """
         logging.debug("Sending growl notification for condition %i", condition)
+        for i in xrange(len(self._growl_hosts)):
+            try:
+                self._notify_growl_host(i, condition, message)
+            except socket.error, error:
+                logging.warn("Can't connect to growl on %s",
+                              self._growl_hosts[i][0])
+                logging.debug("%s", error)
+
+
+    def _notify_growl_host(self, i, condition, message=None):
+        """ Send notification via growl to the growl host with the given index,
+            registering with the host if necessary. Raise a socket.error if
+            the host cannot be reached.
+        """
         titles = ["Begun execution", "Execution Terminated",
                   "Execution aborted", "Execution failed"]
         try:
@@ -145,19 +201,25 @@ class Notifier:
             logging.debug("Handling unknown codition in notify_growl")
             growl_type = self.growl_types[-1] # "Other"
             title = "LPBS"
-        for growl_notifier in self._growl_notifiers:
-            logging.debug("Sending growl notification to host %s",
-                          growl_notifier.hostname)
-            try:
-                if test_socket(growl_notifier.hostname, growl_notifier.port):
-                    growl_notifier.notify(noteType=growl_type, title=title,
-                    description=self._get_notify_description(condition,
-                    message), icon="", sticky=self.growl['sticky'],
-                    priority=1)
-            except socket.error, error:
-                logging.warn("Can't connect to growl on %s",
-                              growl_notifier.hostname)
-                logging.debug("%s", error)
+        if not self._growl_notifiers.has_key(i):
+            (hostname, port, password) = self._growl_hosts[i]
+            growl_notifier = self._register_growl(hostname, port, password)
+            if growl_notifier is None:
+                # unreachable; not retried before the failure_ttl expires
+                return
+            self._growl_notifiers[i] = growl_notifier
+        growl_notifier = self._growl_notifiers[i]
+        logging.debug("Sending growl notification to host %s",
+                      growl_notifier.hostname)
+        try:
+            growl_notifier.notify(noteType=growl_type, title=title,
+            description=self._get_notify_description(condition, message),
+            icon="", sticky=self.growl['sticky'], priority=1)
+        except socket.error:
+            del self._growl_notifiers[i]
+            update_growl_cache(growl_notifier.hostname, growl_notifier.port,
+                               None)
+            raise
 
 
     def _get_notify_description(self, condition, message=None):
@@ -179,94 +241,401 @@ class Notifier:
             description += "\n" + message
         return description
 
-    def _register_growl(self, hostname, port=23053, password='', force=False):
+    def _register_growl(self, hostname, port=23053, password=''):
         """ Return a GrowlNotifier that's registered with the given
-            hostname:port and the given password. If registration fails, return
-            None unless force is True, in which case the unregistered
-            GrowlNotifier is returned
+            hostname:port and the given password, or None if registration
+            fails. Registrations and failures are remembered in $LPBS_HOME for
+            'registration_ttl' and 'failure_ttl' seconds, respectively, so
+            that neither a working nor a dead host is contacted for every job
         """
-        logging.debug("Registering with growl on %s:%s", hostname, port)
-        growl_notifier = gntp_notifier.GrowlNotifier(
+        hostname = hostname.strip()
+        password = password.strip()
+        import gntp.notifier
+        import hashlib
+        growl_notifier = gntp.notifier.GrowlNotifier(
         applicationName="LPBS",
         notifications=self.growl_types,
         defaultNotifications=["Job Started"],
-        hostname=hostname.strip(),
+        hostname=hostname,
         port=port,
-        password=password.strip())
+        password=password)
+        signature = hashlib.sha1("\0".join([password] + self.growl_types)
+                                 ).hexdigest()
+        cached = read_growl_cache().get("%s:%s" % (hostname, port))
+        if cached is not None:
+            (cached_signature, timestamp) = cached
+            age = time.time() - timestamp
+            if cached_signature is None and age < self.growl['failure_ttl']:
+                logging.debug("Skipping growl on %s:%s, unreachable %is ago",
+                              hostname, port, age)
+                return None
+            if (cached_signature == signature
+            and age < self.growl['registration_ttl']):
+                logging.debug("Using cached growl registration for %s:%s",
+                              hostname, port)
+                return growl_notifier
+        logging.debug("Registering with growl on %s:%s", hostname, port)
         try:
-            if test_socket(hostname, port):
-                growl_notifier.register()
+            if not test_socket(hostname, port, self.timeout):
+                raise socket.error("Connection to %s:%s failed"
+                                   % (hostname, port))
+            growl_notifier.register()
         except socket.error, error:
-            logging.warn("Can't connect to growl on %s:%s",
-                          growl_notifier.hostname, port)
+            logging.warn("Can't connect to growl on %s:%s", hostname, port)
             logging.debug("%s", error)
-            if not force:
-                return None
+            update_growl_cache(hostname, port, None)
+            return None
         except gntp.BaseError, error:
             logging.warn("GNTP Exception")
             logging.debug("%s", error)
+            update_growl_cache(hostname, port, None)
             return None
+        update_growl_cache(hostname, port, signature)
         return growl_notifier
 
     def notify_email(self, condition, message=None):
-        """ Notify by email """
+        """ Notify by email, to all recipients at once. In digest mode, the
+            notification is added to the digest spool instead. Raise a
+            socket.error or smtplib.SMTPException if the mail cannot be sent
+        """
         if not self.mail['mail_conditions'][condition-1]:
             logging.debug("Skipping email notification for condition %i",
                           condition)
             return
+        if len(self.mail['recipients']) == 0:
+            return
         logging.debug("Sending email notification for condition %i", condition)
-        for recipient in self.mail['recipients']:
-            logging.debug("Sending email to %s", recipient)
-            msg = email.Message.Message()
-            fromaddr = self.mail['sender']
-            smpt_server = self.mail['smtp_server']
-
-            message_id = email.utils.make_msgid('lpbs')
-            msg.add_header("Subject", "LPBS JOB %s" % self.job_id)
-            msg.add_header("Message-Id", message_id)
-            msg.add_header("From", self.mail['from'])
-            msg.add_header("To", recipient)
-            if condition == COND_STRT:
-                self._message_id = message_id
-            else:
-                msg.add_header("In-Reply-To:", self._message_id)
-                msg.add_header("References:", self._message_id)
-            msg.set_charset("UTF-8")
-            description = self._get_notify_description(condition, message)
-            msg.set_payload(description, charset="UTF-8")
+        description = self._get_notify_description(condition, message)
+        if self.mail['digest'] > 0:
+            add_to_digest(self.mail, description)
+            return
+        import email.Message
+        import email.utils
+        msg = email.Message.Message()
+        message_id = email.utils.make_msgid('lpbs')
+        msg.add_header("Subject", "LPBS JOB %s" % self.job_id)
+        msg.add_header("Message-Id", message_id)
+        msg.add_header("From", self.mail['sender'])
+        msg.add_header("To", ", ".join(self.mail['recipients']))
+        if condition == COND_STRT:
+            self._message_id = message_id
+        elif self._message_id != '':
+            msg.add_header("In-Reply-To", self._message_id)
+            msg.add_header("References", self._message_id)
+        msg.set_charset("UTF-8")
+        msg.set_payload(description, charset="UTF-8")
+        send_mails(self.mail, [msg.as_string(), ])
+
+
+class NotificationQueue:
+    """ Bounded queue of notifications, delivered by a background thread """
+    def __init__(self):
+        """ Initialize; the thread is started with the first notification """
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.thread = None
+        self.flush_timeout = 30
+
+    def put(self, notifier, function, args):
+        """ Schedule the call function(*args), for delivering a notification
+            with the settings of the given notifier. If the queue is full, the
+            notification is dropped.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name="LPBS notifications")
+            self.thread.daemon = True
+            self.thread.start()
+        try:
+            self.queue.put_nowait((notifier, function, args))
+        except Queue.Full:
+            logging.warn("Notification queue is full, dropping notification "
+                         "for job %s", notifier.job_id)
 
+    def _run(self):
+        """ Deliver all notifications in the queue """
+        while True:
+            (notifier, function, args) = self.queue.get()
             try:
-                server = smtplib.SMTP(smpt_server)
-                if self.mail['use_tls']:
-                    server.starttls()
-                if self.mail['authenticate']:
-                    username = self.mail['username']
-                    password = self.mail['password']
-                    server.login(username, password)
-                server.sendmail(fromaddr, recipient, msg.as_string())
-                server.quit()
-            except socket.error, error:
-                logging.warn("Can't connect to smtp server")
-                logging.debug("%s", error)
-            except smtplib.SMTPAuthenticationError, error:
-                logging.warn("SMTP Authentication Error")
-                logging.debug("%s", error)
-            except smtplib.SMTPException, error:
-                logging.warn("SMTP Exception")
-                logging.debug("%s", error)
+                call_with_retries(function, args, notifier.retries,
+                                  notifier.backoff)
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout=None):
+        """ Wait until all notifications have been delivered, but at most for
+            timeout seconds (default: flush_timeout). Return True if the queue
+            is empty
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        deadline = time.time() + timeout
+        self.queue.all_tasks_done.acquire()
+        try:
+            while self.queue.unfinished_tasks > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warn("Gave up on %i pending notifications",
+                                 self.queue.unfinished_tasks)
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        finally:
+            self.queue.all_tasks_done.release()
+        return True
+
+
+def get_queue():
+    """ Return the NotificationQueue of the current process. The queue (and
+        its thread) is never shared across a fork
+    """
+    global _QUEUE
+    if _QUEUE is None or _QUEUE.pid != os.getpid():
+        _QUEUE = NotificationQueue()
+    return _QUEUE
 
 
-def test_socket(host, port, timeout=10):
-    """ Check if we can open a socket to the given host:port within the number
-        of seconds specified by timeout. Return True if a connection could be
-        made, False otherwise.
+def flush_notifications(timeout=None):
+    """ Wait until all notifications of the current process have been
+        delivered, but at most for the given timeout in seconds (default: the
+        'flush_timeout' in the [Notification] section of the config). This
+        must be called before leaving a process through os._exit; it is called
+        automatically at normal interpreter exit.
     """
-    sock = socket.socket()
+    if _QUEUE is not None and _QUEUE.pid == os.getpid():
+        return _QUEUE.flush(timeout)
+    return True
+
+atexit.register(flush_notifications)
+
+
+def call_with_retries(function, args, retries=3, backoff=2):
+    """ Call function(*args). If it raises a socket.error or an
+        smtplib.SMTPException, retry up to the given number of times, waiting
+        backoff seconds before the first retry and doubling the wait for every
+        further retry. Errors are logged
+    """
+    import smtplib
+    for attempt in xrange(retries + 1):
+        try:
+            function(*args)
+            return
+        except smtplib.SMTPAuthenticationError, error:
+            logging.warn("SMTP Authentication Error")
+            logging.debug("%s", error)
+            return
+        except socket.error, error:
+            logging.warn("Can't connect to notification server")
+            logging.debug("%s", error)
+        except smtplib.SMTPException, error:
+            logging.warn("SMTP Exception")
+            logging.debug("%s", error)
+        except Exception, error:
+            # e.g. gntp errors
+            logging.warn("Notification failed: %s", error)
+            return
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    logging.warn("Giving up on notification after %i retries", retries)
+
+
+def send_mails(mail, messages):
+    """ Send all messages (strings) to the recipients given in the mail
+        settings of a Notifier, over a single SMTP connection. Raise a
+        socket.error or smtplib.SMTPException on failure
+    """
+    import smtplib
+    logging.debug("Sending %i mails to %s", len(messages),
+                  ", ".join(mail['recipients']))
+    server = smtplib.SMTP(mail['smtp_server'], timeout=mail['timeout'])
     try:
-        sock.settimeout(timeout)
-        sock.connect((host, port))
-        return True
-    except socket.error, error:
-        logging.debug("test_socket(%s,%s,%s) failed: %s",
-                      host, port, timeout, error)
-        return False
+        if mail['use_tls']:
+            server.starttls()
+        if mail['authenticate']:
+            server.login(mail['username'], mail['password'])
+        for msg in messages:
+            server.sendmail(mail['sender'], mail['recipients'], msg)
+    finally:
+        try:
+            server.quit()
+        except (socket.error, smtplib.SMTPException):
+            server.close()
+
+
+def smtp_settings(config):
+    """ Return a dict of the settings in the [Mail] section of the given config
+        for connecting to the SMTP server, with the keys used in the mail
+        settings of a Notifier
+    """
+    return {'authenticate': config.getboolean("Mail", 'authenticate'),
+            'sender': config.get("Mail", 'from'),
+            'username': config.get("Mail", 'username'),
+            'password': config.get("Mail", 'password'),
+            'smtp_server': config.get("Mail", 'smtp'),
+            'use_tls': config.getboolean("Mail", 'tls')}
+
+
+def digest_spool():
+    """ Return the name of the spool file for digest mails """
+    return os.path.join(os.environ['LPBS_HOME'],
+                        "mail_digest.%s.spool" % getpass.getuser())
+
+
+def add_to_digest(mail, description):
+    """ Add the notification with the given description to the digest spool,
+        for the recipients in the mail settings of a Notifier. If the spool was
+        empty, start a background process that sends the digest after
+        mail['digest'] seconds. The spool is only readable by the user, and
+        holds no SMTP settings; these are read from the config when the digest
+        is sent
+    """
+    import json
+    spool_fd = os.open(digest_spool(), os.O_WRONLY|os.O_APPEND|os.O_CREAT,
+                       0600)
+    spool = os.fdopen(spool_fd, 'a')
+    try:
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        # a spool written by an earlier version may be readable by others
+        os.fchmod(spool_fd, 0600)
+        spool.seek(0, os.SEEK_END)
+        is_first = (spool.tell() == 0)
+        spool.write(json.dumps({'recipients': mail['recipients'],
+                                'text': description}) + "\n")
+        spool.flush()
+    finally:
+        spool.close()
+    if is_first:
+        # a new interpreter, as it is not safe to fork from a threaded process
+        import subprocess
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(
+                      os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([package_dir]
+                            + env.get('PYTHONPATH', '').split(os.pathsep))
+        devnull = open(os.devnull, 'r+')
+        subprocess.Popen([sys.executable, '-c', 'from LPBS.Notifications '
+                         'import send_digest; send_digest(%r)'
+                         % mail['digest']], env=env, close_fds=True,
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         preexec_fn=os.setsid)
+        devnull.close()
+
+
+def send_digest(delay=0):
+    """ Wait for delay seconds, then send all notifications in the digest
+        spool, as a single mail for each set of recipients. The SMTP server
+        and the delivery settings are taken from the config in $LPBS_HOME and
+        $HOME
+    """
+    import json
+    from LPBS.Config import get_config
+    time.sleep(delay)
+    try:
+        spool = open(digest_spool(), 'r+')
+    except IOError:
+        return
+    entries = []
+    try:
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        for line in spool:
+            try:
+                entry = json.loads(line)
+                entries.append((tuple(address.encode('utf-8') for address
+                                      in entry['recipients']),
+                                entry['text'].encode('utf-8')))
+            except (ValueError, KeyError, TypeError, AttributeError), error:
+                logging.warn("Corrupt entry in digest spool: %s", error)
+        spool.truncate(0)
+    finally:
+        spool.close()
+    if len(entries) == 0:
+        return
+    config = get_config(None)
+    mail = smtp_settings(config)
+    mail.update({'timeout': 10, 'retries': 3, 'backoff': 2})
+    for option in ['timeout', 'retries', 'backoff']:
+        try:
+            mail[option] = config.getfloat("Notification", option)
+        except ValueError:
+            logging.warn("Invalid value for %s in section Notification",
+                         option)
+    mail['retries'] = int(mail['retries'])
+    import email.Message
+    import email.utils
+    digests = {} # recipients => list of descriptions
+    for (recipients, description) in entries:
+        digests.setdefault(recipients, []).append(description)
+    for (recipients, descriptions) in digests.items():
+        mail['recipients'] = list(recipients)
+        msg = email.Message.Message()
+        msg.add_header("Subject", "LPBS digest: %i notifications"
+                       % len(descriptions))
+        msg.add_header("Message-Id", email.utils.make_msgid('lpbs'))
+        msg.add_header("From", mail['sender'])
+        msg.add_header("To", ", ".join(recipients))
+        msg.set_charset("UTF-8")
+        msg.set_payload(("\n" + "-" * 72 + "\n\n").join(descriptions),
+                        charset="UTF-8")
+        call_with_retries(send_mails, (dict(mail), [msg.as_string(), ]),
+                          mail['retries'], mail['backoff'])
+
+
+def growl_cache_file():
+    """ Return the name of the file holding the state of the registrations
+        with Growl hosts
+    """
+    return os.path.join(os.environ['LPBS_HOME'],
+                        "growl.%s.cache" % getpass.getuser())
+
+
+def read_growl_cache():
+    """ Return a dict 'hostname:port' => (signature, timestamp) of all Growl
+        hosts LPBS registered with (signature is a hash of the registration
+        data), or failed to register with (signature is None)
+    """
+    try:
+        cache_fh = open(growl_cache_file(), 'r')
+    except IOError:
+        return {}
+    try:
+        fcntl.flock(cache_fh, fcntl.LOCK_SH)
+        return _decode_growl_cache(cache_fh.read())
+    finally:
+        cache_fh.close()
+
+
+def _decode_growl_cache(data):
+    """ Return the dict stored as JSON in the given data of the growl cache
+        file, or an empty dict if the data is not valid
+    """
+    import json
+    try:
+        cache = json.loads(data)
+    except ValueError:
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def update_growl_cache(hostname, port, signature):
+    """ Record a successful registration with the given signature (or a failed
+        one, if signature is None) with the Growl host hostname:port. The cache
+        file is only readable by the user
+    """
+    import json
+    try:
+        cache_fd = os.open(growl_cache_file(), os.O_RDWR|os.O_CREAT, 0600)
+    except OSError, error:
+        logging.debug("Can't write growl cache: %s", error)
+        return
+    cache_fh = os.fdopen(cache_fd, 'r+')
+    try:
+        fcntl.flock(cache_fh, fcntl.LOCK_EX)
+        cache = _decode_growl_cache(cache_fh.read())
+        cache["%s:%s" % (hostname, port)] = (signature, time.time())
+        cache_fh.seek(0)
+        cache_fh.truncate(0)
+        cache_fh.write(json.dumps(cache))
+        cache_fh.flush()
+    finally:
+        cache_fh.close()
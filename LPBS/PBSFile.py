@@ -19,26 +19,89 @@
 #    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
 ############################################################################
 
-""" Work with PBS script files """
+""" Work with PBS script files
 
+    A submitted script is read only once, into memory: its directives are
+    parsed from that buffer, and the copy that the job runs is written from it
+    as well, so that the job runs exactly the script whose directives were
+    parsed.
+"""
+
+import os
 import shlex
 import logging
 
+DEFAULT_PREFIX = '#PBS'
+
+class PBSScript:
+    """ The content of a PBS script """
+    def __init__(self, path):
+        """ Read the script at path. Raise an IOError if it cannot be read """
+        self.path = path
+        self.name = os.path.basename(path)
+        script_fh = open(path, 'rb')
+        try:
+            self.content = script_fh.read()
+        finally:
+            script_fh.close()
+
+    def directives(self, prefix=DEFAULT_PREFIX):
+        """ Return the list of arguments given in the directives of the script
+            that start with the given prefix. The directives are the lines
+            after the shebang up to the first line that is neither blank nor a
+            directive. If prefix is empty, return an empty list
+        """
+        if prefix == '':
+            return []
+        opt_string = ''
+        start = 0
+        while start < len(self.content):
+            end = self.content.find('\n', start)
+            if end < 0:
+                end = len(self.content)
+            line = self.content[start:end+1]
+            start = end + 1
+            if line.startswith('#!'):
+                continue
+            if line.strip() == (''):
+                continue
+            if not (line.startswith(prefix)
+            and line[len(prefix):len(prefix)+1] in (' ', '\t')):
+                break
+            opt_string += line[len(prefix):]
+        logging.debug("opt_string extracted from PBS file:\n%s", opt_string)
+        return shlex.split(opt_string)
+
+    def write_copy(self, path):
+        """ Write the script to path, atomically, as an executable file only
+            accessible by the current user
+        """
+        temp_file = "%s.%i" % (path, os.getpid())
+        script_fh = os.fdopen(os.open(temp_file,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o700),
+                              'wb')
+        try:
+            script_fh.write(self.content)
+        finally:
+            script_fh.close()
+        os.rename(temp_file, path)
+
+
+def directive_prefix(options):
+    """ Return the directive prefix given with the -C option in options, or
+        else in the environment variable $PBS_DPREFIX, or the default '#PBS'
+    """
+    prefix = getattr(options, 'directive_prefix', None)
+    if prefix is None:
+        prefix = os.environ.get('PBS_DPREFIX', DEFAULT_PREFIX)
+    return prefix.strip()
+
+
 def set_options_from_pbs_script(arg_parser, options, pbs_script):
-    """ Add directives in pbs_script to existing options, using arg_parser
+    """ Add directives in pbs_script (a PBSScript instance, or the name of the
+        script file) to existing options, using arg_parser
     """
-    opt_string = ''
-    pbs_fh = open(pbs_script)
-    for line in pbs_fh:
-        if line.startswith('#!'):
-            continue
-        if line.strip() == (''):
-            continue
-        if not line.startswith('#PBS '):
-            break
-        opt_string += line.replace('#PBS', '', 1)
-    pbs_fh.close()
-    logging.debug("opt_string extracted from PBS file:\n%s", opt_string)
-    argv = shlex.split(opt_string)
+    if not isinstance(pbs_script, PBSScript):
+        pbs_script = PBSScript(pbs_script)
+    argv = pbs_script.directives(directive_prefix(options))
     options, args = arg_parser.parse_args(argv, options)
-
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+
+""" Profiling of the LPBS command line tools, and timing of the phases of the
+    submission and startup of jobs
+
+    Every tool that is run with the option --profile writes the statistics of
+    cProfile for its process to the folder 'profile' in $LPBS_HOME, as
+    <tool>.<time>.<pid>.prof, to be read e.g. with the pstats module. A
+    process forked by the tool (such as the process supervising a job
+    submitted with lqsub) writes its own file when it exits.
+
+    The phase timers are always on: the durations of the phases of submitting
+    and starting a job are stored with the job (see JobInfo.startup_phases),
+    logged, and shown by 'lqstat -f' as 'startup_time'.
+"""
+
+import os
+import sys
+import time
+import logging
+
+PROFILE_DIR = 'profile' # folder for the statistics, inside $LPBS_HOME
+
+
+class PhaseTimer:
+    """ Durations of the consecutive phases of an operation """
+    def __init__(self):
+        """ Initialize, starting the first phase """
+        self.phases = [] # list of [name, seconds]
+        self.last = time.time()
+
+    def mark(self, name):
+        """ End the current phase, recording it under the given name, and
+            start the next one
+        """
+        now = time.time()
+        self.phases.append([name, now - self.last])
+        self.last = now
+
+
+def format_phases(phases):
+    """ Return a one-line description of the given list of phases, as in
+        PhaseTimer.phases
+    """
+    total = sum([seconds for (name, seconds) in phases])
+    return "%.3fs (%s)" % (total, ", ".join(["%s %.3fs" % (name, seconds)
+                                            for (name, seconds) in phases]))
+
+
+def profile_file(prog):
+    """ Return the name of the file for the profiling statistics of the
+        current process, for the tool prog
+    """
+    return os.path.join(os.environ['LPBS_HOME'], PROFILE_DIR, "%s.%s.%i.prof"
+                        % (prog, time.strftime('%Y%m%d%H%M%S'), os.getpid()))
+
+
+def profiled(main, argv=None):
+    """ Return the result of calling main(argv). If the option --profile is in
+        argv (default: sys.argv), main is run under cProfile, and the
+        statistics are written to $LPBS_HOME, in the current process and in
+        any process forked by main that returns from it
+    """
+    if argv is None:
+        argv = sys.argv
+    if not '--profile' in argv[1:] or not os.environ.has_key('LPBS_HOME'):
+        return main(argv)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(main, argv)
+    finally:
+        outfile = profile_file(os.path.basename(argv[0]))
+        try:
+            if not os.path.isdir(os.path.dirname(outfile)):
+                try:
+                    os.makedirs(os.path.dirname(outfile))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(outfile)):
+                        raise
+            profiler.dump_stats(outfile)
+            logging.info("Wrote profile to %s", outfile)
+        except (IOError, OSError), error:
+            print >> sys.stderr, "Cannot write profile: %s" % error
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Time series of the resource usage of a job, in a fixed-size ring file
+
+    The file $LPBS_HOME/<job_id>.res consists of a header, followed by space
+    for a fixed number of samples. Once the file is full, the oldest samples are
+    overwritten. The header keeps the totals over the entire run of the job
+    (peak memory, CPU time, number of threads), which remain available after
+    the job has finished.
+"""
+
+import os
+import struct
+import logging
+
+MAGIC = 'LPBSRES1'
+
+# magic, capacity, number of samples written, requested cores, start time,
+# time of last sample, end time (0 while running), CPU time at last sample,
+# peak memory, peak virtual memory, peak threads, sum of threads of all samples
+HEADER = struct.Struct('!8sIIIddddQQIQ')
+
+# time, CPU time in seconds, memory, virtual memory (in bytes), threads
+RECORD = struct.Struct('!ddQQI')
+
+
+def sampling_interval(config):
+    """ Return the interval in seconds at which the resource usage of running
+        jobs is sampled, according to the [Monitoring] section of the config
+        (0 if sampling is disabled)
+    """
+    try:
+        return max(0.0, config.getfloat('Monitoring', 'interval'))
+    except ValueError:
+        logging.warn("Invalid value for interval in section Monitoring")
+        return 0.0
+
+
+def sample_capacity(config):
+    """ Return the number of samples kept in the ring file of a job """
+    try:
+        return max(1, config.getint('Monitoring', 'samples'))
+    except ValueError:
+        logging.warn("Invalid value for samples in section Monitoring")
+        return 1440
+
+
+def resource_log_file(job_id):
+    """ Return the name of the ring file for the given job ID """
+    return os.path.join(os.environ['LPBS_HOME'], "%s.res" % job_id)
+
+
+class ResourceLog:
+    """ Writer and reader for the ring file of a single job """
+    def __init__(self, filename, capacity=None, cores=1, start_time=0):
+        """ Open the given ring file. If capacity is given, a new file is
+            created for that number of samples, for a job with the given number
+            of requested cores that started at start_time. Otherwise, an
+            existing file is opened for reading. Raise an IOError if the file
+            cannot be opened, or is not a valid ring file
+        """
+        self.filename = filename
+        if capacity is not None:
+            self.fh = open(filename, 'w+b')
+            self.capacity = max(1, int(capacity))
+            self.count = 0
+            self.cores = max(1, int(cores))
+            self.start_time = start_time
+            self.last_time = start_time
+            self.end_time = 0
+            self.last_cput = 0.0
+            self.max_mem = 0
+            self.max_vmem = 0
+            self.max_threads = 0
+            self.sum_threads = 0
+            self._write_header()
+        else:
+            self.fh = open(filename, 'rb')
+            self._read_header()
+
+    def _read_header(self):
+        """ Load the header from the file """
+        data = self.fh.read(HEADER.size)
+        try:
+            (magic, self.capacity, self.count, self.cores, self.start_time,
+             self.last_time, self.end_time, self.last_cput, self.max_mem,
+             self.max_vmem, self.max_threads, self.sum_threads) \
+             = HEADER.unpack(data)
+        except struct.error:
+            raise IOError("Truncated resource log %s" % self.filename)
+        if magic != MAGIC:
+            raise IOError("%s is not a resource log" % self.filename)
+
+    def _write_header(self):
+        """ Write the header to the file """
+        self.fh.seek(0)
+        self.fh.write(HEADER.pack(MAGIC, self.capacity, self.count,
+                      self.cores, self.start_time, self.last_time,
+                      self.end_time, self.last_cput, self.max_mem,
+                      self.max_vmem, self.max_threads, self.sum_threads))
+        self.fh.flush()
+
+    def add(self, timestamp, cput, mem, vmem, threads):
+        """ Add a sample, overwriting the oldest one if the file is full """
+        self.fh.seek(HEADER.size + (self.count % self.capacity) * RECORD.size)
+        self.fh.write(RECORD.pack(timestamp, cput, mem, vmem, threads))
+        self.count += 1
+        self.last_time = timestamp
+        self.last_cput = max(self.last_cput, cput)
+        self.max_mem = max(self.max_mem, mem)
+        self.max_vmem = max(self.max_vmem, vmem)
+        self.max_threads = max(self.max_threads, threads)
+        self.sum_threads += threads
+        self._write_header()
+
+    def close(self, end_time=None):
+        """ Close the file. If end_time is given, it is recorded as the time
+            at which the job finished
+        """
+        if end_time is not None:
+            self.end_time = end_time
+            self._write_header()
+        self.fh.close()
+
+    def samples(self):
+        """ Return a list of tuples (time, cput, mem, vmem, threads) for all
+            samples in the file, oldest first
+        """
+        stored = min(self.count, self.capacity)
+        self.fh.seek(HEADER.size)
+        data = self.fh.read(stored * RECORD.size)
+        records = [RECORD.unpack_from(data, i * RECORD.size)
+                   for i in xrange(len(data) / RECORD.size)]
+        first = self.count % self.capacity
+        if self.count > self.capacity:
+            records = records[first:] + records[:first]
+        return records
+
+    def summary(self):
+        """ Return a dict with the totals over the entire run of the job:
+            'walltime' (seconds, up to the end of the job or the last sample),
+            'cput' (seconds), 'maxmem', 'maxvmem' (bytes), 'maxthreads',
+            'avgthreads', 'cpu_utilization' (mean number of busy cores),
+            'cpu_efficiency' (cpu_utilization divided by the requested
+            'cores'), and 'samples' (number of samples taken)
+        """
+        end_time = self.end_time
+        if end_time == 0:
+            end_time = self.last_time
+        walltime = max(0.0, end_time - self.start_time)
+        result = {'walltime': walltime, 'cput': self.last_cput,
+                  'cores': self.cores,
+                  'maxmem': self.max_mem, 'maxvmem': self.max_vmem,
+                  'maxthreads': self.max_threads, 'samples': self.count,
+                  'avgthreads': 0.0, 'cpu_utilization': 0.0,
+                  'cpu_efficiency': 0.0}
+        if self.count > 0:
+            result['avgthreads'] = float(self.sum_threads) / self.count
+        if walltime > 0:
+            result['cpu_utilization'] = self.last_cput / walltime
+            result['cpu_efficiency'] = result['cpu_utilization'] / self.cores
+        return result
+
+
+def read_summary(job_id):
+    """ Return the summary dict of the ring file of the given job ID, or None
+        if the job has no (valid) ring file
+    """
+    try:
+        resource_log = ResourceLog(resource_log_file(job_id))
+    except IOError:
+        return None
+    try:
+        return resource_log.summary()
+    finally:
+        resource_log.close()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Schedule jobs on a local pool of cores and memory
+
+    Queued jobs are kept in the job registry with status 'Q', together with
+    everything that is necessary to start them. No process waits for a queued
+    job: whenever a job is submitted or finishes, the queue is checked and all
+    jobs that fit into the free resources are claimed (status 'R') and started
+    by the calling process. Jobs that wait for other jobs to end are held in
+    the registry with status 'H' until they are released into the queue (see
+    LPBS.Dependencies). Released jobs are queued even if the scheduler is
+    disabled, in which case they are started right away.
+"""
+
+import os
+import re
+import getpass
+import logging
+import cPickle as pickle
+from LPBS.JobRegistry import get_registry
+from LPBS.JobUtils import pid_is_alive
+from LPBS.Dependencies import record_exit, EXIT_DELETED
+from LPBS.Accounting import write_records, deleted_record
+
+MEMORY_UNITS = {'b': 1, 'w': 8, 'kb': 1024, 'kw': 8192, 'mb': 1024**2,
+                'mw': 8 * 1024**2, 'gb': 1024**3, 'gw': 8 * 1024**3,
+                'tb': 1024**4, 'tw': 8 * 1024**4}
+
+
+def scheduler_enabled(config):
+    """ Return True if jobs are to be queued by the scheduler """
+    return config.getboolean('Scheduler', 'enabled')
+
+
+def parse_memory(value):
+    """ Convert a memory specification such as '2gb' or '512mb' (or a plain
+        number of bytes) to an integer number of bytes. Raise a ValueError if
+        the value cannot be parsed.
+    """
+    match = re.match(r'^\s*(\d+)\s*([kmgt]?[bw])?\s*$', str(value), re.I)
+    if not match:
+        raise ValueError("Invalid memory specification '%s'" % value)
+    unit = match.group(2)
+    if unit is None:
+        unit = 'b'
+    return int(match.group(1)) * MEMORY_UNITS[unit.lower()]
+
+
+def parse_resource_list(resource_list):
+    """ Return a dict of resource names to values from the list of
+        RESOURCE_LIST strings passed to the '-l' option of lqsub, e.g.
+        ['nodes=1:ppn=4', 'mem=2gb,walltime=01:00:00']
+    """
+    resources = {}
+    if resource_list is None:
+        return resources
+    for item in resource_list:
+        for resource in item.split(','):
+            resource = resource.strip()
+            if resource == '':
+                continue
+            if '=' in resource:
+                name, value = resource.split('=', 1)
+                resources[name.strip()] = value.strip()
+            else:
+                resources[resource] = ''
+    return resources
+
+
+def requested_cores(resources):
+    """ Return the number of cores requested by the given dict of resources,
+        from the 'nodes' (e.g. 'nodes=2:ppn=4', or 'nodes=1:ppn=2+1:ppn=4'),
+        'procs', or 'ncpus' resource. Since all jobs run on the local machine,
+        all nodes count towards the number of cores. Raise a ValueError if the
+        request cannot be parsed.
+    """
+    if resources.has_key('nodes'):
+        cores = 0
+        for node_spec in resources['nodes'].split('+'):
+            properties = node_spec.split(':')
+            try:
+                nodes = int(properties[0])
+            except ValueError:
+                nodes = 1 # node given by name
+            ppn = 1
+            for prop in properties[1:]:
+                if prop.startswith('ppn='):
+                    ppn = int(prop[4:])
+            cores += nodes * ppn
+        return cores
+    for name in ['procs', 'ncpus']:
+        if resources.has_key(name):
+            return int(resources[name])
+    return 1
+
+
+def requested_memory(resources):
+    """ Return the number of bytes of memory requested by the given dict of
+        resources (0 if no memory was requested). Raise a ValueError if the
+        request cannot be parsed.
+    """
+    for name in ['mem', 'pmem']:
+        if resources.has_key(name):
+            return parse_memory(resources[name])
+    return 0
+
+
+def resource_request(resource_list):
+    """ Return tuple (resources, cores, mem) for the list of RESOURCE_LIST
+        strings passed to the '-l' option of lqsub, where resources is the
+        dict returned by parse_resource_list, and cores and mem are the
+        requested number of cores and bytes of memory. Raise a ValueError if
+        the request cannot be parsed.
+    """
+    resources = parse_resource_list(resource_list)
+    return (resources, requested_cores(resources), requested_memory(resources))
+
+
+def get_pool(config):
+    """ Return tuple (cores, mem) of the number of cores and bytes of memory
+        available to the scheduler, according to the [Scheduler] section of the
+        config. A value of None for mem means that the memory is unlimited
+    """
+    try:
+        cores = config.getint('Scheduler', 'cores')
+    except ValueError:
+        logging.warn("Invalid value for cores in section Scheduler")
+        cores = 0
+    if cores <= 0:
+        import multiprocessing
+        cores = multiprocessing.cpu_count()
+    try:
+        mem = parse_memory(config.get('Scheduler', 'memory'))
+    except ValueError, error:
+        logging.warn("%s in section Scheduler", error)
+        mem = 0
+    if mem <= 0:
+        try:
+            mem = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            mem = None
+    return (cores, mem)
+
+
+def queue_job(job_info, spec):
+    """ Put the job described by job_info into the queue. The spec is stored
+        with the job, and returned by claim_jobs when the job can be started
+    """
+    job_info.status = 'Q'
+    job_info.pid = None
+    get_registry().add(job_info, spec)
+    logging.info("Queued job %s (%s cores, %s bytes)", job_info.job_id,
+                 job_info.req_cores, job_info.req_mem)
+
+
+def remove_queued_jobs(job_id=None, owner=None):
+    """ Remove all queued and held jobs that match the given job identifier
+        and owner (default: current user) from the queue. Return a list of the
+        removed job IDs
+    """
+    if owner is None:
+        owner = getpass.getuser()
+    registry = get_registry()
+    removed = [] # tuples (job_id, owner)
+    for status in ('Q', 'H'):
+        queued = registry.lookup_owners(job_id, owner, status=status)
+        for (queued_job_id, job_owner) in queued:
+            if registry.remove(queued_job_id, status=status):
+                logging.info("Removed job %s from queue", queued_job_id)
+                removed.append((queued_job_id, job_owner))
+                script_copy = os.path.join(registry.lpbs_home,
+                                           "%s.SC" % queued_job_id)
+                try:
+                    os.unlink(script_copy)
+                except OSError:
+                    pass
+                record_exit(queued_job_id, EXIT_DELETED)
+    write_records([deleted_record(queued_job_id, job_owner)
+                   for (queued_job_id, job_owner) in removed])
+    return [queued_job_id for (queued_job_id, job_owner) in removed]
+
+
+def claim_jobs(config, owner=None):
+    """ Return a list of tuples (job_id, spec) for all queued jobs of the
+        given owner (default: current user) that fit into the currently free
+        resources, after marking them as running in the registry.
+
+        Jobs are considered in FIFO order. If backfill is enabled in the
+        config, jobs may skip ahead of earlier jobs that don't fit (yet). If
+        the scheduler is disabled, all queued jobs are claimed.
+    """
+    if owner is None:
+        owner = getpass.getuser()
+    connection = get_registry().connection
+    claimed = []
+    if len(connection.execute("SELECT 1 FROM jobs WHERE status = 'Q' AND "
+    "owner = ? LIMIT 1", (owner, )).fetchall()) == 0:
+        return claimed
+    if scheduler_enabled(config):
+        (pool_cores, pool_mem) = get_pool(config)
+    else:
+        (pool_cores, pool_mem) = (float('inf'), None)
+    backfill = config.getboolean('Scheduler', 'backfill')
+    with connection:
+        # lock the registry against other schedulers
+        connection.execute("BEGIN IMMEDIATE")
+        used_cores = 0
+        used_mem = 0
+        for (pid, cores, mem) in connection.execute(
+        "SELECT pid, cores, mem FROM jobs WHERE status = 'R'"):
+            # pid is None for jobs that have been claimed, but not started
+            if pid is not None and not pid_is_alive(pid):
+                continue
+            used_cores += (cores or 0)
+            used_mem += (mem or 0)
+        queued = connection.execute(
+                 "SELECT job_id, owner, cores, mem, spec FROM jobs "
+                 "WHERE status = 'Q' ORDER BY seq").fetchall()
+        for (job_id, job_owner, cores, mem, spec) in queued:
+            fits = (used_cores + cores <= pool_cores)
+            if pool_mem is not None:
+                fits = fits and (used_mem + mem <= pool_mem)
+            if fits and job_owner == owner:
+                connection.execute("UPDATE jobs SET status = 'R' "
+                                   "WHERE job_id = ?", (job_id, ))
+                used_cores += cores
+                used_mem += mem
+                claimed.append((job_id, pickle.loads(str(spec))))
+                logging.debug("Claimed job %s from queue", job_id)
+            elif not backfill:
+                break
+    return claimed
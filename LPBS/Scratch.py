@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Deferred removal of the scratch folders of finished jobs
+
+    The process supervising a job does not delete the job's scratch folder
+    itself: it renames the folder into the trash folder inside the scratch
+    root, and leaves the deletion to a reaper process that runs in the
+    background at the lowest CPU and I/O priority. At most one reaper runs for
+    every trash folder.
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import logging
+
+TRASH_DIR = '.lpbs_trash' # name of the trash folder inside the scratch root
+LOCK_FILE = '.lock' # held by the running reaper
+STATUS_FILE = '.status' # progress of the running reaper
+STATUS_INTERVAL = 1.0 # seconds between updates of the status file
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# machine => number of the ioprio_set system call
+SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                  'armv7l': 314, 'ppc64le': 273}
+
+
+def trash_folder(scratch_root):
+    """ Return the trash folder for the given scratch root """
+    return os.path.join(scratch_root, TRASH_DIR)
+
+
+def lock_trash(trash):
+    """ Try to obtain the reaper lock for the given trash folder. Return the
+        open lock file, or None if another process holds the lock
+    """
+    lock_fh = open(os.path.join(trash, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, error:
+        lock_fh.close()
+        if error.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_fh
+
+
+def trash_entries(trash):
+    """ Return the names of all folders in the given trash folder that are
+        waiting to be deleted
+    """
+    try:
+        return sorted([name for name in os.listdir(trash)
+                       if not name.startswith('.')])
+    except OSError:
+        return []
+
+
+def discard_scratch(job_scratch):
+    """ Move the given scratch folder into the trash, and make sure a reaper
+        is running to delete it. If the folder cannot be moved, delete it
+        right away
+    """
+    trash = trash_folder(os.path.dirname(os.path.abspath(job_scratch)))
+    target = os.path.join(trash, "%s.%i.%i" % (os.path.basename(job_scratch),
+                                               time.time(), os.getpid()))
+    try:
+        if not os.path.isdir(trash):
+            try:
+                os.mkdir(trash)
+            except OSError, error:
+                if error.errno != errno.EEXIST:
+                    raise
+        os.rename(job_scratch, target)
+    except OSError, error:
+        logging.debug("Cannot move %s to trash: %s", job_scratch, error)
+        shutil.rmtree(job_scratch, ignore_errors=True)
+        return
+    try:
+        start_reaper(trash)
+    except (IOError, OSError), error:
+        logging.warn("Cannot start scratch reaper for %s: %s", trash, error)
+
+
+def start_reaper(trash):
+    """ Start a reaper for the given trash folder in the background, unless
+        one is running already
+    """
+    lock_fh = lock_trash(trash)
+    if lock_fh is None:
+        # the running reaper looks for new entries before it exits
+        return
+    lock_fh.close()
+    import subprocess
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir]
+                        + env.get('PYTHONPATH', '').split(os.pathsep))
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, '-c', 'from LPBS.Scratch import reap; '
+                     'reap(%r)' % trash], env=env, close_fds=True,
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     preexec_fn=os.setsid)
+    devnull.close()
+
+
+def set_idle_priority():
+    """ Lower the CPU and I/O priority of the current process as far as
+        possible. Failures are ignored
+    """
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+    syscall = SYS_IOPRIO_SET.get(os.uname()[4])
+    if syscall is None:
+        return
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0,
+                     IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except (ImportError, OSError, AttributeError):
+        pass
+
+
+class ReaperStatus:
+    """ Progress of a reaper, written to the status file in the trash folder
+    """
+    def __init__(self, trash):
+        self.status_file = os.path.join(trash, STATUS_FILE)
+        self.entry = ''
+        self.removed = 0 # files and folders removed in the current entry
+        self.total_removed = 0 # files and folders removed by this reaper
+        self.started = time.time()
+        self.last_write = 0
+
+    def count(self, entry=None):
+        """ Count one removed file or folder, or the start of the given trash
+            entry, and update the status file if it has not been updated for
+            STATUS_INTERVAL seconds
+        """
+        if entry is not None:
+            self.entry = entry
+            self.removed = 0
+        else:
+            self.removed += 1
+            self.total_removed += 1
+        if time.time() - self.last_write >= STATUS_INTERVAL:
+            self.write()
+
+    def write(self):
+        """ Write the status file """
+        temp_file = "%s.%i" % (self.status_file, os.getpid())
+        try:
+            status_fh = open(temp_file, 'w')
+            status_fh.write("pid: %i\nstarted: %.0f\nentry: %s\nremoved: %i\n"
+                            "total_removed: %i\n" % (os.getpid(),
+                            self.started, self.entry, self.removed,
+                            self.total_removed))
+            status_fh.close()
+            os.rename(temp_file, self.status_file)
+        except (IOError, OSError):
+            pass
+        self.last_write = time.time()
+
+    def clear(self):
+        """ Remove the status file """
+        try:
+            os.unlink(self.status_file)
+        except OSError:
+            pass
+
+
+def remove_tree(path, status):
+    """ Delete the folder at path with everything in it, counting every
+        removed file and folder in status. Return True if the folder was
+        removed completely
+    """
+    def make_writable(error):
+        """ Let the owner modify folders that the job made read-only """
+        if error.filename is not None:
+            try:
+                os.chmod(error.filename, 0o700)
+            except OSError:
+                pass
+    for (dirpath, dirnames, filenames) in os.walk(path, topdown=True,
+                                                  onerror=make_writable):
+        for dirname in dirnames:
+            try:
+                # os.walk must be able to list and empty sub-folders
+                os.chmod(os.path.join(dirpath, dirname), 0o700)
+            except OSError:
+                pass
+        for filename in filenames:
+            try:
+                os.unlink(os.path.join(dirpath, filename))
+                status.count()
+            except OSError:
+                pass
+    for (dirpath, dirnames, filenames) in os.walk(path, topdown=False):
+        for name in dirnames + filenames:
+            try:
+                # symlinks to folders, and files that appeared meanwhile
+                full_path = os.path.join(dirpath, name)
+                if os.path.isdir(full_path) and not os.path.islink(full_path):
+                    os.rmdir(full_path)
+                else:
+                    os.unlink(full_path)
+                status.count()
+            except OSError:
+                pass
+    try:
+        os.rmdir(path)
+        status.count()
+    except OSError:
+        return False
+    return True
+
+
+def reap(trash):
+    """ Delete everything in the given trash folder, at idle priority, unless
+        another reaper is already running for it. Return when the trash folder
+        is empty
+    """
+    lock_fh = lock_trash(trash)
+    if lock_fh is None:
+        return
+    set_idle_priority()
+    status = ReaperStatus(trash)
+    failed = set() # entries that cannot be deleted
+    try:
+        while True:
+            entries = [name for name in trash_entries(trash)
+                       if not name in failed]
+            if len(entries) == 0:
+                # a job may have added an entry while its check for a
+                # running reaper found us
+                status.clear()
+                lock_fh.close()
+                entries = [name for name in trash_entries(trash)
+                           if not name in failed]
+                if len(entries) == 0:
+                    return
+                lock_fh = lock_trash(trash)
+                if lock_fh is None:
+                    return
+            for entry in entries:
+                status.count(entry)
+                path = os.path.join(trash, entry)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    removed = remove_tree(path, status)
+                else:
+                    try:
+                        os.unlink(path)
+                        removed = True
+                    except OSError:
+                        removed = False
+                if not removed:
+                    failed.add(entry)
+    finally:
+        if lock_fh is not None and not lock_fh.closed:
+            status.clear()
+            lock_fh.close()
+
+
+def scratch_status(scratch_root):
+    """ Return a dictionary with the status of the deferred removal of scratch
+        folders in the given scratch root, with the keys 'trash' (the trash
+        folder), 'backlog' (list of entries waiting to be deleted), and
+        'reaper' (None if no reaper is running, otherwise a dictionary with
+        the keys 'pid', 'started', 'entry', 'removed', 'total_removed')
+    """
+    trash = trash_folder(scratch_root)
+    result = {'trash': trash, 'backlog': trash_entries(trash),
+              'reaper': None}
+    if not os.path.isdir(trash):
+        return result
+    try:
+        lock_fh = lock_trash(trash)
+    except IOError:
+        return result
+    if lock_fh is not None:
+        lock_fh.close()
+        return result
+    reaper = {'pid': 0, 'started': 0, 'entry': '', 'removed': 0,
+              'total_removed': 0}
+    try:
+        status_fh = open(os.path.join(trash, STATUS_FILE))
+        try:
+            for line in status_fh:
+                if not ':' in line:
+                    continue
+                key, value = line.split(':', 1)
+                key = key.strip()
+                value = value.strip()
+                if reaper.has_key(key):
+                    if key == 'entry':
+                        reaper[key] = value
+                    else:
+                        reaper[key] = int(value)
+        finally:
+            status_fh.close()
+    except (IOError, ValueError):
+        pass
+    result['reaper'] = reaper
+    return result
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+""" Stage files into the scratch folder of a job before it starts, and out of
+    it after it has finished, as requested with 'lqsub -W stagein=...' and
+    'lqsub -W stageout=...'
+
+    Staged-in files are kept in a store inside the scratch root, one read-only
+    file per distinct content (named by its SHA1 hash), and are hard-linked
+    into the scratch folder of every job that needs them. Files are copied
+    through reflinks where the filesystem supports them, and by a pool of
+    threads.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+
+FICLONE = 0x40049409 # ioctl for reflinks (btrfs, xfs)
+BLOCK_SIZE = 1048576
+STORE_DIR = '.lpbs_stage' # name of the store inside the scratch root
+
+
+def parse_stage_list(file_list, local_root, remote_root):
+    """ Parse the value of the stagein or stageout attribute, of the form
+        'local_file@hostname:remote_file[,...]'. Return a list of tuples
+        (local_file, remote_file) of absolute paths, with relative local paths
+        taken relative to local_root, and relative remote paths relative to
+        remote_root. As all jobs run locally, the hostname is ignored. Raise a
+        ValueError if file_list cannot be parsed
+    """
+    result = []
+    for spec in file_list.split(','):
+        spec = spec.strip()
+        if spec == '':
+            continue
+        try:
+            local_file, remote = spec.split('@', 1)
+            hostname, remote_file = remote.split(':', 1)
+        except ValueError:
+            raise ValueError("Invalid stage file '%s', must be of the form "
+                             "local_file@hostname:remote_file" % spec)
+        if local_file == '' or remote_file == '':
+            raise ValueError("Invalid stage file '%s'" % spec)
+        local_file = os.path.join(local_root, os.path.expanduser(local_file))
+        remote_file = os.path.join(remote_root,
+                                   os.path.expanduser(remote_file))
+        result.append((os.path.normpath(local_file),
+                       os.path.normpath(remote_file)))
+    return result
+
+
+def clone_or_copy(source, destination):
+    """ Copy the file source to destination (which must not exist), through a
+        reflink if possible. Return True if a reflink was made
+    """
+    cloned = False
+    source_fh = open(source, 'rb')
+    try:
+        destination_fh = open(destination, 'wb')
+        try:
+            try:
+                fcntl.ioctl(destination_fh.fileno(), FICLONE,
+                            source_fh.fileno())
+                cloned = True
+            except (IOError, OSError):
+                # not supported, or across filesystems
+                shutil.copyfileobj(source_fh, destination_fh, BLOCK_SIZE)
+        finally:
+            destination_fh.close()
+    finally:
+        source_fh.close()
+    shutil.copymode(source, destination)
+    return cloned
+
+
+def link_or_copy(source, destination):
+    """ Replace destination by a hard link to source if possible, or else by a
+        copy of source
+    """
+    temp_file = "%s.lpbs-%i-%i" % (destination, os.getpid(),
+                                   id(destination))
+    try:
+        os.link(source, temp_file)
+    except OSError:
+        clone_or_copy(source, temp_file)
+    os.rename(temp_file, destination)
+
+
+class StageStore:
+    """ Content-addressed store for staged-in files """
+    def __init__(self, root):
+        """ Use (and create, if necessary) the store in the folder root.
+            Raise an OSError if the store cannot be created
+        """
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.index = os.path.join(root, 'index')
+        for folder in (self.objects, self.index):
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError, error:
+                    if error.errno != errno.EEXIST:
+                        raise
+
+    def content_hash(self, path):
+        """ Return the SHA1 hash of the content of the file at path. Hashes
+            are remembered for the device, inode, size, and modification time of
+            the file, so unchanged files are not read again
+        """
+        file_stat = os.stat(path)
+        key = "%x-%x-%x-%.9f" % (file_stat.st_dev, file_stat.st_ino,
+                                 file_stat.st_size, file_stat.st_mtime)
+        index_file = os.path.join(self.index, key)
+        try:
+            index_fh = open(index_file)
+            try:
+                content_hash = index_fh.read().strip()
+            finally:
+                index_fh.close()
+            if len(content_hash) == 40:
+                return content_hash
+        except IOError:
+            pass
+        sha1 = hashlib.sha1()
+        source_fh = open(path, 'rb')
+        try:
+            while True:
+                block = source_fh.read(BLOCK_SIZE)
+                if not block:
+                    break
+                sha1.update(block)
+        finally:
+            source_fh.close()
+        content_hash = sha1.hexdigest()
+        temp_file = "%s.%i-%i" % (index_file, os.getpid(), id(sha1))
+        try:
+            index_fh = open(temp_file, 'w')
+            index_fh.write(content_hash)
+            index_fh.close()
+            os.rename(temp_file, index_file)
+        except (IOError, OSError), error:
+            logging.debug("Cannot write stage index %s: %s", index_file, error)
+        return content_hash
+
+    def add(self, path):
+        """ Return the path of the (read-only) file in the store with the same
+            content as the file at path, adding it to the store if necessary
+        """
+        stored_file = os.path.join(self.objects, self.content_hash(path))
+        if os.path.isfile(stored_file):
+            logging.debug("Found %s in stage store", path)
+            os.utime(stored_file, None) # mark as recently used
+            return stored_file
+        temp_file = "%s.%i-%i" % (stored_file, os.getpid(), id(path))
+        try:
+            clone_or_copy(path, temp_file)
+            os.chmod(temp_file, 0o444)
+            # a concurrent job may have stored the same content; that's fine
+            os.rename(temp_file, stored_file)
+        except (IOError, OSError):
+            try:
+                os.unlink(temp_file)
+            except OSError:
+                pass
+            raise
+        return stored_file
+
+    def prune(self, max_age):
+        """ Remove all files from the store that are not used by any job, and
+            have not been used for max_age seconds
+        """
+        now = time.time()
+        for folder in (self.objects, self.index):
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    file_stat = os.lstat(path)
+                    if (file_stat.st_nlink == 1
+                    and now - file_stat.st_mtime > max_age):
+                        os.unlink(path)
+                except OSError:
+                    pass
+
+
+def expand_folders(file_pairs):
+    """ Replace every tuple (source, destination) in file_pairs for which
+        source is a folder by the tuples for all files in that folder, and
+        create the folders in destination. Return the resulting list of
+        tuples. Raise an IOError if a source does not exist
+    """
+    result = []
+    for (source, destination) in file_pairs:
+        if os.path.isdir(source):
+            for (dirpath, dirnames, filenames) in os.walk(source):
+                target = os.path.join(destination,
+                                      os.path.relpath(dirpath, source))
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                for filename in filenames:
+                    result.append((os.path.join(dirpath, filename),
+                                   os.path.join(target, filename)))
+        elif os.path.exists(source):
+            target = os.path.dirname(destination)
+            if target and not os.path.isdir(target):
+                os.makedirs(target)
+            result.append((source, destination))
+        else:
+            raise IOError(errno.ENOENT, "Cannot stage %s: no such file"
+                          % source)
+    return result
+
+
+def run_in_threads(function, items, threads):
+    """ Call function(item) for every item, using the given number of threads.
+        Raise the first exception raised by any call, after all calls have
+        finished
+    """
+    errors = []
+    def call(item):
+        """ Call function, recording errors """
+        try:
+            function(item)
+        except (IOError, OSError), error:
+            errors.append(error)
+    if threads > 1 and len(items) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(threads, len(items)))
+        try:
+            pool.map(call, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for item in items:
+            call(item)
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def stage_in(file_pairs, store=None, threads=1):
+    """ Stage in all files given by the list of tuples (local_file,
+        remote_file): make each remote_file (or folder) available as
+        local_file. If store is a StageStore, every file is added to the store,
+        and linked from there. Raise an IOError or OSError on failure
+    """
+    start = time.time()
+    pairs = expand_folders([(remote_file, local_file)
+                            for (local_file, remote_file) in file_pairs])
+    def stage_file(pair):
+        """ Stage in a single file """
+        (source, destination) = pair
+        if store is not None:
+            link_or_copy(store.add(source), destination)
+        else:
+            temp_file = "%s.lpbs-%i" % (destination, os.getpid())
+            clone_or_copy(source, temp_file)
+            os.rename(temp_file, destination)
+    run_in_threads(stage_file, pairs, threads)
+    logging.debug("Staged in %i files in %.2fs", len(pairs),
+                  time.time() - start)
+
+
+def stage_out(file_pairs, threads=1):
+    """ Stage out all files given by the list of tuples (local_file,
+        remote_file): replace each remote_file (or folder) by local_file.
+        Files are hard-linked if possible, unless they are shared with other
+        jobs through the store. Raise an IOError or OSError on failure
+    """
+    start = time.time()
+    pairs = expand_folders(file_pairs)
+    def stage_file(pair):
+        """ Stage out a single file """
+        (source, destination) = pair
+        if os.stat(source).st_nlink > 1:
+            # shared with the store, or with other jobs
+            temp_file = "%s.lpbs-%i" % (destination, os.getpid())
+            clone_or_copy(source, temp_file)
+            os.rename(temp_file, destination)
+        else:
+            link_or_copy(source, destination)
+    run_in_threads(stage_file, pairs, threads)
+    logging.debug("Staged out %i files in %.2fs", len(pairs),
+                  time.time() - start)
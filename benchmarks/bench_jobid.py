@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Stress test for job ID allocation: fork N submitters that each allocate M job
+IDs from a throwaway $LPBS_HOME, and verify that all IDs are unique.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+from LPBS.Config import get_config
+from LPBS.JobUtils import get_new_job_id
+
+
+class Options:
+    """ Stand-in for the lqsub options, carrying only the config """
+    def __init__(self):
+        self.config = get_config(None)
+
+
+def submitter(ids_per_process, outfile):
+    """ Allocate the given number of job IDs, and write them to outfile """
+    options = Options()
+    out = open(outfile, 'w')
+    for i in xrange(ids_per_process):
+        out.write("%s\n" % get_new_job_id(options))
+    out.close()
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-n', action='store', dest='processes', type='int', default=32,
+      help="Number of concurrent submitters (default 32)")
+    arg_parser.add_option(
+      '-m', action='store', dest='ids', type='int', default=200,
+      help="Number of IDs allocated by each submitter (default 200)")
+    options, args = arg_parser.parse_args(argv)
+    lpbs_home = tempfile.mkdtemp(prefix='lpbs_bench_')
+    os.environ['LPBS_HOME'] = lpbs_home
+    try:
+        start = time.time()
+        children = []
+        for i in xrange(options.processes):
+            outfile = os.path.join(lpbs_home, "ids.%i" % i)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    submitter(options.ids, outfile)
+                finally:
+                    os._exit(0)
+            children.append((pid, outfile))
+        job_ids = []
+        for (pid, outfile) in children:
+            os.waitpid(pid, 0)
+            job_ids.extend(open(outfile).read().split())
+        runtime = time.time() - start
+        expected = options.processes * options.ids
+        unique = len(set(job_ids))
+        print "submitters: %i" % options.processes
+        print "ids_allocated: %i" % len(job_ids)
+        print "ids_unique: %i" % unique
+        print "ids_per_second: %.1f" % (len(job_ids) / runtime)
+        if unique != expected or len(job_ids) != expected:
+            print >> sys.stderr, "FAILED: expected %i unique IDs" % expected
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(lpbs_home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Benchmark and check for the LPBS log: fork N processes that each log M
+entries into a throwaway $LPBS_HOME, once through the plain text logfile and
+once through the JSON-lines segments, and report the time spent in the
+logging calls per entry. Verify that every entry ends up in the log as a
+complete line.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+from optparse import OptionParser
+from LPBS.Config import get_config
+from LPBS.EventLog import setup_logging, log_folder, segment_days, flush_log
+
+
+def cpu_time():
+    """ Return the CPU time (user and system) of the current process """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def logger_process(config, entries, timing_file):
+    """ Log the given number of entries, write the CPU time spent on them
+        (including the writes of the background thread) and the wall time
+        spent in the logging calls to timing_file
+    """
+    setup_logging(config)
+    start_cpu = cpu_time()
+    start = time.time()
+    for i in xrange(entries):
+        logging.info("Finished job %i.localhost.local with status %i", i, 0)
+    elapsed = time.time() - start
+    flush_log()
+    timing_fh = open(timing_file, 'w')
+    timing_fh.write("%r %r\n" % (cpu_time() - start_cpu, elapsed))
+    timing_fh.close()
+
+
+def run(config, processes, entries, lpbs_home):
+    """ Run the logging processes, return a tuple of the total CPU time, and
+        the total wall time spent in the logging calls
+    """
+    pids = []
+    for i in xrange(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logger_process(config, entries,
+                               os.path.join(lpbs_home, "timing.%i" % i))
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    total_cpu = total = 0.0
+    for i in xrange(processes):
+        timing_file = os.path.join(lpbs_home, "timing.%i" % i)
+        cpu, elapsed = open(timing_file).read().split()
+        total_cpu += float(cpu)
+        total += float(elapsed)
+        os.unlink(timing_file)
+    return (total_cpu, total)
+
+
+def count_lines(config, lpbs_home):
+    """ Return a tuple (lines, broken lines) for the log given in config """
+    folder = log_folder(config)
+    if folder is None:
+        files = [os.path.join(lpbs_home, config.get('LPBS', 'logfile'))]
+    else:
+        files = [os.path.join(folder, "%s.jsonl" % day)
+                 for day in segment_days(folder)]
+    lines = broken = 0
+    for filename in files:
+        for line in open(filename):
+            lines += 1
+            if folder is None:
+                if not line.rstrip('\n').endswith('status 0'):
+                    broken += 1
+            else:
+                try:
+                    json.loads(line)
+                except ValueError:
+                    broken += 1
+    return (lines, broken)
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-n', action='store', dest='processes', type='int', default=32,
+      help="Number of logging processes (default 32)")
+    arg_parser.add_option(
+      '-m', action='store', dest='entries', type='int', default=2000,
+      help="Number of entries per process (default 2000)")
+    options, args = arg_parser.parse_args(argv)
+    failed = False
+    for (name, folder) in (('logfile', ''), ('segments', 'log')):
+        lpbs_home = tempfile.mkdtemp(prefix='lpbs_bench_')
+        os.environ['LPBS_HOME'] = lpbs_home
+        try:
+            config = get_config(None)
+            config.set('LPBS', 'log_folder', folder)
+            total_cpu, total = run(config, options.processes,
+                                   options.entries, lpbs_home)
+            lines, broken = count_lines(config, lpbs_home)
+            count = options.processes * options.entries
+            print "%s_cpu_us_per_entry: %.2f" % (name,
+                                                 1e6 * total_cpu / count)
+            print "%s_wall_us_per_entry: %.2f" % (name, 1e6 * total / count)
+            print "%s_lines: %i" % (name, lines)
+            print "%s_broken_lines: %i" % (name, broken)
+            if lines != count or broken > 0:
+                print >> sys.stderr, "FAILED: expected %i complete lines " \
+                                     "in %s" % (count, name)
+                failed = True
+        finally:
+            shutil.rmtree(lpbs_home, ignore_errors=True)
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Benchmark and check for email notifications: run a local SMTP stand-in that
+answers slowly, send start and stop notifications for N jobs to R recipients
+from a throwaway $LPBS_HOME, and report the time spent in Notifier.notify, and
+the number of SMTP sessions and mails received by the stand-in.
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncore
+import smtpd
+import tempfile
+import threading
+from optparse import OptionParser
+from LPBS.Config import get_config
+from LPBS.Notifications import Notifier, COND_STRT, COND_STOP
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """ SMTP stand-in that counts sessions and mails, and delays every
+        session by a fixed time
+    """
+    def __init__(self, localaddr, delay):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.listen(128) # all background senders connect at the same time
+        self.delay = delay
+        self.sessions = 0
+        self.mails = 0
+        self.recipients = 0
+    def handle_accept(self):
+        self.sessions += 1
+        time.sleep(self.delay)
+        smtpd.SMTPServer.handle_accept(self)
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.mails += 1
+        self.recipients += len(rcpttos)
+
+
+class Options:
+    """ Stand-in for the lqsub options """
+    def __init__(self, recipients):
+        self.config = get_config(None)
+        self.job_name = 'bench'
+        self.email_addresses = [",".join(["user%i@example.org" % i
+                                          for i in xrange(recipients)])]
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-n', action='store', dest='jobs', type='int', default=20,
+      help="Number of jobs (default 20)")
+    arg_parser.add_option(
+      '-r', action='store', dest='recipients', type='int', default=3,
+      help="Number of recipients (default 3)")
+    arg_parser.add_option(
+      '--delay', action='store', dest='delay', type='float', default=0.2,
+      help="Delay of the SMTP stand-in per session, in seconds (default 0.2)")
+    arg_parser.add_option(
+      '--digest', action='store', dest='digest', type='float', default=0,
+      help="Digest interval in seconds (default 0: no digest)")
+    arg_parser.add_option(
+      '--port', action='store', dest='port', type='int', default=10025,
+      help="Port for the SMTP stand-in (default 10025)")
+    options, args = arg_parser.parse_args(argv)
+    lpbs_home = tempfile.mkdtemp(prefix='lpbs_bench_')
+    os.environ['LPBS_HOME'] = lpbs_home
+    try:
+        sink = SMTPSink(('localhost', options.port), options.delay)
+        server_thread = threading.Thread(target=asyncore.loop,
+                                         kwargs={'timeout': 0.1})
+        server_thread.daemon = True
+        server_thread.start()
+        job_options = Options(options.recipients)
+        config = job_options.config
+        config.set('Notification', 'send_mail', '1')
+        config.set('Mail', 'smtp', 'localhost:%i' % options.port)
+        config.set('Mail', 'tls', '0')
+        config.set('Mail', 'digest', str(options.digest))
+        # the digest is sent with the settings from $LPBS_HOME/lpbs.cfg
+        config_fh = open(os.path.join(lpbs_home, 'lpbs.cfg'), 'w')
+        config.write(config_fh)
+        config_fh.close()
+        start = time.time()
+        for i in xrange(options.jobs):
+            notifier = Notifier("%i.localhost.local" % i, job_options)
+            notifier.notify(COND_STRT)
+            notifier.job_retcode = 0
+            notifier.notify(COND_STOP)
+        notify_time = time.time() - start
+        # wait for the background deliveries
+        expected = 2 * options.jobs
+        if options.digest > 0:
+            expected = 1
+        deadline = time.time() + options.digest + 30
+        while sink.mails < expected and time.time() < deadline:
+            time.sleep(0.1)
+        print "notifications: %i" % (2 * options.jobs)
+        print "notify_seconds: %.4f" % notify_time
+        print "smtp_sessions: %i" % sink.sessions
+        print "mails: %i" % sink.mails
+        print "delivered_recipients: %i" % sink.recipients
+        if sink.mails != expected:
+            print >> sys.stderr, "FAILED: expected %i mails" % expected
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(lpbs_home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
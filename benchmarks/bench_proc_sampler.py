@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Benchmark for collecting the CPU and memory usage of many jobs: start N
+synthetic process trees (each a root process with W children, which each have
+W children of their own), and compare the time needed to collect the resources
+of all trees with get_cpu_mem_info for every job (psutil, if available), with
+one pass over /proc per job, and with a single pass over /proc for all jobs.
+"""
+
+import os
+import sys
+import time
+import signal
+from optparse import OptionParser
+from LPBS.JobUtils import get_cpu_mem_info, get_cpu_mem_info_for_pids
+
+
+def spawn_tree(depth, width):
+    """ Fork a process tree of the given depth, in which every process except
+        the leaves has width children. Return the PID of its root. All
+        processes sleep until they are killed
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgid(0, 0)
+            for i in xrange(width):
+                if depth > 1:
+                    spawn_subtree(depth - 1, width)
+            while True:
+                time.sleep(3600)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def spawn_subtree(depth, width):
+    """ Fork a subtree of a tree started by spawn_tree (in the same process
+        group)
+    """
+    if os.fork() == 0:
+        try:
+            for i in xrange(width):
+                if depth > 1:
+                    spawn_subtree(depth - 1, width)
+            while True:
+                time.sleep(3600)
+        finally:
+            os._exit(0)
+
+
+def timed(function, repeat):
+    """ Return tuple (result, seconds per call) for calling function repeat
+        times
+    """
+    start = time.time()
+    for i in xrange(repeat):
+        result = function()
+    return (result, (time.time() - start) / repeat)
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-n', action='store', dest='trees', type='int', default=100,
+      help="Number of process trees (default 100)")
+    arg_parser.add_option(
+      '-w', action='store', dest='width', type='int', default=3,
+      help="Number of children of every non-leaf process (default 3)")
+    arg_parser.add_option(
+      '-r', action='store', dest='repeat', type='int', default=5,
+      help="Number of repetitions of every measurement (default 5)")
+    options, args = arg_parser.parse_args(argv)
+    roots = []
+    try:
+        for i in xrange(options.trees):
+            roots.append(spawn_tree(3, options.width))
+        time.sleep(1) # let all trees finish forking
+        processes = options.trees * (1 + options.width + options.width**2)
+        print "trees: %i" % options.trees
+        print "processes: %i" % processes
+        try:
+            import psutil
+            (per_job, seconds) = timed(lambda: dict([(pid,
+                                 get_cpu_mem_info(pid)) for pid in roots]),
+                                 options.repeat)
+            print "psutil_per_job_seconds: %.4f" % seconds
+        except ImportError:
+            per_job = None
+            print "psutil_per_job_seconds: n/a (psutil not available)"
+        (per_job_proc, seconds) = timed(lambda: dict([(pid,
+                                  get_cpu_mem_info_for_pids([pid])[pid])
+                                  for pid in roots]), options.repeat)
+        print "proc_per_job_seconds: %.4f" % seconds
+        (batched, seconds) = timed(lambda: get_cpu_mem_info_for_pids(roots),
+                                   options.repeat)
+        print "proc_batched_seconds: %.4f" % seconds
+        failed = False
+        for pid in roots:
+            # memory may fluctuate between samples; compare the process counts
+            # implied by the thread numbers and the presence of results
+            if batched[pid][1] <= 0 or batched[pid][3] <= 0:
+                failed = True
+            if per_job is not None and per_job[pid][3] != batched[pid][3]:
+                failed = True
+            if per_job_proc[pid][3] != batched[pid][3]:
+                failed = True
+        if failed:
+            print >> sys.stderr, "FAILED: results of the methods differ"
+            return 1
+        return 0
+    finally:
+        for pid in roots:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for pid in roots:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
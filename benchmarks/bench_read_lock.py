@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Benchmark for looking up running jobs: start N sleeping processes, register
+each as a job in a throwaway $LPBS_HOME, and compare the time needed to read
+all lock files in full and examine the processes of every job (as lqstat and
+lqdel did before the job registry), to read only the headers of all lock
+files, to find the PIDs of all jobs in the registry (as lqdel does), and to
+list all jobs of the current user with and without sampling their processes
+(as 'lqstat -u <user>' and 'lqstat -u <user> -F job_state' do).
+"""
+
+import os
+import sys
+import time
+import pwd
+import shutil
+import signal
+import tempfile
+from optparse import OptionParser
+from LPBS.JobUtils import JobInfo, find_jobs, pid_for_job_id, \
+                          decode_job_info, read_lock_header
+from LPBS.JobRegistry import close_registry
+
+
+def spawn_sleeper():
+    """ Fork a process that sleeps until it is killed. Return its PID """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            while True:
+                time.sleep(3600)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def timed(function, repeat):
+    """ Return tuple (result, seconds per call) for calling function repeat
+        times
+    """
+    start = time.time()
+    for i in xrange(repeat):
+        result = function()
+    return (result, (time.time() - start) / repeat)
+
+
+def read_locks(lockfiles):
+    """ Return a list of JobInfo instances read in full from the given lock
+        files, after determining the resources used by every job one by one
+    """
+    result = []
+    for lockfile in lockfiles:
+        lock = open(lockfile, 'r')
+        try:
+            job_info = decode_job_info(lock.read())
+        finally:
+            lock.close()
+        job_info.update_resources_used()
+        result.append(job_info)
+    return result
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-n', action='store', dest='jobs', type='int', default=200,
+      help="Number of running jobs (default 200)")
+    arg_parser.add_option(
+      '-r', action='store', dest='repeat', type='int', default=5,
+      help="Number of repetitions of every measurement (default 5)")
+    options, args = arg_parser.parse_args(argv)
+    lpbs_home = tempfile.mkdtemp(prefix='lpbs_bench_')
+    os.environ['LPBS_HOME'] = lpbs_home
+    owner = pwd.getpwuid(os.getuid()).pw_name
+    pids = []
+    try:
+        close_registry()
+        for i in xrange(options.jobs):
+            pids.append(spawn_sleeper())
+        job_ids = []
+        lockfiles = []
+        for (i, pid) in enumerate(pids):
+            job_info = JobInfo("%i.localhost" % (i + 1))
+            job_info.name = "bench"
+            job_info.owner = owner
+            job_info.start_time = time.time()
+            job_info.set_lock(pid)
+            job_ids.append(job_info.job_id)
+            lockfiles.append(job_info.lockfile)
+        print "jobs: %i" % options.jobs
+        (full, seconds) = timed(lambda: read_locks(lockfiles),
+                                options.repeat)
+        print "read_locks_sampled_seconds: %.4f" % seconds
+        (headers, seconds) = timed(lambda: [read_lock_header(lockfile)
+                                   for lockfile in lockfiles], options.repeat)
+        print "read_lock_headers_seconds: %.4f" % seconds
+        (found_pids, seconds) = timed(lambda: [pid_for_job_id(job_id)
+                                      for job_id in job_ids], options.repeat)
+        print "lqdel_lookup_seconds: %.4f" % seconds
+        (sampled, seconds) = timed(lambda: find_jobs(owner=owner),
+                                   options.repeat)
+        print "lqstat_u_seconds: %.4f" % seconds
+        (unsampled, seconds) = timed(lambda: find_jobs(owner=owner,
+                                     sample=False), options.repeat)
+        print "lqstat_u_unsampled_seconds: %.4f" % seconds
+        failed = False
+        if found_pids != pids:
+            failed = True
+        if [job_info.pid for job_info in headers] != pids:
+            failed = True
+        for job_infos in (full, sampled):
+            if len(job_infos) != len(pids):
+                failed = True
+            for job_info in job_infos:
+                if not job_info.resources_used.has_key('walltime'):
+                    failed = True
+        if len(unsampled) != len(pids):
+            failed = True
+        if failed:
+            print >> sys.stderr, "FAILED: results of the methods differ"
+            return 1
+        return 0
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        close_registry()
+        shutil.rmtree(lpbs_home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Benchmark for the startup time of the LPBS command line tools: run every entry
+point N times in a throwaway $LPBS_HOME, and report the mean wall time per
+invocation. Also check that the query tools
+(lqstat, lqdel) do not import the modules for sending notifications.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# entry point => arguments (none of them starts a job)
+ENTRY_POINTS = [('lqstat', []), ('lqdel', ['999']), ('lqsub', ['--help']),
+                ('lpbsd', ['--stop'])]
+
+# modules that the query tools must not load
+HEAVY_MODULES = ['email', 'smtplib', 'gntp', 'multiprocessing']
+
+# run a tool, then report which modules it imported
+MODULE_REPORT = """
+import sys, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print >> sys.__stderr__, 'MODULES', ' '.join(sorted(name for (name, module)
+                                    in sys.modules.items() if module))
+"""
+
+
+def run_tool(tool, args, env):
+    """ Run the given tool and return the wall time in seconds """
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    subprocess.call([sys.executable, os.path.join(ROOT, tool)] + args,
+                    env=env, stdout=devnull, stderr=devnull)
+    seconds = time.time() - start
+    devnull.close()
+    return seconds
+
+
+def loaded_modules(tool, args, env):
+    """ Return the set of modules imported by running the given tool """
+    proc = subprocess.Popen([sys.executable, '-c', MODULE_REPORT,
+                            os.path.join(ROOT, tool)] + args, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = proc.communicate()
+    for line in err.splitlines():
+        if line.startswith('MODULES'):
+            return set(line.split()[1:])
+    return set()
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-n', action='store', dest='repeat', type='int', default=20,
+      help="Number of invocations of every tool (default 20)")
+    options, args = arg_parser.parse_args(argv)
+    lpbs_home = tempfile.mkdtemp(prefix='lpbs_bench_')
+    env = dict(os.environ)
+    env['LPBS_HOME'] = lpbs_home
+    env['PYTHONPATH'] = os.pathsep.join([ROOT]
+                        + env.get('PYTHONPATH', '').split(os.pathsep))
+    failed = False
+    try:
+        run_tool('lqstat', [], env) # creates lpbs.cfg
+        for (tool, tool_args) in ENTRY_POINTS:
+            seconds = 0.0
+            for i in xrange(options.repeat):
+                seconds += run_tool(tool, tool_args, env)
+            print "%s_ms: %.1f" % (tool, 1000 * seconds / options.repeat)
+            modules = loaded_modules(tool, tool_args, env)
+            heavy = [name for name in HEAVY_MODULES if name in modules]
+            print "%s_modules: %i" % (tool, len(modules))
+            print "%s_heavy_modules: %s" % (tool, ",".join(heavy) or "none")
+            if tool in ('lqstat', 'lqdel') and len(heavy) > 0:
+                failed = True
+        if failed:
+            print >> sys.stderr, "FAILED: query tools import notification " \
+                                 "modules"
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(lpbs_home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
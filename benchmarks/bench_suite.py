@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+############################################################################
+#    Copyright (C) 2015 by Michael Goerz                                   #
+#    http://michaelgoerz.net                                               #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+"""
+Benchmark suite for the LPBS command line tools: for every job count N given
+with -s, create a throwaway $LPBS_HOME and measure
+- the throughput of lqsub, submitting N jobs that each sleep until deleted,
+- the peak memory (VmHWM) of the processes supervising the jobs, per job,
+- the latency of lqstat, lqstat -f, and lqstat --json -F job_state,
+- the wall time of 'lqdel all', and until all jobs have ended.
+Once, it also compares the time for K short jobs to run with and without
+start and end notifications, sent to a local SMTP stand-in, and checks that a
+job released by deleting the held job it depends on starts right away.
+
+Jobs are supervised by a single lpbsd (default) or by one lqsub process each
+(--direct). The results are printed as 'key: value' lines, or with --json as a
+single JSON object, so that runs can be compared.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import asyncore
+import platform
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+from bench_mail import SMTPSink
+from LPBS.JobRegistry import JobRegistry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMEOUT = 600 # seconds to wait for jobs to start or end
+RELEASE_TIMEOUT = 10 # seconds for a released job to start
+
+LONG_JOB = "#!/bin/sh\n#PBS -N bench\nexec sleep 3600\n"
+SHORT_JOB = "#!/bin/sh\n#PBS -N short\nexit 0\n"
+
+MAIL_CONFIG = """
+[Notification]
+send_mail: 1
+
+[Mail]
+from: lpbs@localhost
+smtp: localhost:%i
+authenticate: 0
+tls: 0
+"""
+
+
+class Home:
+    """ Throwaway $LPBS_HOME, with the environment for running the tools in
+        it
+    """
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='lpbs_bench_')
+        self.env = dict(os.environ)
+        self.env['LPBS_HOME'] = self.path
+        self.env['SCRATCH_ROOT'] = self.path
+        self.env['SHELL'] = '/bin/sh'
+        self.env['PYTHONPATH'] = os.pathsep.join([ROOT] + self.env.get(
+                                 'PYTHONPATH', '').split(os.pathsep))
+        for (name, script) in (('long.pbs', LONG_JOB),
+                               ('short.pbs', SHORT_JOB)):
+            script_fh = open(os.path.join(self.path, name), 'w')
+            script_fh.write(script)
+            script_fh.close()
+            os.chmod(os.path.join(self.path, name), 0o755)
+        self.run('lqstat') # creates lpbs.cfg
+
+    def run(self, tool, *args):
+        """ Run the given tool to completion, and return its wall time in
+            seconds
+        """
+        devnull = open(os.devnull, 'w')
+        start = time.time()
+        subprocess.call([sys.executable, os.path.join(ROOT, tool)]
+                        + list(args), env=self.env, cwd=self.path,
+                        stdout=devnull, stderr=devnull)
+        seconds = time.time() - start
+        devnull.close()
+        return seconds
+
+    def submit(self, count, args, parallel):
+        """ Submit count jobs with lqsub and the given arguments, running at
+            most parallel submissions at a time. Return the wall time in
+            seconds. Raise a RuntimeError if any submission fails
+        """
+        devnull = open(os.devnull, 'w')
+        command = [sys.executable, os.path.join(ROOT, 'lqsub')] + args
+        running = []
+        failed = 0
+        start = time.time()
+        for i in xrange(count):
+            while len(running) >= parallel:
+                if running.pop(0).wait() != 0:
+                    failed += 1
+            running.append(subprocess.Popen(command, env=self.env,
+                           cwd=self.path, stdout=devnull, stderr=devnull))
+        for process in running:
+            if process.wait() != 0:
+                failed += 1
+        seconds = time.time() - start
+        devnull.close()
+        if failed > 0:
+            raise RuntimeError("%i of %i submissions failed" % (failed, count))
+        return seconds
+
+    def submit_one(self, *args):
+        """ Submit a single job with lqsub and the given arguments, and return
+            its job ID. Raise a RuntimeError if the submission fails
+        """
+        process = subprocess.Popen([sys.executable,
+                                   os.path.join(ROOT, 'lqsub')] + list(args),
+                                   env=self.env, cwd=self.path,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        (out, err) = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError("Submission failed: %s" % err.strip())
+        return out.strip()
+
+    def jobs(self):
+        """ Return a list of tuples (job_id, pid) for all registered jobs """
+        registry = JobRegistry(self.path)
+        try:
+            return registry.lookup()
+        finally:
+            registry.connection.close()
+
+    def wait_for(self, condition, timeout=TIMEOUT):
+        """ Wait until condition(jobs) is True for the list of registered jobs
+            (as returned by jobs). Return the seconds waited, or None after
+            timeout seconds
+        """
+        start = time.time()
+        while time.time() - start < timeout:
+            if condition(self.jobs()):
+                return time.time() - start
+            time.sleep(0.1)
+        return None
+
+    def remove(self):
+        """ Delete all jobs, stop the daemon (if any), and delete $LPBS_HOME
+        """
+        self.run('lqdel', 'all')
+        self.run('lpbsd', '--stop')
+        self.wait_for(lambda jobs: len(jobs) == 0)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def peak_memory(pid):
+    """ Return the peak resident memory of the process with the given PID in
+        bytes, or 0 if it cannot be determined
+    """
+    try:
+        status_fh = open('/proc/%i/status' % pid)
+        try:
+            for line in status_fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            status_fh.close()
+    except (IOError, IndexError, ValueError):
+        pass
+    return 0
+
+
+def parent_pid(pid):
+    """ Return the PID of the parent of the process with the given PID, or
+        None if it cannot be determined
+    """
+    try:
+        stat_fh = open('/proc/%i/stat' % pid)
+        try:
+            stat = stat_fh.read()
+        finally:
+            stat_fh.close()
+        return int(stat[stat.rfind(')')+2:].split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def job_started(job_id):
+    """ Return a condition for Home.wait_for that is True once the job with
+        the given ID has a process
+    """
+    return lambda jobs: len([pid for (registered_id, pid) in jobs
+                             if registered_id == job_id
+                             and pid is not None]) > 0
+
+
+def mean_time(home, repeat, tool, *args):
+    """ Return the mean wall time in seconds of repeat runs of the tool """
+    return sum([home.run(tool, *args) for i in xrange(repeat)]) / repeat
+
+
+def bench_scale(count, options):
+    """ Return a dict with the results for count jobs """
+    results = {}
+    home = Home()
+    try:
+        if not options.direct:
+            home.run('lpbsd')
+        seconds = home.submit(count, ['long.pbs'], options.parallel)
+        results['submit_per_second'] = count / seconds
+        waited = home.wait_for(lambda jobs: len([pid for (job_id, pid)
+                               in jobs if pid is not None]) >= count)
+        if waited is None:
+            raise RuntimeError("Only %i of %i jobs started"
+                               % (len(home.jobs()), count))
+        results['start_seconds'] = seconds + waited
+        # the lock of a job run by lqsub holds the PID of the supervising
+        # process, that of a job run by lpbsd the PID of the job's process
+        if options.direct:
+            supervisors = set([pid for (job_id, pid) in home.jobs()])
+        else:
+            supervisors = set([parent_pid(pid) for (job_id, pid)
+                               in home.jobs()])
+        supervisors.discard(None)
+        results['supervisors'] = len(supervisors)
+        results['peak_memory_per_job_kb'] = sum([peak_memory(pid) for pid
+                                            in supervisors]) / 1024.0 / count
+        results['lqstat_ms'] = 1000 * mean_time(home, options.repeat,
+                                                'lqstat')
+        results['lqstat_full_ms'] = 1000 * mean_time(home, options.repeat,
+                                                     'lqstat', '-f')
+        results['lqstat_fields_ms'] = 1000 * mean_time(home, options.repeat,
+                                      'lqstat', '--json', '-F', 'job_state')
+        results['lqdel_all_seconds'] = home.run('lqdel', 'all')
+        waited = home.wait_for(lambda jobs: len(jobs) == 0)
+        if waited is None:
+            raise RuntimeError("%i jobs still running after lqdel all"
+                               % len(home.jobs()))
+        results['lqdel_drain_seconds'] = results['lqdel_all_seconds'] + waited
+    finally:
+        home.remove()
+    return results
+
+
+def bench_release(options):
+    """ Return a dict with the time for a job to start after lqdel released it:
+        job A runs, job B is held until A ends, and job C is held until B
+        ends. Deleting B must start C, while A is still running. Raise a
+        RuntimeError if C does not start within RELEASE_TIMEOUT seconds
+    """
+    results = {}
+    home = Home()
+    try:
+        if not options.direct:
+            home.run('lpbsd')
+        job_a = home.submit_one('long.pbs')
+        job_b = home.submit_one('-W', 'depend=afterok:%s' % job_a, 'long.pbs')
+        job_c = home.submit_one('-W', 'depend=afterany:%s' % job_b,
+                                'long.pbs')
+        if home.wait_for(job_started(job_a), RELEASE_TIMEOUT) is None:
+            raise RuntimeError("Job %s did not start" % job_a)
+        start = time.time()
+        home.run('lqdel', job_b)
+        if home.wait_for(job_started(job_c), RELEASE_TIMEOUT) is None:
+            raise RuntimeError("Job %s did not start after deleting %s"
+                               % (job_c, job_b))
+        results['start_seconds'] = time.time() - start
+    finally:
+        home.remove()
+    return results
+
+
+def bench_notifications(count, options):
+    """ Return a dict with the time for count short jobs to run with and
+        without notifications, and the number of mails received
+    """
+    results = {}
+    sink = SMTPSink(('localhost', options.port), 0)
+    server_thread = threading.Thread(target=asyncore.loop,
+                                     kwargs={'timeout': 0.1})
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        for mail in (False, True):
+            home = Home()
+            try:
+                args = ['short.pbs']
+                if mail:
+                    config_file = os.path.join(home.path, 'mail.cfg')
+                    config_fh = open(config_file, 'w')
+                    config_fh.write(MAIL_CONFIG % options.port)
+                    config_fh.close()
+                    args = ['--config', config_file, '-m', 'be', '-M',
+                            'user@example.org'] + args
+                if not options.direct:
+                    home.run('lpbsd')
+                start = time.time()
+                home.submit(count, args, options.parallel)
+                if home.wait_for(lambda jobs: len(jobs) == 0) is None:
+                    raise RuntimeError("Short jobs did not end")
+                if mail:
+                    deadline = time.time() + TIMEOUT
+                    while sink.mails < 2 * count and time.time() < deadline:
+                        time.sleep(0.05)
+                    results['mails'] = sink.mails
+                    results['mail_seconds'] = time.time() - start
+                else:
+                    results['plain_seconds'] = time.time() - start
+            finally:
+                home.remove()
+        results['overhead_per_job_ms'] = 1000 * (results['mail_seconds']
+                                         - results['plain_seconds']) / count
+    finally:
+        sink.close()
+    return results
+
+
+def main(argv=None):
+    """ Main Program """
+    if argv is None:
+        argv = sys.argv
+    arg_parser = OptionParser(
+    usage = "usage: %prog [options]", description = __doc__)
+    arg_parser.add_option(
+      '-s', action='store', dest='scales', default='10,100',
+      help="Comma-separated job counts (default '10,100'; up to 10000)")
+    arg_parser.add_option(
+      '-k', action='store', dest='notify_jobs', type='int', default=20,
+      help="Number of jobs for the notification benchmark (default 20; "
+      "0 to skip it)")
+    arg_parser.add_option(
+      '-p', action='store', dest='parallel', type='int', default=1,
+      help="Number of concurrent lqsub processes (default 1)")
+    arg_parser.add_option(
+      '-r', action='store', dest='repeat', type='int', default=5,
+      help="Number of repetitions of every lqstat measurement (default 5)")
+    arg_parser.add_option(
+      '--direct', action='store_true', dest='direct', default=False,
+      help="Let every job be supervised by its own lqsub process, instead "
+      "of by lpbsd")
+    arg_parser.add_option(
+      '--port', action='store', dest='port', type='int', default=10025,
+      help="Port for the SMTP stand-in (default 10025)")
+    arg_parser.add_option(
+      '--json', action='store_true', dest='json', default=False,
+      help="Print the results as a single JSON object")
+    options, args = arg_parser.parse_args(argv)
+    try:
+        scales = [int(scale) for scale in options.scales.split(',')]
+    except ValueError:
+        print >> sys.stderr, "Invalid job counts: %s" % options.scales
+        return 1
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': socket.gethostname(),
+              'python': platform.python_version(),
+              'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+              'mode': ('direct' if options.direct else 'daemon'),
+              'parallel': options.parallel, 'scales': {}}
+    try:
+        for count in scales:
+            report['scales'][str(count)] = bench_scale(count, options)
+        report['release'] = bench_release(options)
+        if options.notify_jobs > 0:
+            report['notifications'] = bench_notifications(options.notify_jobs,
+                                                          options)
+    except RuntimeError, error:
+        print >> sys.stderr, "FAILED: %s" % error
+        return 1
+    if options.json:
+        print json.dumps(report, sort_keys=True)
+        return 0
+    for key in ('time', 'host', 'python', 'cpus', 'mode', 'parallel'):
+        print "%s: %s" % (key, report[key])
+    for count in scales:
+        results = report['scales'][str(count)]
+        for key in sorted(results.keys()):
+            print "jobs_%i.%s: %s" % (count, key, _format(results[key]))
+    for key in sorted(report['release'].keys()):
+        print "release.%s: %s" % (key, _format(report['release'][key]))
+    for key in sorted(report.get('notifications', {}).keys()):
+        print "notifications.%s: %s" % (key,
+                                        _format(report['notifications'][key]))
+    return 0
+
+
+def _format(value):
+    """ Format a result value """
+    if isinstance(value, float):
+        return "%.4f" % value
+    return str(value)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,7 +20,7 @@ setup(name='LPBS',
       url='https://github.com/goerz/LPBS',
       license='GPL',
       packages=['LPBS'],
-      scripts=['lqsub', 'lqdel', 'lqstat'],
+      scripts=['lqsub', 'lqdel', 'lqstat', 'lqpeek', 'lqacct', 'lqlog', 'lpbsd'],
       long_description=read('README.rst'),
       classifiers=[
           'Development Status :: 4 - Beta',